@@ -17,15 +17,37 @@ import sys
 import codecs
 import io
 import argparse
+import heapq
 import re
+from collections import deque
+from multiprocessing import Pool
 
 # hack for python2/3 compatibility
 from io import open
 argparse.open = open
 
+# lines segmented by a worker at once
+CHUNK_LINES = 2000
+
+class BoundedCache(dict):
+    """Cache of encoded words that stops growing at maxsize entries
+
+    Words are not evicted: the cache keeps the first words that it is given,
+    which are the most frequent ones if it was prewarmed (see BPE.prewarm),
+    and mostly frequent ones in any case.
+    """
+
+    def __init__(self, maxsize):
+        dict.__init__(self)
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        if len(self) < self.maxsize:
+            dict.__setitem__(self, key, value)
+
 class BPE(object):
 
-    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None):
+    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None, cache_size=None):
 
         # check version information
         firstline = codes.readline()
@@ -48,7 +70,7 @@ class BPE(object):
 
         self.glossaries = glossaries if glossaries else []
 
-        self.cache = {}
+        self.cache = {} if cache_size is None else BoundedCache(cache_size)
 
     def segment(self, sentence):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
@@ -70,6 +92,14 @@ class BPE(object):
 
         return ' '.join(output)
 
+    def prewarm(self, words):
+        """Encode words into the cache, most frequent first, until it is full"""
+        maxsize = getattr(self.cache, 'maxsize', None)
+        for word in words:
+            if maxsize is not None and len(self.cache) >= maxsize:
+                break
+            self.segment(word)
+
     def _isolate_glossaries(self, word):
         word_segments = [word]
         for gloss in self.glossaries:
@@ -115,6 +145,18 @@ def create_parser():
         metavar="STR",
         help="Glossaries. The strings provided in glossaries will not be affected"+
              "by the BPE (i.e. they will neither be broken into subwords, nor concatenated with other subwords")
+    parser.add_argument(
+        '--num-workers', '-j', type=int, default=1,
+        metavar="INT",
+        help="Number of processes segmenting the input. The output keeps the order of the input (default: %(default)s)")
+    parser.add_argument(
+        '--cache-size', type=int, default=None,
+        metavar="INT",
+        help="Maximum number of encoded words cached by each process (default: no limit)")
+    parser.add_argument(
+        '--cache-vocabulary', type=argparse.FileType('r'), default=None,
+        metavar="PATH",
+        help="Word vocabulary (built with get_vocab.py) whose most frequent words are encoded into the cache before the input")
 
     return parser
 
@@ -130,6 +172,58 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+def merge_symbols(symbols, bpe_codes):
+    """Apply BPE merge operations to a list of symbols, and return the result as a tuple
+
+    The result is the same as merging all occurrences of the pair with the
+    lowest rank, leftmost first, until no pair in bpe_codes is left. The
+    symbols are kept in a doubly linked list (indices of the previous and next
+    symbol), and candidate merges in a heap of (rank, position), which is only
+    updated around each merge.
+    """
+    symbols = list(symbols)
+    n = len(symbols)
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    nxt[-1] = -1
+
+    heap = []
+    for i in range(n - 1):
+        rank = bpe_codes.get((symbols[i], symbols[i + 1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+
+    while heap:
+        # all occurrences of the pair with this rank, from left to right.
+        # merges create pairs with the merged symbol, never the same pair
+        rank = heap[0][0]
+        batch = []
+        while heap and heap[0][0] == rank:
+            batch.append(heapq.heappop(heap)[1])
+
+        for i in batch:
+            j = nxt[i]
+            # skip entries of merged symbols, and of pairs that changed since
+            if symbols[i] is None or j == -1 or bpe_codes.get((symbols[i], symbols[j])) != rank:
+                continue
+            symbols[i] += symbols[j]
+            symbols[j] = None
+            k = nxt[j]
+            nxt[i] = k
+            if k != -1:
+                prev[k] = i
+                new_rank = bpe_codes.get((symbols[i], symbols[k]))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, i))
+            h = prev[i]
+            if h != -1:
+                new_rank = bpe_codes.get((symbols[h], symbols[i]))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, h))
+
+    return tuple(symbol for symbol in symbols if symbol is not None)
+
 def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache, glossaries=None):
     """Encode word based on list of BPE merge operations, which are applied consecutively
     """
@@ -148,39 +242,10 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     else:
         raise NotImplementedError
 
-    pairs = get_pairs(word)
-
-    if not pairs:
+    if len(word) < 2:
         return orig
 
-    while True:
-        bigram = min(pairs, key = lambda pair: bpe_codes.get(pair, float('inf')))
-        if bigram not in bpe_codes:
-            break
-        first, second = bigram
-        new_word = []
-        i = 0
-        while i < len(word):
-            try:
-                j = word.index(first, i)
-                new_word.extend(word[i:j])
-                i = j
-            except:
-                new_word.extend(word[i:])
-                break
-
-            if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                new_word.append(first+second)
-                i += 2
-            else:
-                new_word.append(word[i])
-                i += 1
-        new_word = tuple(new_word)
-        word = new_word
-        if len(word) == 1:
-            break
-        else:
-            pairs = get_pairs(word)
+    word = merge_symbols(word, bpe_codes)
 
     # don't print end-of-word symbols
     if word[-1] == '</w>':
@@ -246,6 +311,51 @@ def check_vocab_and_split(orig, bpe_codes, vocab, separator):
     return out
 
 
+_worker_bpe = None
+
+def _init_worker(bpe):
+    global _worker_bpe
+    _worker_bpe = bpe
+
+def _segment_chunk(lines):
+    return [_worker_bpe.segment(line).strip() for line in lines]
+
+def _read_chunks(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == CHUNK_LINES:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def segment_lines(bpe, lines, num_workers=1):
+    """Segment lines with bpe, and yield them in order (stripped)
+
+    With num_workers > 1, chunks of lines are segmented by a pool of
+    processes, each with its own copy of bpe and its cache.
+    """
+    if num_workers <= 1:
+        for line in lines:
+            yield bpe.segment(line).strip()
+        return
+
+    pool = Pool(num_workers, _init_worker, (bpe,))
+    try:
+        # keep at most two chunks per worker in flight, and write them in order
+        pending = deque()
+        for chunk in _read_chunks(lines):
+            pending.append(pool.apply_async(_segment_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                for line in pending.popleft().get():
+                    yield line
+        while pending:
+            for line in pending.popleft().get():
+                yield line
+    finally:
+        pool.terminate()
+
 def read_vocabulary(vocab_file, threshold):
     """read vocabulary file produced by get_vocab.py, and filter according to frequency threshold.
     """
@@ -260,6 +370,19 @@ def read_vocabulary(vocab_file, threshold):
 
     return vocabulary
 
+def read_words_by_frequency(vocab_file):
+    """read vocabulary file produced by get_vocab.py, and return its words, most frequent first.
+    """
+
+    words = []
+
+    for line in vocab_file:
+        word, freq = line.split()
+        words.append((int(freq), word))
+
+    words.sort(key=lambda x: x[0], reverse=True)
+    return [word for freq, word in words]
+
 def isolate_glossary(word, glossary):
     """
     Isolate a glossary present inside a word.
@@ -299,14 +422,19 @@ if __name__ == '__main__':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
     if args.vocabulary:
         args.vocabulary = codecs.open(args.vocabulary.name, encoding='utf-8')
+    if args.cache_vocabulary:
+        args.cache_vocabulary = codecs.open(args.cache_vocabulary.name, encoding='utf-8')
 
     if args.vocabulary:
         vocabulary = read_vocabulary(args.vocabulary, args.vocabulary_threshold)
     else:
         vocabulary = None
 
-    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries)
+    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries, args.cache_size)
+
+    if args.cache_vocabulary:
+        bpe.prewarm(read_words_by_frequency(args.cache_vocabulary))
 
-    for line in args.input:
-        args.output.write(bpe.segment(line).strip())
+    for line in segment_lines(bpe, args.input, args.num_workers):
+        args.output.write(line)
         args.output.write('\n')
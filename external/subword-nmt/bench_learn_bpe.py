@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the merge loop of learn_bpe.py.
+
+Learns BPE codes for several numbers of symbols on a corpus and reports
+merges per second, for the heap-based selection of learn_bpe.main and for
+the former selection, a full max() scan over pruned pair statistics.
+The codes of both are compared, too, and the peak memory allocated by
+each run is reported.
+
+    python bench_learn_bpe.py -i corpus.txt -s 10000 20000 50000
+"""
+
+from __future__ import unicode_literals, division
+
+import argparse
+import codecs
+import copy
+import io
+import sys
+import time
+import tracemalloc
+
+import learn_bpe
+
+
+def prune_stats(stats, big_stats, threshold):
+    for item,freq in list(stats.items()):
+        if freq < threshold:
+            del stats[item]
+            if freq < 0:
+                big_stats[item] += freq
+            else:
+                big_stats[item] = freq
+
+
+def main_max_scan(infile, outfile, num_symbols, min_frequency=2, is_dict=False):
+    """learn_bpe.main as it selected merges before the PairQueue"""
+    outfile.write('#version: 0.2\n')
+
+    vocab = learn_bpe.get_vocabulary(infile, is_dict)
+    vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
+    sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+    symbols = learn_bpe.SymbolTable()
+    sorted_vocab = [(tuple(symbols.id(c) for c in word), freq) for word, freq in sorted_vocab]
+
+    stats, indices = learn_bpe.get_pair_statistics(sorted_vocab)
+    big_stats = copy.deepcopy(stats)
+    threshold = max(stats.values()) / 10
+    for i in range(num_symbols):
+        if stats:
+            most_frequent = max(stats, key=lambda x: (stats[x], symbols.pair(x)))
+
+        if not stats or (i and stats[most_frequent] < threshold):
+            prune_stats(stats, big_stats, threshold)
+            stats = copy.deepcopy(big_stats)
+            most_frequent = max(stats, key=lambda x: (stats[x], symbols.pair(x)))
+            threshold = stats[most_frequent] * i/(i+10000.0)
+            prune_stats(stats, big_stats, threshold)
+
+        if stats[most_frequent] < min_frequency:
+            break
+
+        outfile.write('{0} {1}\n'.format(*symbols.pair(most_frequent)))
+        new_symbol = symbols.merge(most_frequent)
+        changes = learn_bpe.replace_pair(most_frequent, new_symbol, sorted_vocab, indices)
+        learn_bpe.update_pair_statistics(most_frequent, new_symbol, changes, stats, indices)
+        stats[most_frequent] = 0
+        if not i % 100:
+            prune_stats(stats, big_stats, threshold)
+
+
+def run(learn, lines, num_symbols, trace_memory=False):
+    out = io.StringIO()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    learn(lines, out, num_symbols)
+    elapsed = time.time() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    codes = out.getvalue()
+    return codes, codes.count('\n') - 1, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark learn_bpe.py")
+    parser.add_argument('--input', '-i', required=True, metavar='PATH',
+                        help="Input text.")
+    parser.add_argument('--symbols', '-s', type=int, nargs='+', default=[10000, 20000, 50000],
+                        help="Numbers of symbols to learn (default: %(default)s)")
+    parser.add_argument('--skip-max-scan', action='store_true',
+                        help="Only time the heap-based selection.")
+    parser.add_argument('--memory', action='store_true',
+                        help="Report the peak memory of each run (slows down the runs, "
+                        "so in a separate run from the timing).")
+    args = parser.parse_args()
+
+    with codecs.open(args.input, encoding='utf-8') as f:
+        lines = f.readlines()
+
+    def heap(infile, outfile, num_symbols):
+        learn_bpe.main(infile, outfile, num_symbols)
+
+    sys.stdout.write('symbols\tmethod\tmerges\tseconds\tmerges/s\tpeak MB\n')
+    for num_symbols in args.symbols:
+        methods = [('heap', heap)]
+        if not args.skip_max_scan:
+            methods.append(('max-scan', main_max_scan))
+        results = {}
+        for name, learn in methods:
+            codes, merges, elapsed, peak = run(learn, lines, num_symbols, args.memory)
+            results[name] = codes
+            sys.stdout.write('{0}\t{1}\t{2}\t{3:.1f}\t{4:.0f}\t{5}\n'.format(
+                num_symbols, name, merges, elapsed, merges / elapsed,
+                '{0:.1f}'.format(peak / 2**20) if args.memory else '-'))
+        if len(results) > 1 and results['heap'] != results['max-scan']:
+            sys.stdout.write('{0}\tcodes differ!\n'.format(num_symbols))
@@ -13,12 +13,14 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 
 from __future__ import unicode_literals
 
+import os
 import sys
 import codecs
-import re
-import copy
 import argparse
-from collections import defaultdict, Counter
+import heapq
+from array import array
+from collections import defaultdict, deque, Counter
+from multiprocessing import Pool
 
 # hack for python2/3 compatibility
 from io import open
@@ -46,35 +48,228 @@ def create_parser():
         help='Stop if no symbol pair has frequency >= FREQ (default: %(default)s))')
     parser.add_argument('--dict-input', action="store_true",
         help="If set, input file is interpreted as a dictionary where each line contains a word-count pair")
+    parser.add_argument(
+        '--num-workers', '-j', type=int, default=1,
+        help="Number of processes counting the vocabulary (default: %(default)s))")
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
 
     return parser
 
-def get_vocabulary(fobj, is_dict=False):
-    """Read text and return dictionary that encodes vocabulary
-    """
-    vocab = Counter()
-    for line in fobj:
+# bytes (or characters, for streams) of input counted by a worker at once
+CHUNK_SIZE = 1 << 22
+
+def count_lines(lines, is_dict=False, vocab=None):
+    """Add the words of lines to vocab (a Counter), and return it"""
+    if vocab is None:
+        vocab = Counter()
+    for line in lines:
         if is_dict:
             word, count = line.strip().split()
             vocab[word] += int(count)
         else:
-            for word in line.split():
-                vocab[word] += 1
+            vocab.update(line.split())
+    return vocab
+
+def _count_range(job):
+    """Count the lines of a UTF-8 file that start in the byte range [start, end)"""
+    path, start, end, is_dict = job
+    with open(path, 'rb') as f:
+        if start:
+            # skip the line that starts before the range
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        if pos >= end:
+            return Counter()
+        data = f.read(end - pos)
+        if not data.endswith(b'\n'):
+            data += f.readline()
+    text = data.decode('utf-8')
+    if is_dict:
+        return count_lines(text.splitlines(), True)
+    return Counter(text.split())
+
+def _count_batch(job):
+    lines, is_dict = job
+    return count_lines(lines, is_dict)
+
+def _input_path(fobj):
+    """Return the path of fobj if it is a file read from its start, else None"""
+    path = getattr(fobj, 'name', None)
+    if not isinstance(path, str) or path == '<stdin>' or not os.path.isfile(path):
+        return None
+    try:
+        if fobj.tell() != 0:
+            return None
+    except (AttributeError, IOError, ValueError):
+        return None
+    return path
+
+def _read_batches(fobj, is_dict):
+    batch = []
+    size = 0
+    for line in fobj:
+        batch.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield batch, is_dict
+            batch = []
+            size = 0
+    if batch:
+        yield batch, is_dict
+
+def get_vocabulary(fobj, is_dict=False, num_workers=1):
+    """Read text and return dictionary that encodes vocabulary
+
+    With num_workers > 1, the text is counted by a pool of processes: a file
+    in byte ranges that the workers read themselves, other inputs (e.g. stdin)
+    in batches of lines read here. The counts are merged in input order, so
+    the vocabulary is the same as with a single process, order included.
+    """
+    if num_workers <= 1:
+        return count_lines(fobj, is_dict)
+
+    path = _input_path(fobj)
+    if path is not None:
+        size = os.path.getsize(path)
+        jobs = [(path, start, min(start + CHUNK_SIZE, size), is_dict)
+                for start in range(0, size, CHUNK_SIZE)]
+        count = _count_range
+    else:
+        jobs = _read_batches(fobj, is_dict)
+        count = _count_batch
+
+    vocab = Counter()
+    pool = Pool(num_workers)
+    try:
+        # submit jobs while the earlier ones are counted, but keep at most
+        # two per worker in flight, to bound the memory used by a stream
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(count, (job,)))
+            if len(pending) >= 2 * num_workers:
+                vocab.update(pending.popleft().get())
+        while pending:
+            vocab.update(pending.popleft().get())
+    finally:
+        pool.terminate()
     return vocab
 
-def update_pair_statistics(pair, changed, stats, indices):
+class ReversedPair(object):
+    """Wraps a pair so that heapq's min-heap pops the largest pair first"""
+    __slots__ = ['pair']
+
+    def __init__(self, pair):
+        self.pair = pair
+
+    def __lt__(self, other):
+        return self.pair > other.pair
+
+    def __eq__(self, other):
+        return self.pair == other.pair
+
+
+class PairQueue(object):
+    """Max-priority queue of symbol pairs, keyed on (frequency, pair)
+
+    Entries are pushed whenever the frequency of a pair increases, and are
+    never removed when it decreases (lazy deletion). An entry whose frequency
+    no longer matches the statistics is corrected when it reaches the top:
+    it is dropped if the pair has another, higher entry, or pushed again with
+    the current frequency otherwise. The pair returned by pop() is thus the
+    same as max(stats, key=lambda x: (stats[x], key(x))).
+
+    key maps pairs to what ties are broken on, e.g. symbol ids to strings.
+    """
+
+    def __init__(self, stats, key=None):
+        self.stats = stats
+        self.key = key if key is not None else lambda pair: pair
+        self.heap = [self._entry(freq, pair) for pair, freq in stats.items() if freq > 0]
+        heapq.heapify(self.heap)
+
+    def _entry(self, freq, pair):
+        # pairs never compare equal on the key, so the last item is never compared
+        return (-freq, ReversedPair(self.key(pair)), pair)
+
+    def push(self, pair):
+        freq = self.stats[pair]
+        if freq > 0:
+            heapq.heappush(self.heap, self._entry(freq, pair))
+
+    def pop(self):
+        """Remove and return the most frequent pair, or None if no pair is left"""
+        heap = self.heap
+        stats = self.stats
+        while heap:
+            freq, _, pair = heap[0]
+            current = stats.get(pair, 0)
+            if -freq == current:
+                heapq.heappop(heap)
+                return pair
+            if -freq > current > 0:
+                heapq.heapreplace(heap, self._entry(current, pair))
+            else:
+                heapq.heappop(heap)
+        return None
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class SymbolTable(object):
+    """Integer ids of symbols (strings)
+
+    Equal strings share an id, even if they result from different merges.
+    """
+
+    def __init__(self):
+        self.symbols = []
+        self.ids = {}
+
+    def id(self, symbol):
+        i = self.ids.get(symbol)
+        if i is None:
+            i = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return i
+
+    def merge(self, pair):
+        """Return the id of the symbol that merges the pair of ids"""
+        return self.id(self.symbols[pair[0]] + self.symbols[pair[1]])
+
+    def pair(self, pair):
+        return self.symbols[pair[0]], self.symbols[pair[1]]
+
+
+def index_word(indices, pair, j):
+    """Record in indices that pair occurs in word j
+
+    indices[pair] is an array of word ids. An id is only appended if it is not
+    the last one already, and ids are never removed: the words are checked for
+    the pair when it is merged.
+    """
+    words = indices[pair]
+    if not words or words[-1] != j:
+        words.append(j)
+
+
+def update_pair_statistics(pair, new_symbol, changed, stats, indices, queue=None):
     """Minimally update the indices and frequency of symbol pairs
 
     if we merge a pair of symbols, only pairs that overlap with occurrences
     of this pair are affected, and need to be updated.
+
+    words are tuples of symbol ids, new_symbol is the id of the merged pair.
+    pairs whose frequency increases are pushed to queue (a PairQueue), if given.
     """
     stats[pair] = 0
-    indices[pair] = defaultdict(int)
+    indices[pair] = array('i')
     first, second = pair
-    new_pair = first+second
+    new_pair = new_symbol
+    increased = set()
     for j, word, old_word, freq in changed:
 
         # find all instances of pair, and update frequency/indices around it
@@ -91,14 +286,12 @@ def update_pair_statistics(pair, changed, stats, indices):
                 if i:
                     prev = old_word[i-1:i+1]
                     stats[prev] -= freq
-                    indices[prev][j] -= 1
                 if i < len(old_word)-2:
                     # assuming a symbol sequence "A B C B", if "B C" is merged, reduce the frequency of "C B".
                     # however, skip this if the sequence is A B C B C, because the frequency of "C B" will be reduced by the previous code block
                     if old_word[i+2] != first or i >= len(old_word)-3 or old_word[i+3] != second:
                         nex = old_word[i+1:i+3]
                         stats[nex] -= freq
-                        indices[nex][j] -= 1
                 i += 2
             else:
                 i += 1
@@ -114,15 +307,21 @@ def update_pair_statistics(pair, changed, stats, indices):
             if i:
                 prev = word[i-1:i+1]
                 stats[prev] += freq
-                indices[prev][j] += 1
+                index_word(indices, prev, j)
+                increased.add(prev)
             # assuming a symbol sequence "A BC B", if "B C" is merged, increase the frequency of "BC B"
             # however, if the sequence is A BC BC, skip this step because the count of "BC BC" will be incremented by the previous code block
             if i < len(word)-1 and word[i+1] != new_pair:
                 nex = word[i:i+2]
                 stats[nex] += freq
-                indices[nex][j] += 1
+                index_word(indices, nex, j)
+                increased.add(nex)
             i += 1
 
+    if queue is not None:
+        for item in increased:
+            queue.push(item)
+
 
 def get_pair_statistics(vocab):
     """Count frequency of all symbol pairs, and create index"""
@@ -131,59 +330,46 @@ def get_pair_statistics(vocab):
     stats = defaultdict(int)
 
     #index from pairs to words
-    indices = defaultdict(lambda: defaultdict(int))
+    indices = defaultdict(lambda: array('i'))
 
     for i, (word, freq) in enumerate(vocab):
         prev_char = word[0]
         for char in word[1:]:
             stats[prev_char, char] += freq
-            indices[prev_char, char][i] += 1
+            index_word(indices, (prev_char, char), i)
             prev_char = char
 
     return stats, indices
 
 
-def replace_pair(pair, vocab, indices):
-    """Replace all occurrences of a symbol pair ('A', 'B') with a new symbol 'AB'"""
+def replace_pair(pair, new_symbol, vocab, indices):
+    """Replace all occurrences of a symbol pair (A, B) with a new symbol AB"""
     first, second = pair
-    pair_str = ''.join(pair)
-    pair_str = pair_str.replace('\\','\\\\')
     changes = []
-    pattern = re.compile(r'(?<!\S)' + re.escape(first + ' ' + second) + r'(?!\S)')
-    if sys.version_info < (3, 0):
-        iterator = indices[pair].iteritems()
-    else:
-        iterator = indices[pair].items()
-    for j, freq in iterator:
-        if freq < 1:
-            continue
+    for j in set(indices[pair]):
         word, freq = vocab[j]
-        new_word = ' '.join(word)
-        new_word = pattern.sub(pair_str, new_word)
-        new_word = tuple(new_word.split())
+        # scan for non-overlapping occurrences, from left to right
+        new_word = []
+        i = 0
+        n = len(word)
+        while i < n:
+            if word[i] == first and i < n-1 and word[i+1] == second:
+                new_word.append(new_symbol)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        if len(new_word) == n:
+            # the pair is no longer in this word
+            continue
+        new_word = tuple(new_word)
 
         vocab[j] = (new_word, freq)
         changes.append((j, new_word, word, freq))
 
     return changes
 
-def prune_stats(stats, big_stats, threshold):
-    """Prune statistics dict for efficiency of max()
-
-    The frequency of a symbol pair never increases, so pruning is generally safe
-    (until we the most frequent pair is less frequent than a pair we previously pruned)
-    big_stats keeps full statistics for when we need to access pruned items
-    """
-    for item,freq in list(stats.items()):
-        if freq < threshold:
-            del stats[item]
-            if freq < 0:
-                big_stats[item] += freq
-            else:
-                big_stats[item] = freq
-
-
-def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False):
+def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False, num_workers=1):
     """Learn num_symbols BPE operations from vocabulary, and write to outfile.
     """
 
@@ -191,39 +377,31 @@ def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=F
     # version numbering allows bckward compatibility
     outfile.write('#version: 0.2\n')
 
-    vocab = get_vocabulary(infile, is_dict)
+    vocab = get_vocabulary(infile, is_dict, num_workers)
     vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
     sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
 
+    # words are tuples of symbol ids
+    symbols = SymbolTable()
+    sorted_vocab = [(tuple(symbols.id(c) for c in word), freq) for word, freq in sorted_vocab]
+
     stats, indices = get_pair_statistics(sorted_vocab)
-    big_stats = copy.deepcopy(stats)
-    # threshold is inspired by Zipfian assumption, but should only affect speed
-    threshold = max(stats.values()) / 10
+    queue = PairQueue(stats, key=symbols.pair)
     for i in range(num_symbols):
-        if stats:
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-
-        # we probably missed the best pair because of pruning; go back to full statistics
-        if not stats or (i and stats[most_frequent] < threshold):
-            prune_stats(stats, big_stats, threshold)
-            stats = copy.deepcopy(big_stats)
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-            # threshold is inspired by Zipfian assumption, but should only affect speed
-            threshold = stats[most_frequent] * i/(i+10000.0)
-            prune_stats(stats, big_stats, threshold)
-
-        if stats[most_frequent] < min_frequency:
+        most_frequent = queue.pop()
+
+        if most_frequent is None or stats[most_frequent] < min_frequency:
             sys.stderr.write('no pair has frequency >= {0}. Stopping\n'.format(min_frequency))
             break
 
+        pair = symbols.pair(most_frequent)
         if verbose:
-            sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, most_frequent[0], most_frequent[1], stats[most_frequent]))
-        outfile.write('{0} {1}\n'.format(*most_frequent))
-        changes = replace_pair(most_frequent, sorted_vocab, indices)
-        update_pair_statistics(most_frequent, changes, stats, indices)
+            sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, pair[0], pair[1], stats[most_frequent]))
+        outfile.write('{0} {1}\n'.format(*pair))
+        new_symbol = symbols.merge(most_frequent)
+        changes = replace_pair(most_frequent, new_symbol, sorted_vocab, indices)
+        update_pair_statistics(most_frequent, new_symbol, changes, stats, indices, queue)
         stats[most_frequent] = 0
-        if not i % 100:
-            prune_stats(stats, big_stats, threshold)
 
 
 if __name__ == '__main__':
@@ -247,4 +425,5 @@ if __name__ == '__main__':
     if args.output.name != '<stdout>':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
 
-    main(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input)
+    main(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input,
+         num_workers=args.num_workers)
@@ -15,10 +15,8 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 from __future__ import unicode_literals
 
 import sys
-import os
 import codecs
 import argparse
-import tempfile
 from collections import Counter
 
 import learn_bpe
@@ -54,6 +52,9 @@ def create_parser():
     parser.add_argument(
         '--min-frequency', type=int, default=2, metavar='FREQ',
         help='Stop if no symbol pair has frequency >= FREQ (default: %(default)s))')
+    parser.add_argument(
+        '--num-workers', '-j', type=int, default=1,
+        help="Number of processes counting the vocabulary (default: %(default)s))")
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
@@ -85,11 +86,11 @@ if __name__ == '__main__':
     args.input = [codecs.open(f.name, encoding='UTF-8') for f in args.input]
     args.vocab = [codecs.open(f.name, 'w', encoding='UTF-8') for f in args.vocab]
 
-    # get combined vocabulary of all input texts
+    # get vocabulary of each input text, and their combined vocabulary
+    vocabs = [learn_bpe.get_vocabulary(f, num_workers=args.num_workers) for f in args.input]
     full_vocab = Counter()
-    for f in args.input:
-        full_vocab += learn_bpe.get_vocabulary(f)
-        f.seek(0)
+    for vocab in vocabs:
+        full_vocab.update(vocab)
 
     vocab_list = ['{0} {1}'.format(key, freq) for (key, freq) in full_vocab.items()]
 
@@ -101,25 +102,15 @@ if __name__ == '__main__':
         bpe = apply_bpe.BPE(codes, separator=args.separator)
 
     # apply BPE to each training corpus and get vocabulary
-    for train_file, vocab_file in zip(args.input, args.vocab):
-
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.close()
-
-        tmpout = codecs.open(tmp.name, 'w', encoding='UTF-8')
-
-        train_file.seek(0)
-        for line in train_file:
-            tmpout.write(bpe.segment(line).strip())
-            tmpout.write('\n')
-
-        tmpout.close()
-        tmpin = codecs.open(tmp.name, encoding='UTF-8')
+    # words are segmented independently of their context, so the vocabulary
+    # of a segmented corpus follows from the vocabulary of the corpus
+    for vocab, vocab_file in zip(vocabs, args.vocab):
 
-        vocab = learn_bpe.get_vocabulary(tmpin)
-        tmpin.close()
-        os.remove(tmp.name)
+        bpe_vocab = Counter()
+        for word, freq in vocab.items():
+            for item in bpe.segment(word).split():
+                bpe_vocab[item] += freq
 
-        for key, freq in sorted(vocab.items(), key=lambda x: x[1], reverse=True):
+        for key, freq in sorted(bpe_vocab.items(), key=lambda x: x[1], reverse=True):
             vocab_file.write("{0} {1}\n".format(key, freq))
         vocab_file.close()
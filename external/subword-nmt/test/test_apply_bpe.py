@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import io
+import random
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import apply_bpe
+import learn_bpe
+from apply_bpe import BPE, encode, segment_lines
+
+def reference_encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache, glossaries=None):
+    """encode() before merge_symbols, which recomputed all pairs after every merge"""
+
+    if orig in cache:
+        return cache[orig]
+
+    if orig in glossaries:
+        cache[orig] = (orig,)
+        return (orig,)
+
+    if version == (0, 1):
+        word = tuple(orig) + ('</w>',)
+    elif version == (0, 2): # more consistent handling of word-final segments
+        word = tuple(orig[:-1]) + ( orig[-1] + '</w>',)
+    else:
+        raise NotImplementedError
+
+    pairs = apply_bpe.get_pairs(word)
+
+    if not pairs:
+        return orig
+
+    while True:
+        bigram = min(pairs, key = lambda pair: bpe_codes.get(pair, float('inf')))
+        if bigram not in bpe_codes:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word)-1 and word[i+1] == second:
+                new_word.append(first+second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = apply_bpe.get_pairs(word)
+
+    # don't print end-of-word symbols
+    if word[-1] == '</w>':
+        word = word[:-1]
+    elif word[-1].endswith('</w>'):
+        word = word[:-1] + (word[-1].replace('</w>',''),)
+
+    if vocab:
+        word = apply_bpe.check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
+
+    cache[orig] = word
+    return word
+
+class TestParallelSegmentation(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        words = [''.join(rng.choice('abcdef') for _ in range(rng.randint(1, 9)))
+                 for _ in range(400)]
+        self.lines = [' '.join(rng.choice(words) for _ in range(rng.randint(0, 12))) + '\n'
+                      for _ in range(500)]
+        codes = io.StringIO()
+        learn_bpe.main(self.lines, codes, 100)
+        self.codes = codes.getvalue()
+        self.chunk_lines = apply_bpe.CHUNK_LINES
+        # many chunks in flight
+        apply_bpe.CHUNK_LINES = 7
+
+    def tearDown(self):
+        apply_bpe.CHUNK_LINES = self.chunk_lines
+
+    def bpe(self, **kwargs):
+        return BPE(io.StringIO(self.codes), **kwargs)
+
+    def test_ordered_output(self):
+        expected = [self.bpe().segment(line).strip() for line in self.lines]
+        self.assertEqual(list(segment_lines(self.bpe(), self.lines, num_workers=3)), expected)
+
+    def test_bounded_cache(self):
+        expected = [self.bpe().segment(line).strip() for line in self.lines]
+        bpe = self.bpe(cache_size=10)
+        self.assertEqual(list(segment_lines(bpe, self.lines)), expected)
+        self.assertEqual(len(bpe.cache), 10)
+
+    def test_prewarm(self):
+        vocab = learn_bpe.get_vocabulary(self.lines)
+        vocab_file = io.StringIO(''.join('{0} {1}\n'.format(word, freq) for word, freq in vocab.items()))
+        words = apply_bpe.read_words_by_frequency(vocab_file)
+        self.assertEqual(words[0], vocab.most_common(1)[0][0])
+
+        bpe = self.bpe(cache_size=20)
+        bpe.prewarm(words)
+        # the cache holds the most frequent words (but not those of a single symbol)
+        self.assertEqual(list(bpe.cache), [word for word in words if len(word) > 1][:20])
+        self.assertEqual(list(segment_lines(bpe, self.lines, num_workers=2)),
+                         [self.bpe().segment(line).strip() for line in self.lines])
+
+class TestEncode(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(4)
+        self.words = set(''.join(self.rng.choice('aab') for _ in range(self.rng.randint(1, 12)))
+                         for _ in range(2000))
+
+    def random_codes(self, n):
+        """Codes of arbitrary pairs of symbols, merged ones included, in random order"""
+        symbols = ['a', 'b', 'a</w>', 'b</w>']
+        codes = []
+        for _ in range(n):
+            pair = (self.rng.choice(symbols), self.rng.choice(symbols))
+            if pair[0].endswith('</w>') or pair in codes:
+                continue
+            codes.append(pair)
+            symbols.append(pair[0] + pair[1])
+        self.rng.shuffle(codes)
+        return dict((code, i) for i, code in enumerate(codes))
+
+    def assertSameEncoding(self, bpe_codes, version, vocab=None):
+        bpe_codes_reverse = dict((pair[0] + pair[1], pair) for pair in bpe_codes)
+        for word in sorted(self.words):
+            args = (word, bpe_codes, bpe_codes_reverse, vocab, '@@', version)
+            self.assertEqual(tuple(encode(*args, cache={}, glossaries=[])),
+                             tuple(reference_encode(*args, cache={}, glossaries=[])), word)
+
+    def test_random_codes(self):
+        for _ in range(20):
+            bpe_codes = self.random_codes(40)
+            self.assertSameEncoding(bpe_codes, (0, 1))
+            self.assertSameEncoding(bpe_codes, (0, 2))
+
+    def test_lower_rank_after_merge(self):
+        # merging "a b" creates "ab a", of a lower rank, which must wait until
+        # all occurrences of "a b" are merged
+        self.words = set(['ababa', 'abababa', 'aababa'])
+        self.assertSameEncoding({('a', 'b'): 1, ('ab', 'a'): 0, ('a', 'b</w>'): 2}, (0, 2))
+
+    def test_vocabulary(self):
+        bpe_codes = self.random_codes(40)
+        vocab = set(self.rng.sample(sorted(set(pair[0] + pair[1] for pair in bpe_codes)), 10))
+        vocab.update(['a', 'b', 'a@@', 'b@@'])
+        self.assertSameEncoding(bpe_codes, (0, 2), vocab)
+
+if __name__ == '__main__':
+    unittest.main()
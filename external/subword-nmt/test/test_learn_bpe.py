@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import io
+import random
+import re
+import shutil
+import tempfile
+from collections import Counter
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import learn_bpe
+from learn_bpe import PairQueue
+
+def naive_learn_bpe(lines, num_symbols, min_frequency=2):
+    """Recount all pairs before every merge, and take the max() over them"""
+    vocab = Counter(word for line in lines for word in line.split())
+    vocab = dict((tuple(w[:-1]) + (w[-1] + '</w>',), freq) for w, freq in vocab.items())
+    codes = ['#version: 0.2']
+    for i in range(num_symbols):
+        stats = Counter()
+        for word, freq in vocab.items():
+            for pair in zip(word, word[1:]):
+                stats[pair] += freq
+        if not stats:
+            break
+        best = max(stats, key=lambda x: (stats[x], x))
+        if stats[best] < min_frequency:
+            break
+        codes.append('{0} {1}'.format(*best))
+        pattern = re.compile(r'(?<!\S)' + re.escape(' '.join(best)) + r'(?!\S)')
+        vocab = dict((tuple(pattern.sub(''.join(best), ' '.join(word)).split()), freq)
+                     for word, freq in vocab.items())
+    return '\n'.join(codes) + '\n'
+
+def learn(lines, num_symbols):
+    out = io.StringIO()
+    learn_bpe.main(lines, out, num_symbols)
+    return out.getvalue()
+
+class TestPairQueue(unittest.TestCase):
+
+    def test_order(self):
+        stats = {('a', 'b'): 3, ('a', 'c'): 3, ('b', 'c'): 5, ('c', 'd'): 0}
+        queue = PairQueue(stats)
+        self.assertEqual(queue.pop(), ('b', 'c'))
+        # ties are broken by the larger pair, like max() on (freq, pair)
+        self.assertEqual(queue.pop(), ('a', 'c'))
+        self.assertEqual(queue.pop(), ('a', 'b'))
+        self.assertEqual(queue.pop(), None)
+
+    def test_updates(self):
+        stats = {('a', 'b'): 3, ('a', 'c'): 4, ('b', 'c'): 5}
+        queue = PairQueue(stats)
+        stats[('b', 'c')] = 1
+        stats[('a', 'b')] = 6
+        queue.push(('a', 'b'))
+        stats[('c', 'd')] = 2
+        queue.push(('c', 'd'))
+        self.assertEqual(queue.pop(), ('a', 'b'))
+        self.assertEqual(queue.pop(), ('a', 'c'))
+        self.assertEqual(queue.pop(), ('c', 'd'))
+        self.assertEqual(queue.pop(), ('b', 'c'))
+        self.assertEqual(queue.pop(), None)
+
+class TestLearnBPE(unittest.TestCase):
+
+    def test_repeated_symbols(self):
+        lines = ['aaaa aaa aa a', 'abab ababab baba', 'aaaa abab', 'aaaa']
+        self.assertEqual(learn(lines, 20), naive_learn_bpe(lines, 20))
+
+    def test_random_corpus(self):
+        rng = random.Random(1)
+        words = [''.join(rng.choice('abcde') for _ in range(rng.randint(1, 8)))
+                 for _ in range(300)]
+        lines = [' '.join(rng.choice(words) for _ in range(10)) for _ in range(300)]
+        self.assertEqual(learn(lines, 200), naive_learn_bpe(lines, 200))
+
+    def test_min_frequency(self):
+        lines = ['low lower newest widest']
+        codes = learn(lines, 100)
+        self.assertEqual(codes, naive_learn_bpe(lines, 100))
+        # learning stops before 100 merges, when no pair occurs twice
+        self.assertLess(len(codes.splitlines()), 101)
+class TestGetVocabulary(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = learn_bpe.CHUNK_SIZE
+        # many small chunks, with lines across their boundaries
+        learn_bpe.CHUNK_SIZE = 17
+        self.tmpdir = tempfile.mkdtemp()
+        rng = random.Random(2)
+        words = ['\u00e9t\u00e9', 'a', 'bb', 'ccc', 'dddd', 'eeeee']
+        self.text = ''.join(' '.join(rng.choice(words) for _ in range(rng.randint(0, 6))) + '\n'
+                            for _ in range(200))
+
+    def tearDown(self):
+        learn_bpe.CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text):
+        path = os.path.join(self.tmpdir, 'input.txt')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def assertSameVocabulary(self, vocab, expected):
+        # same counts, in the same order
+        self.assertEqual(list(vocab.items()), list(expected.items()))
+
+    def test_file(self):
+        expected = learn_bpe.get_vocabulary(io.StringIO(self.text))
+        with io.open(self.write(self.text), encoding='utf-8') as f:
+            self.assertSameVocabulary(learn_bpe.get_vocabulary(f, num_workers=3), expected)
+
+    def test_stream(self):
+        expected = learn_bpe.get_vocabulary(io.StringIO(self.text))
+        self.assertSameVocabulary(learn_bpe.get_vocabulary(io.StringIO(self.text), num_workers=3), expected)
+
+    def test_dict(self):
+        vocab = learn_bpe.get_vocabulary(io.StringIO(self.text))
+        text = ''.join('{0} {1}\n'.format(word, count) for word, count in vocab.items())
+        with io.open(self.write(text), encoding='utf-8') as f:
+            self.assertSameVocabulary(learn_bpe.get_vocabulary(f, is_dict=True, num_workers=3), vocab)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
 import argparse
+import hashlib
+import importlib
+import json
 import os, sys
 import os.path as osp
 from fvcore.common.config import CfgNode
+import queue
 import subprocess
+import threading
+import time
+import traceback
 
 # Use cases:
 # python main.py -d multi30k -i $multi30k_path -a preprocess_text -o $output_path
@@ -11,9 +18,228 @@ import subprocess
 def joinpath(a,*p):
     return os.path.realpath(os.path.join(a, *p))
 
-def run(C, cmd):
+# Files up to this size are fingerprinted by content, larger ones by size and
+# modification time
+HASH_LIMIT = 16 << 20
+
+def fingerprint(path):
+    if not osp.exists(path):
+        return None
+    if osp.isdir(path):
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                st = os.stat(osp.join(root, fname))
+                h.update("{} {} {}\n".format(
+                    osp.relpath(osp.join(root, fname), path),
+                    st.st_size, st.st_mtime_ns).encode("utf-8"))
+        return h.hexdigest()
+    st = os.stat(path)
+    if st.st_size > HASH_LIMIT:
+        return "{}:{}".format(st.st_size, st.st_mtime_ns)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def stamp_file(outputs):
+    return outputs[0].rstrip("/") + ".stamp"
+
+def stage_state(cmd, inputs):
+    return {"cmd": cmd, "inputs": {path: fingerprint(path) for path in inputs}}
+
+def up_to_date(C, outputs, state):
+    """A stage is up to date if all its outputs exist and its stamp records
+    the same command and input fingerprints as now."""
+    if C.FORCE or not all(osp.exists(path) for path in outputs):
+        return False
+    try:
+        with open(stamp_file(outputs)) as f:
+            return json.load(f) == state
+    except (OSError, ValueError):
+        return False
+
+def run(C, cmd, inputs=None, outputs=None):
+    """Runs ``cmd``. When ``outputs`` are given, the command is skipped if
+    its outputs are up to date with respect to ``inputs`` and the command
+    line, and a stamp is written next to the first output on success.
+    Returns False if the command failed."""
+    state = None
+    if outputs:
+        state = stage_state(cmd, inputs or [])
+        if up_to_date(C, outputs, state):
+            print("Up to date: {}".format(" ".join(cmd)))
+            return True
+
     print(" ".join(cmd))
-    if not C.DRY_RUN: subprocess.run(cmd)
+    if C.DRY_RUN:
+        return True
+
+    if state is not None and osp.exists(stamp_file(outputs)):
+        os.remove(stamp_file(outputs))
+    if RUNNER is not None and RUNNER.accepts(cmd):
+        ok = RUNNER(cmd)
+    else:
+        ok = subprocess.run(cmd).returncode == 0
+    if not ok:
+        return False
+    if state is not None:
+        with open(stamp_file(outputs), "w") as f:
+            json.dump(state, f)
+    return True
+
+class InProcessRunner(object):
+    """Runs the extractor scripts by calling their ``run`` function instead of
+    starting a new Python process. Every model is built once and reused by
+    all the commands that need it, as identified by the script's
+    ``model_key``."""
+    MODULES = ["extract_image_feats_resnet50", "feats_vinvl", "feats_butd"]
+
+    def __init__(self, prpath):
+        sys.path.insert(0, osp.join(prpath, "src"))
+        self.models = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.startup = 0.0
+        self.steady = 0.0
+        self.runs = 0
+
+    def accepts(self, cmd):
+        return len(cmd) > 1 and cmd[0] == "python" and \
+            osp.splitext(osp.basename(cmd[1]))[0] in self.MODULES
+
+    def __call__(self, cmd):
+        name = osp.splitext(osp.basename(cmd[1]))[0]
+        try:
+            t0 = time.perf_counter()
+            module = importlib.import_module(name)
+            args = module.parse_args(cmd[2:])
+            key = (name,) + module.model_key(args)
+            startup = time.perf_counter() - t0
+            with self.lock:
+                lock = self.locks.setdefault(key, threading.Lock())
+            # A model is only used by one command at a time. Waiting for it
+            # is not counted as startup or steady state.
+            with lock:
+                if key not in self.models:
+                    print("Building model for {} (in-process).".format(name))
+                    t0 = time.perf_counter()
+                    self.models[key] = module.load_model(args)
+                    startup += time.perf_counter() - t0
+                t1 = time.perf_counter()
+                module.run(args, self.models[key])
+                steady = time.perf_counter() - t1
+            # Stages run on several scheduler threads
+            with self.lock:
+                self.startup += startup
+                self.steady += steady
+                self.runs += 1
+            return True
+        except SystemExit as e:
+            return e.code in (None, 0)
+        except Exception:
+            traceback.print_exc()
+            return False
+
+    def report(self):
+        print("In-process execution: {} models, {:.1f}s startup (imports "
+              "and model building), {:.1f}s steady state over {} runs.".format(
+                  len(self.models), self.startup, self.steady, self.runs))
+
+# Set by --in-process
+RUNNER = None
+
+class Stage(object):
+    """A command of the preprocessing pipeline.
+
+    Arguments:
+        name (str): Name used in progress and timing reports.
+        cmd (list): Command line, see :func:`run`.
+        inputs, outputs (list, optional): Files tracked by :func:`run`.
+        deps (list, optional): Stages that must succeed before this one.
+        cpus, gpus (int, optional): Slots taken from the CPU and GPU budgets
+            while the stage runs.
+    """
+    def __init__(self, name, cmd, inputs=None, outputs=None, deps=(), cpus=1, gpus=0):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.gpus = gpus
+
+def run_stages(C, stages):
+    """Runs ``stages`` as a DAG: every stage starts as soon as its
+    dependencies succeeded and enough of the ``C.MAX_CPUS`` and
+    ``C.MAX_GPUS`` slots are free, in list order otherwise. Stages depending
+    on a failed stage are skipped. Returns True if all stages succeeded."""
+    max_cpus, max_gpus = C.MAX_CPUS, C.MAX_GPUS
+    free = {"cpus": max_cpus, "gpus": max_gpus}
+    pending = list(stages)
+    status, timings = {}, {}
+    running = 0
+    finished = queue.Queue()
+    start = time.perf_counter()
+
+    def work(stage, cpus, gpus):
+        t0 = time.perf_counter()
+        try:
+            ok = run(C, stage.cmd, stage.inputs, stage.outputs)
+        except Exception as e:
+            print("{}: {}".format(stage.name, e))
+            ok = False
+        finished.put((stage, cpus, gpus, ok, time.perf_counter() - t0))
+
+    while pending or running:
+        # Dependencies always precede their dependents in ``stages``, so a
+        # single pass propagates failures
+        for stage in list(pending):
+            deps = [status.get(dep) for dep in stage.deps]
+            if any(dep in ("failed", "skipped") for dep in deps):
+                pending.remove(stage)
+                status[stage] = "skipped"
+                print("[{:7.1f}s] {}: skipped, a dependency failed".format(
+                    time.perf_counter() - start, stage.name))
+                continue
+            if not all(dep == "ok" for dep in deps):
+                continue
+            # A stage never waits for more slots than the budget has
+            cpus = min(stage.cpus, max_cpus)
+            gpus = min(stage.gpus, max_gpus)
+            if cpus > free["cpus"] or gpus > free["gpus"]:
+                continue
+            pending.remove(stage)
+            free["cpus"] -= cpus
+            free["gpus"] -= gpus
+            running += 1
+            print("[{:7.1f}s] {}: started".format(
+                time.perf_counter() - start, stage.name))
+            threading.Thread(target=work, args=(stage, cpus, gpus),
+                             daemon=True).start()
+
+        if not running:
+            break
+        stage, cpus, gpus, ok, elapsed = finished.get()
+        running -= 1
+        free["cpus"] += cpus
+        free["gpus"] += gpus
+        status[stage] = "ok" if ok else "failed"
+        timings[stage] = elapsed
+        print("[{:7.1f}s] {}: {} in {:.1f}s".format(
+            time.perf_counter() - start, stage.name, status[stage], elapsed))
+        sys.stdout.flush()
+
+    wall = time.perf_counter() - start
+    print("Stage timings:")
+    for stage in stages:
+        print("  {:8.1f}s  {:7}  {}".format(
+            timings.get(stage, 0.0), status.get(stage, "skipped"), stage.name))
+    print("Total: {:.1f}s wall clock, {:.1f}s summed over stages.".format(
+        wall, sum(timings.values())))
+    return all(status.get(stage) == "ok" for stage in stages)
 
 def preprocess_text_multi30k(C, prpath, cfgpath):
     cdir = os.getcwd()
@@ -43,6 +269,7 @@ def preprocess_mm_multi30k_resnet50(C, prpath, cfgpath):
     if C.SPLITS == "NONE":
         raise "Bad split"
 
+    stages = []
     for split in C.SPLITS.split("+"):
         datasetnames = C.DATASET.get(split)
         imagesdirs = C.MULTIMODAL.RAW_DATA.get(split)
@@ -59,22 +286,80 @@ def preprocess_mm_multi30k_resnet50(C, prpath, cfgpath):
             else:
                 sname = name
             
+            outdir = osp.dirname(joinpath(cfgpath, featsdir))
             cmd = [
                 "python",
-                "{}/src/extract_image_feats_resnet50_indep.py".format(prpath),
+                "{}/src/extract_image_feats_resnet50.py".format(prpath),
                 "-i", joinpath(cfgpath, imagesdir),
                 "-f", joinpath(cfgpath, C.MULTIMODAL.SPLITS, name + ".txt"),
                 "-m", joinpath(cfgpath, C.MULTIMODAL.MODEL_WEIGHTS),
-                "-o", osp.dirname(joinpath(cfgpath, featsdir)),
+                "-o", outdir,
                 "-s", sname.lower(),
                 "-b", str(C.MULTIMODAL.PREPROCESS_BATCH_SIZE)
             ]
-            run(C, cmd)
+            cache_dir = C.MULTIMODAL.get("FEATURE_CACHE_DIR", None)
+            if cache_dir:
+                # Shared by all splits, e.g. test sets reusing Flickr30k images
+                cmd += ["--cache-dir", joinpath(cfgpath, cache_dir)]
+                cache_size = C.MULTIMODAL.get("FEATURE_CACHE_SIZE", None)
+                if cache_size:
+                    cmd += ["--cache-size", str(cache_size)]
+            # The extractor decodes images with 4 loader workers by default
+            stages.append(Stage(
+                "resnet50 {}".format(name), cmd,
+                inputs=[cmd[3], cmd[5], cmd[7]],
+                outputs=[joinpath(outdir, layer, sname.lower() + ".txt")
+                         for layer in ["res4frelu", "res5erelu", "avgpool"]],
+                cpus=4, gpus=1))
+
+    return run_stages(C, stages)
     
+def sweep_stages(C, prpath, cfgpath, name, mmtype, suffix, detect):
+    """Stages of a threshold sweep (``--sweep``): one conversion writing the
+    object-word corpus of every threshold from a single read of the
+    detections, then one tokenization and BPE pass over all corpora, which
+    also reports their statistics."""
+    featsdir = C.MULTIMODAL.DATA
+    thresholds = list(C.SWEEP)
+    bpe_workers = C.DATASET.get("BPE_WORKERS", 1)
+    text = joinpath(cfgpath, featsdir, "text", name + ".{}.{{threshold}}.en".format(mmtype))
+    cmd = [
+        "python", "{}/src/convert_{}_output_to_text.py".format(prpath, mmtype),
+        "--input-folder", joinpath(cfgpath, featsdir, "npz"),
+        "--file-names", joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+        "--output-file", text,
+        "--threshold"] + thresholds
+    convert = Stage(
+        "sweep convert {}".format(name), cmd,
+        inputs=[joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+                joinpath(cfgpath, featsdir, "npz", name),
+                joinpath(cfgpath, featsdir, "npz", name + ".store")],
+        outputs=[text.replace("{threshold}", t) for t in thresholds],
+        deps=[detect])
+
+    cmd = [
+        "python", "{}/src/bpe_sweep.py".format(prpath),
+        "--suffix", suffix,
+        "--codes", joinpath(cfgpath, C.DATASET.BPE_CODES),
+        "--vocabulary", joinpath(cfgpath, C.DATASET.PATH, "vocab.en"),
+        "--input-file", text,
+        "--output-prefix", joinpath(cfgpath, C.DATASET.PATH, name),
+        "--num-workers", str(bpe_workers),
+        "--threshold"] + thresholds
+    bpe = Stage(
+        "sweep bpe {}".format(name), cmd,
+        inputs=[cmd[5], cmd[7]] + convert.outputs,
+        outputs=[joinpath(cfgpath, C.DATASET.PATH, name + ".sweep.{}.tsv".format(suffix))],
+        deps=[convert], cpus=max(2, bpe_workers))
+    return [convert, bpe]
+
 def preprocess_mm_multi30k_vinvl(C, prpath, cfgpath):
     if C.SPLITS == "NONE":
         raise "Bad split"
 
+    # apply_bpe.py processes of every BPE stage
+    bpe_workers = C.DATASET.get("BPE_WORKERS", 1)
+    stages = []
     for split in C.SPLITS.split("+"):
         datasetnames = C.DATASET.get(split)
         imagesdirs = C.MULTIMODAL.RAW_DATA.get(split)
@@ -98,11 +383,24 @@ def preprocess_mm_multi30k_vinvl(C, prpath, cfgpath):
                 "--image-dir", joinpath(cfgpath, imagesdir),
                 "--file-list", joinpath(cfgpath, C.MULTIMODAL.SPLITS, name + ".txt"),
                 "--output-dir", joinpath(cfgpath, featsdir, "npz", name),
+                "--images-per-batch", str(C.MULTIMODAL.get("DETECTOR_IMAGES_PER_BATCH", 1)),
+                "--codec", C.MULTIMODAL.get("OUTPUT_CODEC", "zlib"),
+                "--output-format", C.MULTIMODAL.get("OUTPUT_FORMAT", "npz"),
                 "MODEL.WEIGHT", joinpath(cfgpath, C.MULTIMODAL.MODEL_WEIGHTS),
                 "MODEL.ROI_HEADS.NMS_FILTER", "1", "MODEL.ROI_HEADS.SCORE_THRESH", "0.2", "TEST.IGNORE_BOX_REGRESSION", "False",
                 "DATASETS.LABELMAP_FILE", joinpath(cfgpath, C.MULTIMODAL.OBJDET_LABELMAP_FILE)
             ]
-            run(C, cmd)
+            detect = Stage(
+                "vinvl {}".format(name), cmd,
+                inputs=[joinpath(cfgpath, C.MULTIMODAL.MODEL_PARAMS),
+                        joinpath(cfgpath, imagesdir),
+                        joinpath(cfgpath, C.MULTIMODAL.SPLITS, name + ".txt"),
+                        joinpath(cfgpath, C.MULTIMODAL.MODEL_WEIGHTS),
+                        joinpath(cfgpath, C.MULTIMODAL.OBJDET_LABELMAP_FILE)],
+                outputs=[joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+                         joinpath(cfgpath, featsdir, "npz", name)],
+                cpus=1, gpus=1)
+            stages.append(detect)
 
             cmd = [
                 "python", "{}/src/convert_vinvl_output_to_text.py".format(prpath),
@@ -111,7 +409,14 @@ def preprocess_mm_multi30k_vinvl(C, prpath, cfgpath):
                 "--output-file", joinpath(cfgpath, featsdir, "text", name + ".vinvl.en"),
                 "--threshold", str(C.MULTIMODAL.OBJDET_CONF_THRESH)
                 ]
-            run(C, cmd)
+            convert = Stage(
+                "convert {}".format(name), cmd,
+                inputs=[joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+                        joinpath(cfgpath, featsdir, "npz", name),
+                        joinpath(cfgpath, featsdir, "npz", name + ".store")],
+                outputs=[joinpath(cfgpath, featsdir, "text", name + ".vinvl.en")],
+                deps=[detect])
+            stages.append(convert)
 
             cmd = [
                 "bash", "{}/src/process-en/bpe-multi30k-task1.sh".format(prpath),
@@ -119,14 +424,27 @@ def preprocess_mm_multi30k_vinvl(C, prpath, cfgpath):
                 joinpath(cfgpath, C.DATASET.BPE_CODES),
                 joinpath(cfgpath, C.DATASET.PATH, "vocab.en"),
                 joinpath(cfgpath, featsdir, "text", name + ".vinvl.en"),
-                joinpath(cfgpath, C.DATASET.PATH, name)
+                joinpath(cfgpath, C.DATASET.PATH, name),
+                str(bpe_workers)
                 ]
-            run(C, cmd)
+            # The tokenizer runs with 2 threads, then apply_bpe.py with bpe_workers
+            stages.append(Stage(
+                "bpe {}".format(name), cmd,
+                inputs=cmd[4:7],
+                outputs=[joinpath(cfgpath, C.DATASET.PATH, name + ".lc.norm.tok.bpe.vv")],
+                deps=[convert], cpus=max(2, bpe_workers)))
+            if C.SWEEP:
+                stages += sweep_stages(C, prpath, cfgpath, name, "vinvl", "vv", detect)
+
+    return run_stages(C, stages)
 
 def preprocess_mm_multi30k_butd(C, prpath, cfgpath):
     if C.SPLITS == "NONE":
         raise "Bad split. Options: TRAIN,VALID,TEST"
 
+    # apply_bpe.py processes of every BPE stage
+    bpe_workers = C.DATASET.get("BPE_WORKERS", 1)
+    stages = []
     for split in C.SPLITS.split("+"):
         datasetnames = C.DATASET.get(split)
         imagesdirs = C.MULTIMODAL.RAW_DATA.get(split)
@@ -158,9 +476,22 @@ def preprocess_mm_multi30k_butd(C, prpath, cfgpath):
                 "--output-dir", joinpath(cfgpath, featsdir, "npz", name),
                 "--objects-vocab", joinpath(prpath, "external/bottom-up-attention.pytorch/evaluation/objects_vocab.txt"),
                 "--attributes-vocab", joinpath(prpath, "external/bottom-up-attention.pytorch/evaluation/attributes_vocab.txt"),
+                "--images-per-batch", str(C.MULTIMODAL.get("DETECTOR_IMAGES_PER_BATCH", 1)),
+                "--codec", C.MULTIMODAL.get("OUTPUT_CODEC", "zlib"),
+                "--output-format", C.MULTIMODAL.get("OUTPUT_FORMAT", "npz"),
                 "MODEL.WEIGHTS", joinpath(cfgpath, C.MULTIMODAL.MODEL_WEIGHTS)
             ]
-            run(C, cmd)
+            detect = Stage(
+                "butd {}".format(name), cmd,
+                inputs=[joinpath(cfgpath, C.MULTIMODAL.MODEL_PARAMS),
+                        joinpath(cfgpath, imagesdir),
+                        joinpath(cfgpath, C.MULTIMODAL.SPLITS, name + ".txt"),
+                        joinpath(cfgpath, C.MULTIMODAL.MODEL_WEIGHTS)],
+                outputs=[joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+                         joinpath(cfgpath, featsdir, "npz", name)],
+                cpus=C.MULTIMODAL.PREPROCESS.NUM_CPUS,
+                gpus=len(str(C.MULTIMODAL.BUTD.GPUS).split(",")))
+            stages.append(detect)
 
             cmd = [
                 "python", "{}/src/convert_butd_output_to_text.py".format(prpath),
@@ -169,7 +500,14 @@ def preprocess_mm_multi30k_butd(C, prpath, cfgpath):
                 "--output-file", joinpath(cfgpath, featsdir, "text", name + ".butd.en"),
                 "--threshold", str(C.MULTIMODAL.OBJDET_CONF_THRESH)
                 ]
-            run(C, cmd)
+            convert = Stage(
+                "convert {}".format(name), cmd,
+                inputs=[joinpath(cfgpath, featsdir, "npz", name + ".txt"),
+                        joinpath(cfgpath, featsdir, "npz", name),
+                        joinpath(cfgpath, featsdir, "npz", name + ".store")],
+                outputs=[joinpath(cfgpath, featsdir, "text", name + ".butd.en")],
+                deps=[detect])
+            stages.append(convert)
 
             cmd = [
                 "bash", "{}/src/process-en/bpe-multi30k-task1.sh".format(prpath),
@@ -177,13 +515,26 @@ def preprocess_mm_multi30k_butd(C, prpath, cfgpath):
                 joinpath(cfgpath, C.DATASET.BPE_CODES),
                 joinpath(cfgpath, C.DATASET.PATH, "vocab.en"),
                 joinpath(cfgpath, featsdir, "text", name + ".butd.en"),
-                joinpath(cfgpath, C.DATASET.PATH, name)
+                joinpath(cfgpath, C.DATASET.PATH, name),
+                str(bpe_workers)
                 ]
-            run(C, cmd)
+            # The tokenizer runs with 2 threads, then apply_bpe.py with bpe_workers
+            stages.append(Stage(
+                "bpe {}".format(name), cmd,
+                inputs=cmd[4:7],
+                outputs=[joinpath(cfgpath, C.DATASET.PATH, name + ".lc.norm.tok.bpe.vb")],
+                deps=[convert], cpus=max(2, bpe_workers)))
+            if C.SWEEP:
+                stages += sweep_stages(C, prpath, cfgpath, name, "butd", "vb", detect)
+
+    return run_stages(C, stages)
 
 def main(C):
+    global RUNNER
     prpath = os.path.dirname(os.path.realpath(__file__))
     cfgpath = C.ROOT_PATH
+    if C.IN_PROCESS:
+        RUNNER = InProcessRunner(prpath)
 
     if C.DATASET.NAME == "multi30k":
         if C.ACTION == "preprocess_text":
@@ -212,6 +563,8 @@ def main(C):
         print("Unknown dataset.")
         return
 
+    if RUNNER is not None:
+        RUNNER.report()
     print("Done.")
 
     
@@ -227,6 +580,16 @@ if __name__ == "__main__":
         "-d", "--dataset-name", help="dataset name", type=str, default=None)
     parser.add_argument(
         "-n", "--dry-run", help="dry run", action="store_true")
+    parser.add_argument(
+        "-f", "--force", help="run all stages, even if their outputs are up to date", action="store_true")
+    parser.add_argument(
+        "-j", "--max-cpus", help="CPU slots shared by concurrent stages", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--max-gpus", help="GPU slots shared by concurrent stages (detection stages take one per GPU they use)", type=int, default=1)
+    parser.add_argument(
+        "--in-process", help="run the feature extractors inside this process, building every model only once", action="store_true")
+    parser.add_argument(
+        "--sweep", help="comma-separated object detection thresholds to also convert and BPE-encode, with statistics per threshold", type=str, default=None)
     parser.add_argument(
         "opts", help="Modify config options using the command-line",
         default=None, nargs=argparse.REMAINDER)
@@ -236,12 +599,19 @@ if __name__ == "__main__":
     C.ROOT_PATH = os.path.dirname(os.path.realpath(args.config_file))
     C.VERBOSE = False
     C.DRY_RUN = False
+    C.FORCE = False
     C.merge_from_file(args.config_file)
     C.merge_from_list(args.opts)
     C.ACTION = args.action
     C.SPLITS = args.split.upper()
     if args.dry_run:
         C.DRY_RUN = True
+    if args.force:
+        C.FORCE = True
+    C.MAX_CPUS = args.max_cpus
+    C.MAX_GPUS = args.max_gpus
+    C.IN_PROCESS = args.in_process
+    C.SWEEP = [str(float(t)) for t in args.sweep.split(",")] if args.sweep else []
     C.DATASET_NAME = args.dataset_name
     C.freeze()
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Compares the output codecs of npz_codec on detector outputs: time to write
+# and read every image and bytes per image. Outputs are either synthetic, or
+# the .npz files of an existing output directory re-saved with each codec.
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import npz_codec
+
+
+def synthetic_vinvl(rng, num_images, num_boxes=20):
+    labels = np.array(["man", "shirt", "dog", "tree", "sky", "water", "grass",
+                       "hand", "hair", "building"])
+    for _ in range(num_images):
+        n = rng.randint(1, num_boxes + 1)
+        yield dict(rects=rng.rand(n, 4).astype(np.float32) * 500,
+                   objects_scores=rng.rand(n).astype(np.float32),
+                   objects=labels[rng.randint(len(labels), size=n)],
+                   attrs_scores=rng.rand(n, 5).astype(np.float32),
+                   attrs=np.array(["white black"] * n))
+
+
+def synthetic_butd(rng, num_images, num_boxes=36, dim=2048):
+    for _ in range(num_images):
+        # RoI features are post-ReLU, so about half of them are zero
+        x = np.maximum(rng.randn(num_boxes, dim), 0).astype(np.float32)
+        info = {"objects_id": rng.randint(1600, size=num_boxes),
+                "objects_conf": rng.rand(num_boxes).astype(np.float32),
+                "attrs_id": rng.randint(400, size=num_boxes),
+                "attrs_conf": rng.rand(num_boxes).astype(np.float32)}
+        yield dict(x=x, bbox=rng.rand(num_boxes, 4).astype(np.float32) * 500,
+                   num_bbox=num_boxes, image_h=375, image_w=500, info=info)
+
+
+def from_dir(input_dir, num_images):
+    files = sorted(glob.glob(os.path.join(input_dir, "**", "*.npz"), recursive=True))
+    for fname in files[:num_images]:
+        d = npz_codec.load(fname, allow_pickle=True)
+        yield {key: d[key] for key in d.files}
+
+
+def bench(codec, images, tmpdir):
+    outdir = os.path.join(tmpdir, codec)
+    os.makedirs(outdir)
+    start = time.perf_counter()
+    for i, arrays in enumerate(images):
+        npz_codec.save(os.path.join(outdir, "{:06d}.npz".format(i)), codec, **arrays)
+    write = time.perf_counter() - start
+
+    files = sorted(os.listdir(outdir))
+    size = sum(os.path.getsize(os.path.join(outdir, f)) for f in files)
+    start = time.perf_counter()
+    for fname in files:
+        d = npz_codec.load(os.path.join(outdir, fname), allow_pickle=True)
+        for key in d.files:
+            d[key]
+    read = time.perf_counter() - start
+    shutil.rmtree(outdir)
+    return write, read, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench-npz-codec')
+    parser.add_argument('--payload', choices=['vinvl', 'butd'], default='vinvl',
+                        help='Synthetic outputs to use')
+    parser.add_argument('-i', '--input-dir', type=str,
+                        help='Use the .npz files of this output directory instead')
+    parser.add_argument('-n', '--num-images', type=int, default=1000,
+                        help='Number of images')
+    parser.add_argument('--codecs', type=str, default=",".join(npz_codec.CODECS),
+                        help='Comma-separated codecs to compare')
+    args = parser.parse_args()
+
+    if args.input_dir:
+        images = list(from_dir(args.input_dir, args.num_images))
+    else:
+        make = synthetic_vinvl if args.payload == 'vinvl' else synthetic_butd
+        images = list(make(np.random.RandomState(0), args.num_images))
+    num_images = len(images)
+    print("{} images".format(num_images))
+
+    tmpdir = tempfile.mkdtemp(prefix="bench-npz-codec-")
+    try:
+        print("{:6} {:>10} {:>10} {:>14}".format(
+            "codec", "write ms", "read ms", "bytes/image"))
+        for codec in args.codecs.split(","):
+            try:
+                write, read, size = bench(codec, images, tmpdir)
+            except ImportError as e:
+                print("{:6} skipped: {}".format(codec, e))
+                continue
+            print("{:6} {:10.3f} {:10.3f} {:14.0f}".format(
+                codec, 1000 * write / num_images, 1000 * read / num_images,
+                size / num_images))
+    finally:
+        shutil.rmtree(tmpdir)
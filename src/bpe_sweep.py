@@ -0,0 +1,163 @@
+# Tokenizes and BPE-encodes the object-word corpora of several detection
+# thresholds in one pass, and reports their token and coverage statistics.
+#
+# The corpora written by convert_*_output_to_text.py with several thresholds
+# are concatenated, so the Moses pipeline runs once and a single apply_bpe
+# model (and its cache) encodes all of them. The result is then split back
+# into one .tok and one .bpe file per threshold, as bpe-multi30k-task1.sh
+# writes them:
+#
+#     <output-prefix>.t<threshold>.lc.norm.tok.<suffix>
+#     <output-prefix>.t<threshold>.lc.norm.tok.bpe.<suffix>
+#     <output-prefix>.sweep.<suffix>.tsv      statistics
+
+import argparse
+import codecs
+from collections import Counter
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+MOSES = os.path.join(ROOT, "external", "moses-3a0631a", "tokenizer")
+SUBWORD_NMT = os.path.join(ROOT, "external", "subword-nmt")
+
+THRESHOLD_FIELD = "{threshold}"
+
+STATS = ["threshold", "sentences", "covered", "words", "words/sent", "types",
+         "bpe_tokens", "bpe/word", "split_words"]
+
+
+def tokenize(in_file, out_file, lang):
+    """Runs the Moses pipeline of bpe-multi30k-task1.sh."""
+    pipeline = ("lowercase.perl | normalize-punctuation.perl -l {lang} | "
+                "tokenizer.perl -l {lang} -threads 2").format(lang=lang)
+    env = dict(os.environ, PATH=MOSES + os.pathsep + os.environ["PATH"])
+    with open(in_file, "rb") as fin, open(out_file, "wb") as fout:
+        subprocess.run(["bash", "-o", "pipefail", "-c", pipeline],
+                       stdin=fin, stdout=fout, env=env, check=True)
+
+
+def load_bpe(codes, vocab):
+    sys.path.insert(0, SUBWORD_NMT)
+    import apply_bpe
+    with codecs.open(vocab, encoding="utf-8") as f:
+        vocabulary = apply_bpe.read_vocabulary(f, None)
+    with codecs.open(codes, encoding="utf-8") as f:
+        return apply_bpe.BPE(f, vocab=vocabulary)
+
+
+def segment(bpe, lines, num_workers):
+    """BPE-encodes lines, in order, with num_workers processes."""
+    import apply_bpe
+    return list(apply_bpe.segment_lines(bpe, lines, num_workers))
+
+
+def corpus_stats(threshold, tok_lines, bpe_lines):
+    sentences = len(tok_lines)
+    words = [w for line in tok_lines for w in line.split()]
+    num_bpe = sum(len(line.split()) for line in bpe_lines)
+    split_words = sum(1 for tok_line, bpe_line in zip(tok_lines, bpe_lines)
+                      for _, n in word_pieces(tok_line, bpe_line) if n > 1)
+    return {
+        "threshold": threshold,
+        "sentences": sentences,
+        "covered": sum(1 for line in tok_lines if line.strip()) / max(sentences, 1),
+        "words": len(words),
+        "words/sent": len(words) / max(sentences, 1),
+        "types": len(Counter(words)),
+        "bpe_tokens": num_bpe,
+        "bpe/word": num_bpe / max(len(words), 1),
+        "split_words": split_words / max(len(words), 1),
+    }
+
+
+def word_pieces(tok_line, bpe_line):
+    """Yields each word of a tokenized line with its number of BPE pieces."""
+    pieces = iter(bpe_line.split())
+    for word in tok_line.split():
+        n = 1
+        while next(pieces, "").endswith("@@"):
+            n += 1
+        yield word, n
+
+
+def format_row(stats):
+    return "\t".join("{:.3f}".format(stats[key]) if isinstance(stats[key], float)
+                     else str(stats[key]) for key in STATS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bpe-sweep')
+    parser.add_argument('-l', '--lang', type=str, default="en",
+                        help='Language of the tokenizer')
+    parser.add_argument('-s', '--suffix', type=str, required=True,
+                        help='Suffix of the output files, e.g. vv or vb')
+    parser.add_argument('-c', '--codes', type=str, required=True,
+                        help='BPE codes')
+    parser.add_argument('-v', '--vocabulary', type=str, required=True,
+                        help='BPE vocabulary')
+    parser.add_argument('-i', '--input-file', type=str, required=True,
+                        help='Object-word corpora, with a %s field in the '
+                        'name' % THRESHOLD_FIELD)
+    parser.add_argument('-t', '--threshold', type=float, nargs='+', required=True,
+                        help='Thresholds of the corpora')
+    parser.add_argument('-o', '--output-prefix', type=str, required=True,
+                        help='Prefix of the output files')
+    parser.add_argument('-j', '--num-workers', type=int, default=1,
+                        help='Processes of the BPE segmentation')
+    args = parser.parse_args()
+
+    if THRESHOLD_FIELD not in args.input_file:
+        parser.error("--input-file needs a {} field".format(THRESHOLD_FIELD))
+    inputs = [args.input_file.replace(THRESHOLD_FIELD, str(t)) for t in args.threshold]
+
+    # One file with all the corpora, in order
+    counts = []
+    with tempfile.TemporaryDirectory(prefix="bpe-sweep-") as tmpdir:
+        concat = os.path.join(tmpdir, "all.txt")
+        tokenized = os.path.join(tmpdir, "all.tok")
+        with open(concat, "w", encoding="utf-8") as fout:
+            for fname in inputs:
+                with open(fname, encoding="utf-8") as fin:
+                    lines = fin.read().splitlines()
+                counts.append(len(lines))
+                for line in lines:
+                    fout.write(line + "\n")
+        tokenize(concat, tokenized, args.lang)
+        with open(tokenized, encoding="utf-8") as f:
+            tok_lines = f.read().splitlines()
+    if len(tok_lines) != sum(counts):
+        raise RuntimeError("The tokenizer returned {} lines for {}.".format(
+            len(tok_lines), sum(counts)))
+
+    bpe = load_bpe(args.codes, args.vocabulary)
+    bpe_lines = segment(bpe, tok_lines, args.num_workers)
+
+    rows = []
+    start = 0
+    for threshold, count in zip(args.threshold, counts):
+        tok = tok_lines[start:start + count]
+        enc = bpe_lines[start:start + count]
+        start += count
+        prefix = "{}.t{}.lc.norm.tok.".format(args.output_prefix, threshold)
+        with open(prefix + args.suffix, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in tok)
+        with open(prefix + "bpe." + args.suffix, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in enc)
+        rows.append(corpus_stats(threshold, tok, enc))
+
+    num_words = sum(r["words"] for r in rows)
+    if args.num_workers > 1:
+        print("{} words encoded by {} processes.".format(num_words, args.num_workers))
+    else:
+        print("{} words encoded with {} cached BPE entries.".format(num_words, len(bpe.cache)))
+    stats_file = "{}.sweep.{}.tsv".format(args.output_prefix, args.suffix)
+    with open(stats_file, "w") as f:
+        f.write("\t".join(STATS) + "\n")
+        for row in rows:
+            f.write(format_row(row) + "\n")
+    print("\t".join(STATS))
+    for row in rows:
+        print(format_row(row))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Completion index of the ``.npz`` outputs of the detector scripts.
+
+Workers append one line per output to ``<output_dir>.done`` once the output
+is completely written, so the driver can tell which images are left from a
+single scan of the output directory, before any model is loaded.
+"""
+import os
+
+from npz_codec import is_complete as is_complete_npz
+
+JOURNAL_SUFFIX = ".done"
+
+
+class CompletionJournal(object):
+    """Journal of the committed outputs in ``output_dir``.
+
+    Lines are ``<name>\\t<size>``, where ``name`` is the path of an output
+    relative to ``output_dir``. They are appended with a single ``write`` on
+    a file opened in append mode, so several worker processes can commit to
+    the same journal.
+
+    Arguments:
+        output_dir (str): Output directory; the journal is written next to
+            it, as ``<output_dir>.done``.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir[:-1] if output_dir.endswith("/") else output_dir
+        self.path = self.output_dir + JOURNAL_SUFFIX
+        self.done = {}
+
+    def _read(self):
+        journal = {}
+        if not os.path.exists(self.path):
+            return journal
+        with open(self.path) as f:
+            for line in f:
+                name, _, size = line.rstrip("\n").rpartition("\t")
+                try:
+                    journal[name] = int(size)
+                except ValueError:
+                    # Torn last line
+                    continue
+        return journal
+
+    def _scan(self, path, prefix=""):
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                yield from self._scan(entry.path, prefix + entry.name + "/")
+            else:
+                yield prefix + entry.name, entry.path, entry.stat().st_size
+
+    def load(self):
+        """Reconciles the journal with one scan of the output directory.
+
+        Journaled outputs count as done if their file still has the
+        journaled size. Outputs that are not journaled (written by an older
+        run, or right before a crash) are adopted if they are complete
+        ``.npz`` files and deleted otherwise, as are leftover temporary
+        files. The journal is then rewritten compactly. Returns the set of
+        done names.
+        """
+        journal = self._read()
+        self.done = {}
+        adopted = removed = 0
+        if os.path.isdir(self.output_dir):
+            for name, path, size in self._scan(self.output_dir):
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                elif not name.endswith(".npz"):
+                    continue
+                elif journal.get(name) == size:
+                    self.done[name] = size
+                elif is_complete_npz(path):
+                    self.done[name] = size
+                    adopted += 1
+                else:
+                    print("Removing partially written {}.".format(path))
+                    os.remove(path)
+                    removed += 1
+        if adopted or removed:
+            print("Completion journal: adopted {} and removed {} unjournaled "
+                  "outputs.".format(adopted, removed))
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for name, size in self.done.items():
+                f.write("{}\t{}\n".format(name, size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return set(self.done)
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def commit(self, name):
+        """Records that the output ``name`` is completely written."""
+        try:
+            size = os.path.getsize(os.path.join(self.output_dir, name))
+        except OSError:
+            # Nothing was written for this image
+            return
+        line = "{}\t{}\n".format(name, size).encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.done[name] = size
@@ -8,6 +8,16 @@ import argparse
 from pathlib import Path
 import numpy as np
 
+import npz_codec
+import convert_utils
+
+def load_detections(input_file):
+    d = npz_codec.load(input_file, allow_pickle=True)
+    # The info dict is unpickled on every access
+    info = d["info"].item()
+    return info["objects_id"], info["objects_conf"]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='extract-cnn-features')
     parser.add_argument('-i', '--input-folder', type=str, required=True,
@@ -16,8 +26,7 @@ if __name__ == '__main__':
                         help="""File containing a list with image file names.""")
     parser.add_argument('-o', '--output-file', type=str, required=True,
                         help='Output file')
-    parser.add_argument('-t', '--threshold', type=float, required=True,
-                        help='Confidence score threshold')
+    convert_utils.add_args(parser)
 
     # Parse arguments
     args = parser.parse_args()
@@ -37,17 +46,4 @@ if __name__ == '__main__':
         for line in f.readlines():
             imglist.append(line.strip())
 
-    with open(str(output_file), "w") as fd:
-        for imgname in imglist:        
-            input_file = input_folder / (os.path.splitext(imgname)[0] + ".npz")
-
-            d = np.load(input_file, allow_pickle=True)
-
-            o_id = d["info"].item()["objects_id"]
-            o_conf = d["info"].item()["objects_conf"]
-            words = np.unique(classes[o_id[o_conf > args.threshold]])
-            
-            # words = np.unique(classes[d["objects_id"][d["objects_conf"] > args.threshold]])
-            sentence = " ".join(words) + "\n"
-
-            fd.write(sentence)
+    convert_utils.convert(args, imglist, load_detections, classes)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Shared code of the convert_*_output_to_text.py scripts.
+
+The detections of a split are read once, from a detection store or from the
+per-image ``.npz`` files with a process pool, into ragged arrays. Each
+threshold then takes one vectorized pass over them, so several thresholds
+can be written in one run.
+"""
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+import detection_store
+
+THRESHOLD_FIELD = "{threshold}"
+
+
+def add_args(parser):
+    parser.add_argument('-t', '--threshold', type=float, nargs='+', required=True,
+                        help='Confidence score threshold(s). With several '
+                        'thresholds, the output file name must contain '
+                        '%s, which is replaced by each of them.' % THRESHOLD_FIELD)
+    parser.add_argument('-j', '--num-workers', type=int, default=os.cpu_count(),
+                        help='Processes reading the .npz files')
+
+
+def output_files(output_file, thresholds):
+    """Returns the output file of every threshold."""
+    if len(thresholds) > 1 and THRESHOLD_FIELD not in str(output_file):
+        raise ValueError("Several thresholds need {} in the output file "
+                         "name: {}".format(THRESHOLD_FIELD, output_file))
+    return [str(output_file).replace(THRESHOLD_FIELD, str(t)) for t in thresholds]
+
+
+def find_store(input_folder, imglist):
+    """Returns the detection store of the manifest entries in ``imglist``,
+    which start with the output directory, or None."""
+    if not imglist:
+        return None
+    store = detection_store.store_dir(os.path.join(str(input_folder), imglist[0].split("/")[0]))
+    return store if detection_store.is_store(store) else None
+
+
+def read_files(load_fn, files, num_workers):
+    """Calls ``load_fn(file)``, which returns the ``(labels, scores)`` of
+    the boxes of one image, for all ``files``. Returns the ragged arrays
+    ``labels, scores, box_offsets``."""
+    if num_workers > 1 and len(files) > 1:
+        with mp.get_context("spawn").Pool(num_workers) as pool:
+            results = pool.map(load_fn, files,
+                               chunksize=max(1, len(files) // (8 * num_workers)))
+    else:
+        results = [load_fn(f) for f in files]
+    counts = [len(scores) for _, scores in results]
+    box_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    if not results:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), box_offsets
+    labels = np.concatenate([np.asarray(labels).reshape(-1) for labels, _ in results])
+    scores = np.concatenate([np.asarray(scores).reshape(-1) for _, scores in results])
+    return labels, scores, box_offsets
+
+
+def write_text(output_file, words_list):
+    with open(str(output_file), "w") as fd:
+        for words in words_list:
+            fd.write(" ".join(words) + "\n")
+
+
+def convert(args, imglist, load_fn, classes=None):
+    """Writes the text of every threshold in ``args.threshold``. Boxes are
+    read from the detection store next to the manifest if there is one,
+    with ``load_fn`` from the ``.npz`` files otherwise. Their labels are
+    indexes into ``classes`` if given, class names otherwise."""
+    outputs = output_files(args.output_file, args.threshold)
+    store = find_store(args.input_folder, imglist)
+    if store is not None:
+        print("Reading detection store: %s" % store)
+        reader = detection_store.DetectionStoreReader(store)
+        for threshold, output in zip(args.threshold, outputs):
+            write_text(output, reader.objects_above(imglist, threshold))
+        return
+
+    files = [os.path.join(str(args.input_folder), os.path.splitext(imgname)[0] + ".npz")
+             for imgname in imglist]
+    labels, scores, box_offsets = read_files(load_fn, files, args.num_workers)
+    if classes is None:
+        classes, labels = np.unique(labels.astype(str), return_inverse=True)
+        labels = labels.reshape(-1)
+    for threshold, output in zip(args.threshold, outputs):
+        write_text(output, detection_store.objects_above(
+            classes, labels, scores, box_offsets, threshold))
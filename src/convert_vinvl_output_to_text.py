@@ -6,7 +6,14 @@ import sys
 import glob
 import argparse
 from pathlib import Path
-import numpy as np
+
+import npz_codec
+import convert_utils
+
+def load_detections(input_file):
+    d = npz_codec.load(input_file)
+    return d["objects"], d["objects_scores"]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='extract-cnn-features')
@@ -16,8 +23,7 @@ if __name__ == '__main__':
                         help="""File containing a list with image file names.""")
     parser.add_argument('-o', '--output-file', type=str, required=True,
                         help='Output file')
-    parser.add_argument('-t', '--threshold', type=float, required=True,
-                        help='Confidence score threshold')
+    convert_utils.add_args(parser)
 
     # Parse arguments
     args = parser.parse_args()
@@ -34,12 +40,4 @@ if __name__ == '__main__':
         for line in f.readlines():
             imglist.append(line.strip())
 
-    with open(str(output_file), "w") as fd:
-        for imgname in imglist:        
-            input_file = input_folder / (os.path.splitext(imgname)[0] + ".npz")
-
-            d = np.load(input_file)
-            words = np.unique(d["objects"][d["objects_scores"] > args.threshold])
-            sentence = " ".join(words) + "\n"
-
-            fd.write(sentence)
+    convert_utils.convert(args, imglist, load_detections)
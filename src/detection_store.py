@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Columnar store for the detections of the VinVL and BUTD scripts.
+
+Instead of one ``.npz`` per image, the detections of a split are appended to
+a few chunk files holding ragged arrays: the boxes of all images back to
+back, with per-image offsets, and the attributes of all boxes back to back,
+with per-box offsets. Classes and attributes are integer ids into a single
+vocabulary kept in the index, so a whole split can be filtered with a few
+vectorized NumPy operations.
+
+Layout of a store directory::
+
+    <store>/index.json          vocabularies, and the chunk files with the
+                                names of their images in order
+    <store>/chunk-00000.npz     box_offsets   int64   (images + 1,)
+    ...                         boxes         float32 (boxes, 4)
+                                scores        float32 or float64 (boxes,)
+                                class_ids     int32   (boxes,)
+                                attr_offsets  int64   (boxes + 1,)
+                                attr_ids      int32   (attributes,)
+                                attr_scores   float32 (attributes,)
+
+Scores keep the dtype of the detector's ``.npz`` outputs (``score_dtype``
+in the index), so thresholds compare them exactly as for the ``.npz`` files.
+
+Like :mod:`feature_store`, several processes can fill the same store by
+writing separate parts (``index.<part>.json`` and ``chunk-<part>-00000.npz``),
+which :func:`merge_parts` then combines into ``index.json``.
+"""
+import glob
+import json
+import os
+
+import numpy as np
+
+from feature_store import index_file, write_index, INDEX_FILE
+
+STORE_SUFFIX = ".store"
+DEFAULT_CHUNK_SIZE = 1024
+
+COLUMNS = ("box_offsets", "boxes", "scores", "class_ids",
+           "attr_offsets", "attr_ids", "attr_scores")
+
+
+def store_dir(output_dir):
+    """The store of an output directory lives next to it, as
+    ``<output_dir>.store``."""
+    output_dir = str(output_dir)
+    return (output_dir[:-1] if output_dir.endswith("/") else output_dir) + STORE_SUFFIX
+
+
+def is_store(path):
+    return os.path.exists(os.path.join(str(path), INDEX_FILE)) or \
+        bool(glob.glob(os.path.join(glob.escape(str(path)), "index.*.json")))
+
+
+def merge_parts(path):
+    """Combines ``index.json`` and all part indexes of the store at ``path``
+    into ``index.json`` and removes the part indexes. A name that appears
+    in several parts keeps its last entry."""
+    path = str(path)
+    files = glob.glob(os.path.join(glob.escape(path), "index.*.json"))
+    if os.path.exists(os.path.join(path, INDEX_FILE)):
+        files.insert(0, os.path.join(path, INDEX_FILE))
+
+    merged = None
+    for fname in files:
+        with open(fname) as f:
+            index = json.load(f)
+        if merged is None:
+            merged = dict(index, chunks=[])
+        elif (index["classes"], index["attributes"]) != \
+                (merged["classes"], merged["attributes"]):
+            raise ValueError("{} was written with a different vocabulary.".format(fname))
+        elif index_score_dtype(index) != index_score_dtype(merged):
+            raise ValueError("{} was written with a different score dtype.".format(fname))
+        merged["chunks"] += index["chunks"]
+    if merged is None:
+        return
+
+    write_index(os.path.join(path, INDEX_FILE), merged)
+    for fname in files:
+        if os.path.basename(fname) != INDEX_FILE:
+            os.remove(fname)
+
+
+def index_score_dtype(index):
+    """The dtype of the scores of a store with ``index``; stores written
+    before it was recorded hold float32 scores."""
+    return np.dtype(index.get("score_dtype", "float32"))
+
+
+def stored_names(path):
+    """Names of the images in the merged store at ``path``, read from the
+    index only."""
+    index_path = os.path.join(str(path), INDEX_FILE)
+    if not os.path.exists(index_path):
+        return set()
+    with open(index_path) as f:
+        index = json.load(f)
+    return {name for chunk in index["chunks"] for name in chunk["names"]}
+
+
+def remove_store(path):
+    """Deletes the index and chunk files of the store at ``path``."""
+    path = glob.escape(str(path))
+    for fname in glob.glob(os.path.join(path, "index*.json")) + \
+            glob.glob(os.path.join(path, "chunk-*.npz")):
+        os.remove(fname)
+
+
+class DetectionStoreWriter(object):
+    """Appends per-image detections to a store.
+
+    Images are buffered and written as one chunk every ``chunk_size``
+    images, after which the index is atomically rewritten; images appended
+    after the last :meth:`flush` are lost on a crash.
+
+    Arguments:
+        path (str): Store directory, created if needed.
+        classes (list): Class names; detections refer to them by index.
+        attributes (list, optional): Attribute names.
+        chunk_size (int, optional): Images per chunk file.
+        part (str, optional): Write a separate part of the store, to be
+            combined with :func:`merge_parts`. Appending to an existing part
+            continues it.
+        score_dtype (dtype, optional): Dtype of the stored scores, the
+            dtype of the scores of the ``.npz`` outputs (float64 for VinVL).
+    """
+    def __init__(self, path, classes, attributes=(), chunk_size=DEFAULT_CHUNK_SIZE,
+                 part=None, score_dtype=np.float32):
+        self.path = str(path)
+        self.part = part
+        self.index_file = index_file(part)
+        self.classes = list(classes)
+        self.attributes = list(attributes)
+        self.chunk_size = max(1, chunk_size)
+        self.score_dtype = np.dtype(score_dtype)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.chunks = []
+        index_path = os.path.join(self.path, self.index_file)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if (index["classes"], index["attributes"]) != (self.classes, self.attributes):
+                raise ValueError("{} was written with a different vocabulary.".format(
+                    index_path))
+            if index_score_dtype(index) != self.score_dtype:
+                raise ValueError("{} was written with {} scores.".format(
+                    index_path, index_score_dtype(index)))
+            self.chunks = index["chunks"]
+        self._reset()
+
+    def _reset(self):
+        self._names = []
+        self._boxes, self._scores, self._class_ids = [], [], []
+        self._num_boxes, self._num_attrs = [], []
+        self._attr_ids, self._attr_scores = [], []
+
+    def append(self, name, boxes, scores, class_ids, attr_ids=None, attr_scores=None):
+        """Appends the detections of one image. ``boxes`` is ``(n, 4)``,
+        ``scores`` and ``class_ids`` have ``n`` elements, ``attr_ids`` and
+        ``attr_scores`` are optional sequences of ``n`` sequences with the
+        attributes of each box."""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        n = len(boxes)
+        scores = np.asarray(scores, dtype=self.score_dtype).reshape(n)
+        class_ids = np.asarray(class_ids, dtype=np.int32).reshape(n)
+        if attr_ids is None:
+            attr_ids = attr_scores = [()] * n
+        num_attrs = [len(ids) for ids in attr_ids]
+
+        self._names.append(name)
+        self._boxes.append(boxes)
+        self._scores.append(scores)
+        self._class_ids.append(class_ids)
+        self._num_boxes.append(n)
+        self._num_attrs += num_attrs
+        self._attr_ids.append(np.fromiter(
+            (i for ids in attr_ids for i in ids), dtype=np.int32, count=sum(num_attrs)))
+        self._attr_scores.append(np.fromiter(
+            (s for conf in attr_scores for s in conf), dtype=np.float32, count=sum(num_attrs)))
+        if len(self._names) >= self.chunk_size:
+            self.flush()
+
+    def _chunk_name(self):
+        # Chunks of merged parts or of a crashed run may use the next number
+        n = len(self.chunks)
+        while True:
+            if self.part is None:
+                name = "chunk-{:05d}.npz".format(n)
+            else:
+                name = "chunk-{}-{:05d}.npz".format(self.part, n)
+            if not os.path.exists(os.path.join(self.path, name)):
+                return name
+            n += 1
+
+    def flush(self):
+        """Writes the buffered images as a chunk and rewrites the index."""
+        if not self._names:
+            return
+        name = self._chunk_name()
+        columns = {
+            "box_offsets": np.concatenate([[0], np.cumsum(self._num_boxes)]).astype(np.int64),
+            "boxes": np.concatenate(self._boxes),
+            "scores": np.concatenate(self._scores),
+            "class_ids": np.concatenate(self._class_ids),
+            "attr_offsets": np.concatenate([[0], np.cumsum(self._num_attrs)]).astype(np.int64),
+            "attr_ids": np.concatenate(self._attr_ids),
+            "attr_scores": np.concatenate(self._attr_scores),
+        }
+        tmp = os.path.join(self.path, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, **columns)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, name))
+
+        self.chunks.append({"file": name, "names": self._names})
+        index = {"classes": self.classes, "attributes": self.attributes,
+                 "score_dtype": self.score_dtype.name, "chunks": self.chunks}
+        write_index(os.path.join(self.path, self.index_file), index)
+        self._reset()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DetectionStoreReader(object):
+    """Read-only access to a merged store written by
+    :class:`DetectionStoreWriter`.
+
+    All chunks are concatenated into split-wide ragged arrays, available as
+    attributes named as the chunk columns, with ``box_offsets`` and
+    ``attr_offsets`` indexing the concatenated arrays. Names may be given
+    as bare image names or as manifest entries (``test_2016_flickr/1000.npz``).
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.classes = np.array(index["classes"], dtype=object)
+        self.attributes = np.array(index["attributes"], dtype=object)
+        self.names = []
+        columns = {column: [] for column in COLUMNS}
+        num_boxes = num_attrs = 0
+        for chunk in index["chunks"]:
+            data = np.load(os.path.join(self.path, chunk["file"]))
+            for column in COLUMNS:
+                values = data[column]
+                if column == "box_offsets":
+                    values = values[:-1] + num_boxes
+                elif column == "attr_offsets":
+                    values = values[:-1] + num_attrs
+                columns[column].append(values)
+            num_boxes += len(data["scores"])
+            num_attrs += len(data["attr_ids"])
+            self.names += chunk["names"]
+        columns["box_offsets"].append([num_boxes])
+        columns["attr_offsets"].append([num_attrs])
+        dtypes = {"box_offsets": np.int64, "boxes": np.float32,
+                  "scores": index_score_dtype(index), "class_ids": np.int32,
+                  "attr_offsets": np.int64, "attr_ids": np.int32,
+                  "attr_scores": np.float32}
+        for column in COLUMNS:
+            values = np.concatenate(columns[column]) if columns[column] else []
+            values = np.asarray(values, dtype=dtypes[column])
+            setattr(self, column, values.reshape(-1, 4) if column == "boxes" else values)
+        # A name appended again (e.g. by a resumed worker) keeps its last entry
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def key(self, name):
+        name = str(name)
+        if name.endswith(".npz"):
+            name = name[:-len(".npz")]
+        if name not in self.index and "/" in name:
+            # Manifest entries start with the output directory
+            name = name.split("/", 1)[1]
+        return name
+
+    def __contains__(self, name):
+        return self.key(name) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def image_ids(self, names):
+        """Positions of ``names`` in the concatenated arrays. Raises
+        ``KeyError`` for names that are not in the store."""
+        return np.array([self.index[self.key(name)] for name in names], dtype=np.int64)
+
+    def get(self, name):
+        """Returns the columns of one image as a dict, with ``attr_offsets``
+        relative to its own ``attr_ids``."""
+        i = self.index[self.key(name)]
+        start, end = self.box_offsets[i], self.box_offsets[i + 1]
+        astart, aend = self.attr_offsets[start], self.attr_offsets[end]
+        return {"boxes": self.boxes[start:end], "scores": self.scores[start:end],
+                "class_ids": self.class_ids[start:end],
+                "attr_offsets": self.attr_offsets[start:end + 1] - astart,
+                "attr_ids": self.attr_ids[astart:aend],
+                "attr_scores": self.attr_scores[astart:aend]}
+
+    def objects_above(self, names, threshold):
+        """Returns, for each of ``names``, the sorted unique class names of
+        the boxes scoring above ``threshold``, like ``np.unique`` on the
+        class names of one image."""
+        image_ids = self.image_ids(names)
+        starts = self.box_offsets[image_ids]
+        counts = self.box_offsets[image_ids + 1] - starts
+        # Boxes of the requested images, in request order
+        boxes = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+            np.arange(counts.sum())
+        return objects_above(self.classes, self.class_ids[boxes],
+                             self.scores[boxes],
+                             np.concatenate([[0], np.cumsum(counts)]), threshold)
+
+
+def objects_above(classes, class_ids, scores, box_offsets, threshold):
+    """Returns, for each image of ragged detections given by
+    ``box_offsets``, the sorted unique names in ``classes`` of the boxes
+    scoring above ``threshold``, in one vectorized pass over all images."""
+    num_images = len(box_offsets) - 1
+    # Class names may repeat in the vocabulary, rank the unique names
+    words, ranks = np.unique(np.asarray(classes).astype(str), return_inverse=True)
+    ranks = ranks.reshape(-1)
+    owner = np.repeat(np.arange(num_images), np.diff(box_offsets))
+    keep = scores > threshold
+    keys = np.unique(owner[keep] * len(words) + ranks[class_ids[keep]])
+    bounds = np.searchsorted(keys // max(len(words), 1), np.arange(num_images + 1))
+    found = words[keys % max(len(words), 1)]
+    return [found[bounds[i]:bounds[i + 1]] for i in range(num_images)]
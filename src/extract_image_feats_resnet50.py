@@ -3,6 +3,7 @@
 import argparse
 from pathlib import Path
 import os, sys
+import time
 
 import numpy as np
 
@@ -12,9 +13,18 @@ import torch
 from torch.autograd import Variable
 import torch.utils.data as data
 
-from torchvision.models import resnet50
 from torchvision import transforms
 
+from resnet50_utils import add_loader_args, build_loader, PipelineStats, AsyncWriter, FusedTransfer
+from resnet50_utils import LAYERS, add_layers_arg, resnet_forward
+from resnet50_utils import ProgressLog, add_resume_arg, fsync_dir, index_runs
+from resnet50_utils import add_device_args, parse_devices, build_cnn, split_work, run_workers
+from resnet50_utils import configure_threads, inference_mode, cache_context
+
+from feature_cache import FeatureCache, add_cache_args, lookup
+
+from feature_store import ShardedFeatureWriter, DEFAULT_SHARD_SIZE, merge_parts, remove_store
+
 # Note: from https://github.com/multi30k/dataset/blob/master/scripts/feature-extractor
 # This script uses the PyTorch's pre-trained ResNet-50 CNN to extract
 #   res4f_relu convolutional features of size 1024x14x14
@@ -84,23 +94,114 @@ class ImageFolderDataset(data.Dataset):
         return len(self.image_files)
 
 
-def resnet_forward(cnn, x):
-    x = cnn.conv1(x)
-    x = cnn.bn1(x)
-    x = cnn.relu(x)
-    x = cnn.maxpool(x)
+def save_npy(path, arr):
+    # Not fsynced: the directories are fsynced once per batch by sync_dirs,
+    # before the batch is marked in the progress log
+    with open(path, "wb") as f:
+        np.save(f, arr)
 
-    x = cnn.layer1(x)
-    x = cnn.layer2(x)
-    res4f_relu = cnn.layer3(x)
-    res5e_relu = cnn.layer4(res4f_relu)
 
-    avgp = cnn.avgpool(res5e_relu)
-    avgp = torch.flatten(avgp, 1)
-    return res4f_relu, res5e_relu, avgp
+def sync_dirs(dirs):
+    for d in dirs.values():
+        fsync_dir(d)
 
 
-if __name__ == '__main__':
+def extract(rank, devices, args, dataset, chunks, names, dirs, store_dir, log,
+            cache, digests, cnn=None):
+    """Extracts the features of the images ``chunks[rank]`` on
+    ``devices[rank]``. With several devices, every process appends to its
+    own part of the sharded store."""
+    device = devices[rank]
+    todo = chunks[rank]
+    layers = args.layers
+    if not todo:
+        return
+    part = None
+    if len(devices) > 1:
+        log.part = part = rank
+
+    if cnn is None:
+        configure_threads(args, devices)
+        print('Creating CNN instance on {} ({} threads).'.format(
+            device, torch.get_num_threads()))
+        cnn = build_cnn(args.model_file, layers, device, args.channels_last)
+    use_cuda = torch.device(device).type == "cuda"
+
+    store = None
+    if store_dir is not None:
+        store = ShardedFeatureWriter(
+            store_dir, [(layer, LAYERS[layer]) for layer in layers],
+            shard_size=args.shard_size, resume=True, part=part)
+
+    loader = build_loader(data.Subset(dataset, todo), args, use_cuda)
+
+    n_batches = int(np.ceil(len(todo) / args.batch_size))
+
+    bs = args.batch_size
+
+    def write_batch(indices, feats, ready=None):
+        if ready is not None:
+            ready.synchronize()
+        # Views of the pinned buffers on the fused path, which are already
+        # float16 and outlive this call, so they are written without a copy
+        feats = [feat.numpy().astype(np.float16, copy=False) for feat in feats]
+
+        for i, idx in enumerate(indices):
+            fname = names[idx]
+            if store is not None:
+                store.append(fname, {layer: feat[i]
+                                     for layer, feat in zip(layers, feats)})
+            else:
+                for layer, feat in zip(layers, feats):
+                    save_npy(dirs[layer] / (fname + ".npy"), feat[i])
+            if cache is not None:
+                for layer, feat in zip(layers, feats):
+                    cache.put(digests[idx], layer, feat[i])
+
+        if store is not None:
+            store.flush()
+        else:
+            sync_dirs(dirs)
+        for start, end in index_runs(indices):
+            log.mark(start, end)
+
+    transfer = None
+    if args.fused_transfer:
+        transfer = FusedTransfer(
+            [LAYERS[layer] for layer in layers], bs, device,
+            num_buffers=args.write_queue + 2)
+
+    prefix = "[{}] ".format(device) if len(devices) > 1 else ""
+
+    stats = PipelineStats()
+    with AsyncWriter(write_batch, args.write_queue) as writer:
+        for bidx, batch in enumerate(stats.iterate(loader)):
+            x = batch.to(device, non_blocking=True)
+            if args.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            with inference_mode():
+                outputs = resnet_forward(cnn, x, layers)
+            outputs = [outputs[layer].contiguous() for layer in layers]
+
+            indices = todo[bidx * bs: (bidx + 1) * bs]
+            if transfer is not None:
+                feats, ready = transfer(outputs)
+                writer.put(indices, feats, ready)
+            else:
+                writer.put(indices, [out.cpu() for out in outputs])
+
+            print('{}{:3}/{:3} batches completed.'.format(
+                prefix, bidx + 1, n_batches), end='\r')
+            sys.stdout.flush()
+
+    print()
+    stats.report(writer)
+
+    if store is not None:
+        store.close()
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(prog='extract-cnn-features')
     parser.add_argument('-i', '--image-folder', type=str, required=True,
                         help='Folder to image files i.e. /images/train')
@@ -113,22 +214,59 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output-folder', type=str, required=True,
                         help='Output folder. Ex: out/train/')
     parser.add_argument('-s', '--split', type=str, required=True, help="Split")
-
-    # Parse arguments
-    args = parser.parse_args()
-
+    parser.add_argument('--output-format', type=str, default="npy",
+                        choices=["npy", "sharded"],
+                        help='"npy" writes one file per image and layer, '
+                        '"sharded" appends all layers to a few large shard '
+                        'files under <output-folder>/sharded/<split>.')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help='Approximate shard size in bytes (sharded format).')
+    add_layers_arg(parser)
+    add_loader_args(parser)
+    add_resume_arg(parser)
+    add_device_args(parser)
+    add_cache_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def model_key(args):
+    """Arguments that determine the model built by :func:`load_model`."""
+    return (os.path.realpath(args.model_file), tuple(args.layers),
+            args.devices, args.channels_last)
+
+
+def load_model(args):
+    """Builds the CNN for a single device run, so that it can be reused by
+    several calls to :func:`run`. Returns ``None`` for several devices,
+    every worker process then builds its own."""
+    devices = parse_devices(args.devices)
+    if len(devices) != 1:
+        return None
+    configure_threads(args, devices)
+    print('Creating CNN instance on {} ({} threads).'.format(
+        devices[0], torch.get_num_threads()))
+    model_file = str(Path(args.model_file).expanduser().resolve())
+    return build_cnn(model_file, args.layers, devices[0], args.channels_last)
+
+
+def run(args, cnn=None):
+    """Extracts the features of one image list. ``cnn`` is an optional model
+    returned by :func:`load_model` for the same arguments."""
     image_folder = Path(args.image_folder).expanduser().resolve()
     file_names = Path(args.file_names).expanduser().resolve()
     output_folder = Path(args.output_folder).expanduser().resolve()
     model_file = Path(args.model_file).expanduser().resolve()
 
     print("Output folder: %s" % str(output_folder))
-    dir_res5erelu = output_folder / "res5erelu" / args.split
-    dir_res4frelu = output_folder / "res4frelu" / args.split
-    dir_avgpool = output_folder / "avgpool" / args.split
-    os.makedirs(dir_res5erelu, exist_ok=True)
-    os.makedirs(dir_res4frelu, exist_ok=True)
-    os.makedirs(dir_avgpool, exist_ok=True)
+    layers = args.layers
+    dirs = {layer: output_folder / layer / args.split for layer in layers}
+    for layer in layers:
+        if args.output_format == "npy":
+            os.makedirs(dirs[layer], exist_ok=True)
+        else:
+            # The manifests are still written next to the layer folders
+            os.makedirs(dirs[layer].parent, exist_ok=True)
 
     if not model_file.exists():
         raise(RuntimeError("%s does not exist." % str(model_file)))
@@ -138,68 +276,75 @@ if __name__ == '__main__':
                                  resize=256, crop=224)
     print('Image folder: %s' % args.image_folder)
 
-    loader = data.DataLoader(dataset, batch_size=args.batch_size)
-
-    print('Creating CNN instance.')
-    cnn = resnet50(pretrained=False)
-    #resnet_dict = torch.hub.load_state_dict_from_url(
-    #    "", file_name="blah/"+str(model_file), progress=True)
-    resnet_dict = torch.load(str(model_file))
-    cnn.load_state_dict(resnet_dict)
-
-    # Remove final classifier layer
-    del cnn.fc
-
-    # Move to GPU and switch to evaluation mode
-    cnn.cuda()
-    cnn.train(False)
-
-    # Create memmaped files
-    # res4f_feats = np.lib.format.open_memmap(
-    #     str(output_prefix) + "-resnet50-res4frelu.npy", mode="w+",
-    #     dtype=np.float16, shape=(len(dataset), 1024, 14, 14))
-    # res5e_feats = np.lib.format.open_memmap(
-    #     str(output_prefix) + "-resnet50-res5erelu.npy", mode="w+",
-    #     dtype=np.float16, shape=(len(dataset), 2048, 7, 7))
-    # pool_feats = np.lib.format.open_memmap(
-    #     str(output_prefix) + "-resnet50-avgpool.npy", mode="w+",
-    #     dtype=np.float16, shape=(len(dataset), 2048))
-
-    n_batches = int(np.ceil(len(dataset) / args.batch_size))
-
-    bs = args.batch_size
-
     img_files = dataset.image_files
+    names = [os.path.splitext(os.path.basename(f))[0] for f in img_files]
+
+    # The manifests only depend on the file list, so they are written upfront
+    for layer in layers:
+        with open(str(dirs[layer]) + ".txt", "w") as fd:
+            for fname in names:
+                fd.write(args.split + "/" + fname + ".npy\n")
+
+    log = ProgressLog(output_folder / (args.split + ".progress"),
+                      {"images": len(dataset), "layers": layers,
+                       "format": args.output_format})
+    resume = args.resume and log.load()
+    if not resume:
+        log.reset()
+
+    store_dir = None
+    if args.output_format == "sharded":
+        store_dir = output_folder / "sharded" / args.split
+        if not resume:
+            remove_store(store_dir)
+
+    todo = log.remaining(len(dataset))
+    if resume:
+        print("Resuming: {} of {} images left.".format(len(todo), len(dataset)))
+
+    # Copy cached features and only compute the misses
+    cache = digests = None
+    if args.cache_dir is not None:
+        cache = FeatureCache(args.cache_dir,
+                             cache_context(model_file, dataset, args),
+                             args.cache_size)
+        store = None
+        if store_dir is not None:
+            store = ShardedFeatureWriter(
+                store_dir, [(layer, LAYERS[layer]) for layer in layers],
+                shard_size=args.shard_size, resume=True, part="cache")
+
+        def write_cached(idx, cached):
+            if store is not None:
+                store.append(names[idx], cached)
+            else:
+                for layer in layers:
+                    save_npy(dirs[layer] / (names[idx] + ".npy"), cached[layer])
+
+        hits, todo, digests = lookup(
+            cache, dataset.image_files, todo, layers, write_cached)
+        if store is not None:
+            store.close()
+        elif hits:
+            sync_dirs(dirs)
+        for start, end in index_runs(hits):
+            log.mark(start, end)
+        print("Feature cache: {} hits, {} misses.".format(len(hits), len(todo)))
+
+    devices = parse_devices(args.devices)
+    chunks = split_work(todo, len(devices))
+    args.model_file = str(model_file)
+    start = time.perf_counter()
+    run_workers(extract, devices, args, dataset, chunks, names, dirs,
+                store_dir, log, cache, digests, cnn)
+    elapsed = time.perf_counter() - start
+    print("Extracted {} images on {} in {:.1f}s ({:.1f} images/s).".format(
+        len(todo), ",".join(devices), elapsed, len(todo) / max(elapsed, 1e-9)))
+
+    if store_dir is not None:
+        # Order the store index as the file list
+        merge_parts(store_dir, names)
 
-    fd_pool = open(str(dir_avgpool) + ".txt", "w")
-    fd_res4f = open(str(dir_res4frelu) + ".txt", "w")
-    fd_res5e = open(str(dir_res5erelu) + ".txt", "w")
 
-    for bidx, batch in enumerate(loader):
-        x = batch.cuda()
-        with torch.no_grad():
-            res4f, res5e, avgpool = resnet_forward(cnn, x)
-
-        pool_feats = avgpool.data.cpu().numpy().astype(np.float16)
-        res4f_feats = res4f.data.cpu().numpy().astype(np.float16)
-        res5e_feats = res5e.data.cpu().numpy().astype(np.float16)
-
-        files = img_files[bidx * bs: (bidx + 1) * bs]
-
-        for i in range(len(files)):
-            fname = os.path.splitext(os.path.basename(files[i]))[0]
-            np.save(dir_avgpool / fname, pool_feats[i])
-            np.save(dir_res4frelu / fname, res4f_feats[i])
-            np.save(dir_res5erelu / fname, res5e_feats[i])
-
-            fd_pool.write(args.split + "/" + fname + ".npy\n")
-            fd_res4f.write(args.split + "/" + fname + ".npy\n")
-            fd_res5e.write(args.split + "/" + fname + ".npy\n")
-
-        print('{:3}/{:3} batches completed.'.format(
-            bidx + 1, n_batches), end='\r')
-        sys.stdout.flush()
-
-    fd_pool.close()
-    fd_res4f.close()
-    fd_res5e.close()
+if __name__ == '__main__':
+    run(parse_args())
@@ -6,8 +6,12 @@ TridentNet Training Script.
 This script is a simplified version of the training script in detectron2/tools.
 """
 import argparse
+from functools import partial
 import os
+import queue
 import sys
+import threading
+import time
 import torch
 # import tqdm
 import cv2
@@ -22,6 +26,7 @@ from detectron2.evaluation import COCOEvaluator, verify_results
 from detectron2.structures import Instances
 
 from utils.utils import mkdir, save_features
+import utils.extract_utils as extract_utils
 from utils.extract_utils import get_image_blob, save_bbox, save_roi_features_by_bbox, save_roi_features, save_scores_and_roi_features
 from utils.progress_bar import ProgressBar
 from models import add_config
@@ -32,6 +37,11 @@ from ray.actor import ActorHandle
 
 from pathlib import Path
 
+from work_queue import ChunkQueue, make_chunks, run_local
+from completion_journal import CompletionJournal
+import npz_codec
+import detection_store
+
 def switch_extract_mode(mode):
     if mode in ['roi_feats','roi_feats_and_confs']:
         switch_cmd = ['MODEL.BUA.EXTRACTOR.MODE', 1]
@@ -83,87 +93,213 @@ def generate_npz(extract_mode, *args):
     else:
         print('Invalid Extract Mode! ')
 
-@ray.remote(num_gpus=1)
-def extract_feat(split_idx, img_list, cfg, args, actor: ActorHandle):
-    num_images = len(img_list)
-    print('Number of images on split{}: {}.'.format(split_idx, num_images))
-
+def build_model(cfg, args):
     model = DefaultTrainer.build_model(cfg)
     DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
         cfg.MODEL.WEIGHTS, resume=args.resume
     )
     model.eval()
+    return model
 
+@ray.remote(num_gpus=1)
+class FeatureExtractor(object):
+    """Holds the model of one GPU, so that it is built only once for all the
+    image lists it extracts."""
+    def __init__(self, cfg, args):
+        self.cfg = cfg
+        self.model = build_model(cfg, args)
+
+    def run_queue(self, worker, chunks, args, actor: ActorHandle):
+        """Extracts chunks pulled from the ``chunks`` queue actor until it
+        is empty."""
+        store = open_store(args, worker)
+        while True:
+            chunk = ray.get(chunks.get.remote(worker))
+            if chunk is None:
+                break
+            start = time.perf_counter()
+            extract_feat(worker, chunk, self.cfg, self.model, args,
+                         actor.update.remote, store)
+            # Waited for, so that the report after this call sees every chunk
+            ray.get(chunks.done.remote(worker, len(chunk), time.perf_counter() - start))
+        if store is not None:
+            store.close()
+
+RemoteChunkQueue = ray.remote(ChunkQueue)
+
+def local_init(devices, cfg, args, worker):
+    """Builds the model of a local worker process on ``devices[worker]``, a
+    GPU id or "cpu"."""
+    device = devices[worker].strip()
+    os.environ['CUDA_VISIBLE_DEVICES'] = "" if device == "cpu" else device
+    if device == "cpu":
+        # MODEL.DEVICE defaults to cuda
+        cfg = cfg.clone()
+        cfg.defrost()
+        cfg.MODEL.DEVICE = "cpu"
+        cfg.freeze()
+    return cfg, build_model(cfg, args), args, open_store(args, worker)
+
+def local_work(state, worker, chunk):
+    cfg, model, args, store = state
+    extract_feat(worker, chunk, cfg, model, args, lambda n: None, store)
+
+def local_exit(state):
+    store = state[3]
+    if store is not None:
+        store.close()
+
+def read_vocab(fname):
+    names = []
+    with open(fname) as f:
+        for line in f.readlines():
+            names.append(line.split(',')[0].lower().strip())
+    return names
+
+def open_store(args, worker):
+    """Opens the part of the detection store written by ``worker``, or
+    returns None if the outputs are only written as .npz files."""
+    if args.output_format != 'store':
+        return None
+    return detection_store.DetectionStoreWriter(
+        detection_store.store_dir(args.output_dir),
+        read_vocab(args.objects_vocab), read_vocab(args.attributes_vocab),
+        chunk_size=args.store_chunk_size, part=str(worker))
+
+def store_detections(store, args, file, arrays):
+    """Appends the detections saved by a saver of extract_utils, which
+    keeps them in its ``info`` dict, to ``store``."""
+    info = arrays.get('info')
+    if info is None:
+        # Boxes only
+        return
+    name = os.path.relpath(str(file), args.output_dir)
+    if name.endswith('.npz'):
+        name = name[:-len('.npz')]
+    attr_ids = attr_scores = None
+    if 'attrs_id' in info:
+        attr_ids = np.asarray(info['attrs_id']).reshape(-1, 1)
+        attr_scores = np.asarray(info['attrs_conf']).reshape(-1, 1)
+    store.append(name, arrays['bbox'], info['objects_conf'], info['objects_id'],
+                 attr_ids, attr_scores)
+
+def load_blob(im_file, cfg, args):
+    """Reads an image and builds its input dict, with the precomputed boxes
+    as proposals in extractor mode 3. Returns ``(None, None)`` for images
+    that cannot be read."""
+    im = cv2.imread(os.path.join(args.image_dir, im_file))
+    if im is None:
+        return None, None
+    dataset_dict = get_image_blob(im, cfg.MODEL.PIXEL_MEAN)
+    if cfg.MODEL.BUA.EXTRACTOR.MODE == 3:
+        bbox = torch.from_numpy(npz_codec.load(os.path.join(args.bbox_dir, im_file.split('.')[0]+'.npz'))['bbox']) * dataset_dict['im_scale']
+        proposals = Instances(dataset_dict['image'].shape[-2:])
+        proposals.proposal_boxes = BUABoxes(bbox)
+        dataset_dict['proposals'] = proposals
+    return im, dataset_dict
+
+def prefetch_blobs(img_list, cfg, args, depth):
+    """Yields ``(im_file, im, dataset_dict)`` for ``img_list`` in order. A
+    background thread decodes the images and builds their blobs, keeping up
+    to ``depth`` of them ready in a queue."""
+    blobs = queue.Queue(maxsize=max(1, depth))
+
+    def produce():
+        try:
+            for im_file in img_list:
+                blobs.put((im_file,) + load_blob(im_file, cfg, args))
+        except Exception as e:
+            blobs.put(e)
+        blobs.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = blobs.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def extract_feat(split_idx, img_list, cfg, model, args, progress, store=None):
+    """Extracts the features of ``img_list``. ``progress(n)`` is called as
+    images are done. Detections are also appended to ``store``, a
+    :class:`detection_store.DetectionStoreWriter`, if given."""
+    num_images = len(img_list)
+    print('Number of images on split{}: {}.'.format(split_idx, num_images))
+
+    mode = cfg.MODEL.BUA.EXTRACTOR.MODE
+    journal = CompletionJournal(args.output_dir)
+    # The savers of extract_utils write with np.savez_compressed
+    extract_utils.np = npz_codec.CodecNumpy(
+        args.codec, None if store is None else partial(store_detections, store, args))
+    todo = []
     for im_file in (img_list):
-        if os.path.exists(os.path.join(args.output_dir, im_file.split('.')[0]+'.npz')):
-            actor.update.remote(1)
+        if mode == 3 and not os.path.exists(os.path.join(args.bbox_dir, im_file.split('.')[0]+'.npz')):
+            progress(1)
             continue
-        im = cv2.imread(os.path.join(args.image_dir, im_file))
+        todo.append(im_file)
+
+    batch_size = max(1, args.images_per_batch)
+    batch = []
+    blobs = prefetch_blobs(todo, cfg, args, 2 * batch_size)
+    for i, (im_file, im, dataset_dict) in enumerate(blobs):
         if im is None:
             print(os.path.join(args.image_dir, im_file), "is illegal!")
-            actor.update.remote(1)
+            progress(1)
+        else:
+            batch.append((im_file, im, dataset_dict))
+        if len(batch) < batch_size and i + 1 < len(todo):
+            continue
+        if not batch:
             continue
-        dataset_dict = get_image_blob(im, cfg.MODEL.PIXEL_MEAN)
-        # extract roi features
-        if cfg.MODEL.BUA.EXTRACTOR.MODE == 1:
+
+        dataset_dicts = [dataset_dict for _, _, dataset_dict in batch]
+        # extract roi features, directly (mode 1) or by bbox (mode 3)
+        if mode in (1, 3):
             attr_scores = None
             with torch.set_grad_enabled(False):
                 if cfg.MODEL.BUA.ATTRIBUTE_ON:
-                    boxes, scores, features_pooled, attr_scores = model([dataset_dict])
+                    boxes, scores, features_pooled, attr_scores = model(dataset_dicts)
                 else:
-                    boxes, scores, features_pooled = model([dataset_dict])
+                    boxes, scores, features_pooled = model(dataset_dicts)
             boxes = [box.tensor.cpu() for box in boxes]
             scores = [score.cpu() for score in scores]
             features_pooled = [feat.cpu() for feat in features_pooled]
             if not attr_scores is None:
-                attr_scores = [attr_score.cpu() for attr_score in attr_scores]
+                attr_scores = [attr_score.data.cpu() for attr_score in attr_scores]
 
-            if args.extract_mode == "roi_feats":
-                generate_npz(1, args, cfg, im_file, im, dataset_dict, 
-                             boxes, scores, features_pooled, attr_scores)
+            if mode == 3:
+                npz_mode = 3
+            elif args.extract_mode == "roi_feats":
+                npz_mode = 1
             elif args.extract_mode == "roi_feats_and_confs":
-                generate_npz(4, args, cfg, im_file, im, dataset_dict, 
-                             boxes, scores, features_pooled, attr_scores)
+                npz_mode = 4
             else:
                 raise(ValueError("args.extract_mode"))
+            # generate_npz expects the outputs of a single image batch
+            for j, (im_file, im, dataset_dict) in enumerate(batch):
+                generate_npz(npz_mode, args, cfg, im_file, im, dataset_dict,
+                             boxes[j:j+1], scores[j:j+1], features_pooled[j:j+1],
+                             None if attr_scores is None else attr_scores[j:j+1])
+                journal.commit(im_file.split('.')[0]+'.npz')
         # extract bbox only
-        elif cfg.MODEL.BUA.EXTRACTOR.MODE == 2:
+        elif mode == 2:
             with torch.set_grad_enabled(False):
-                boxes, scores = model([dataset_dict])
+                boxes, scores = model(dataset_dicts)
             boxes = [box.cpu() for box in boxes]
             scores = [score.cpu() for score in scores]
-            generate_npz(2,
-                args, cfg, im_file, im, dataset_dict, 
-                boxes, scores)
-        # extract roi features by bbox
-        elif cfg.MODEL.BUA.EXTRACTOR.MODE == 3:
-            if not os.path.exists(os.path.join(args.bbox_dir, im_file.split('.')[0]+'.npz')):
-                actor.update.remote(1)
-                continue
-            bbox = torch.from_numpy(np.load(os.path.join(args.bbox_dir, im_file.split('.')[0]+'.npz'))['bbox']) * dataset_dict['im_scale']
-            proposals = Instances(dataset_dict['image'].shape[-2:])
-            proposals.proposal_boxes = BUABoxes(bbox)
-            dataset_dict['proposals'] = proposals
-
-            attr_scores = None
-            with torch.set_grad_enabled(False):
-                if cfg.MODEL.BUA.ATTRIBUTE_ON:
-                    boxes, scores, features_pooled, attr_scores = model([dataset_dict])
-                else:
-                    boxes, scores, features_pooled = model([dataset_dict])
-            boxes = [box.tensor.cpu() for box in boxes]
-            scores = [score.cpu() for score in scores]
-            features_pooled = [feat.cpu() for feat in features_pooled]
-            if not attr_scores is None:
-                attr_scores = [attr_score.data.cpu() for attr_score in attr_scores]
-            generate_npz(3, 
-                args, cfg, im_file, im, dataset_dict, 
-                boxes, scores, features_pooled, attr_scores)
+            for j, (im_file, im, dataset_dict) in enumerate(batch):
+                generate_npz(2,
+                    args, cfg, im_file, im, dataset_dict,
+                    boxes[j:j+1], scores[j:j+1])
+                journal.commit(im_file.split('.')[0]+'.npz')
 
-        actor.update.remote(1)
+        progress(len(batch))
+        batch = []
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="PyTorch Object Detection2 Inference")
     parser.add_argument(
         "--config-file",
@@ -188,9 +324,28 @@ def main():
     parser.add_argument('--min-max-boxes', default='min_max_default', type=str, 
                         help='the number of min-max boxes of extractor')
 
+    parser.add_argument('--images-per-batch', default=1, type=int,
+                        help='number of images per forward pass')
+    parser.add_argument('--chunk-size', default=32, type=int,
+                        help='number of images workers take from the shared '
+                        'queue at a time')
+    parser.add_argument('--scheduler', default='ray', choices=['ray', 'local'],
+                        help="'ray' serves the queue from a Ray actor, "
+                        "'local' from a multiprocessing queue feeding one "
+                        "worker process per id in --gpus, which may be 'cpu'")
+
     parser.add_argument('--output-dir', dest='output_dir',
                         help='output directory for features',
                         default="features")
+    parser.add_argument('--codec', default='zlib', choices=npz_codec.CODECS,
+                        help='compression of the output .npz files')
+    parser.add_argument('--output-format', default='npz', choices=['npz', 'store'],
+                        help="'store' also appends the detections to a "
+                        "columnar store in <output-dir>.store; the .npz "
+                        "files keep the RoI features")
+    parser.add_argument('--store-chunk-size', type=int,
+                        default=detection_store.DEFAULT_CHUNK_SIZE,
+                        help='images per chunk of the store')
     parser.add_argument('--image-dir', dest='image_dir',
                         help='directory with images',
                         default="image")
@@ -218,28 +373,44 @@ def main():
         nargs=argparse.REMAINDER,
     )
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
 
+def model_key(args):
+    """Arguments that determine the models started by :func:`load_model`."""
+    return (os.path.realpath(args.config_file), args.mode, args.extract_mode,
+            args.min_max_boxes, tuple(args.opts), args.gpu_id, args.num_cpus,
+            args.resume, args.scheduler)
+
+def load_model(args, num_workers=None):
+    """Sets up the config and starts one :class:`FeatureExtractor` per GPU,
+    or on the first ``num_workers`` GPUs only. Returns ``(cfg, extractors)``.
+    The local scheduler starts its own worker processes for every run, so
+    ``extractors`` is ``None``."""
     cfg = setup(args)
+    if args.scheduler == "local":
+        return cfg, None
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
     num_gpus = len(args.gpu_id.split(','))
-
-    MIN_BOXES = cfg.MODEL.BUA.EXTRACTOR.MIN_BOXES
-    MAX_BOXES = cfg.MODEL.BUA.EXTRACTOR.MAX_BOXES
-    CONF_THRESH = cfg.MODEL.BUA.EXTRACTOR.CONF_THRESH
-
+    if num_workers is not None:
+        num_gpus = min(num_gpus, num_workers)
+
+    if not ray.is_initialized():
+        if args.num_cpus != 0:
+            ray.init(num_cpus=args.num_cpus)
+        else:
+            ray.init()
+    return cfg, [FeatureExtractor.remote(cfg, args) for i in range(num_gpus)]
+
+def run(args, model=None):
+    """Extracts the features of one image list. ``model`` is an optional
+    ``(cfg, extractors)`` pair returned by :func:`load_model` for the same
+    arguments."""
     # Load classes
-    classes = [] # ['__background__']
-    with open(args.objects_vocab) as f:
-        for object in f.readlines():
-            classes.append(object.split(',')[0].lower().strip())
+    classes = read_vocab(args.objects_vocab) # ['__background__']
 
     # Load attributes
-    attributes = [] # ['__no_attribute__']
-    with open(args.attributes_vocab) as f:
-        for att in f.readlines():
-            attributes.append(att.split(',')[0].lower().strip())
+    attributes = read_vocab(args.attributes_vocab) # ['__no_attribute__']
 
     os.makedirs(args.output_dir, exist_ok=True)
 
@@ -255,43 +426,91 @@ def main():
     print('Number of images: {}.'.format(num_images))
 
     if num_images == 0:
-        exit()
+        return
 
     npsfile = args.output_dir
     npsfile = npsfile[:-1] if npsfile.endswith("/") else npsfile
     base_dir = os.path.basename(npsfile)
     npsfile = npsfile + ".txt"
-    if os.path.exists(npsfile):
-        print("File exists {}".format(npsfile))
-        exit()
     fd_list = open(npsfile, "w")
     for imfile in imglist:
         ofile = base_dir + "/" + os.path.splitext(imfile)[0] + ".npz\n"
         fd_list.write(ofile)
     fd_list.close()
 
+    # Find the images left with one scan of the outputs, before any model
+    # is loaded
+    journal = CompletionJournal(args.output_dir)
+    journal.load()
+    imglist = [im_file for im_file in imglist
+               if im_file.split('.')[0]+'.npz' not in journal]
+    if args.output_format == 'store':
+        # Images whose detections were not flushed to the store are redone
+        store = detection_store.store_dir(args.output_dir)
+        detection_store.merge_parts(store)
+        stored = detection_store.stored_names(store)
+        imglist = [im_file for im_file in imglist
+                   if im_file.split('.')[0] not in stored]
+    print('Images left: {} of {}.'.format(len(imglist), num_images))
+    if not imglist:
+        return
+
+    # Workers pull chunks as they go, so faster workers take more of them.
+    # Only as many workers as there are chunks left are started.
+    chunks = make_chunks(imglist, args.chunk_size)
+    devices = args.gpu_id.split(',')
+    num_gpus = min(len(devices), len(chunks))
+
+    if model is None:
+        model = load_model(args, num_gpus)
+    cfg, extractors = model
+
+    MIN_BOXES = cfg.MODEL.BUA.EXTRACTOR.MIN_BOXES
+    MAX_BOXES = cfg.MODEL.BUA.EXTRACTOR.MAX_BOXES
+    CONF_THRESH = cfg.MODEL.BUA.EXTRACTOR.CONF_THRESH
+
     # Save class and attribute names to file
     np.savez_compressed(
         os.path.splitext(npsfile)[0] + "_info.npz",
         classes=classes, attributes=attributes, cfg=cfg, args=args) #info={'cfg':cfg, 'args':args})
 
-    if args.num_cpus != 0:
-        ray.init(num_cpus=args.num_cpus)
-    else:
-        ray.init()
-    img_lists = [imglist[i::num_gpus] for i in range(num_gpus)]
+    print('Number of GPUs: {} of {}.'.format(num_gpus, len(devices)))
+
+    if extractors is None:
+        done = [0]
+
+        def progress(n):
+            done[0] += n
+            print('{}/{} images done.'.format(done[0], len(imglist)), end='\r')
+            sys.stdout.flush()
+
+        throughput = run_local(partial(local_init, devices, cfg, args),
+                               local_work, chunks, num_gpus, progress,
+                               local_exit)
+        print()
+        print(throughput.report())
+        if args.output_format == 'store':
+            detection_store.merge_parts(store)
+        return
 
     pb = ProgressBar(len(imglist))
     actor = pb.actor
 
-    print('Number of GPUs: {}.'.format(num_gpus))
+    chunk_queue = RemoteChunkQueue.remote(chunks)
     extract_feat_list = []
-    for i in range(num_gpus):
-        extract_feat_list.append(extract_feat.remote(i, img_lists[i], cfg, args, actor))
+    # Extractors of a shared model without a chunk to pull are left idle
+    for i, extractor in enumerate(extractors[:num_gpus]):
+        extract_feat_list.append(extractor.run_queue.remote(i, chunk_queue, args, actor))
     
     pb.print_until_done()
     ray.get(extract_feat_list)
     ray.get(actor.get_counter.remote())
+    print(ray.get(chunk_queue.report.remote()))
+    if args.output_format == 'store':
+        detection_store.merge_parts(store)
+
+def main():
+    run(parse_args())
 
 if __name__ == "__main__":
     main()
@@ -3,6 +3,7 @@
 import argparse
 from pathlib import Path
 import os, sys
+import time
 
 import numpy as np
 
@@ -12,9 +13,16 @@ import torch
 from torch.autograd import Variable
 import torch.utils.data as data
 
-from torchvision.models import resnet50
 from torchvision import transforms
 
+from resnet50_utils import add_loader_args, build_loader, PipelineStats, AsyncWriter, FusedTransfer
+from resnet50_utils import LAYERS, add_layers_arg, resnet_forward
+from resnet50_utils import ProgressLog, add_resume_arg, index_runs
+from resnet50_utils import add_device_args, parse_devices, build_cnn, split_work, run_workers
+from resnet50_utils import configure_threads, inference_mode, cache_context
+
+from feature_cache import FeatureCache, add_cache_args, lookup
+
 # Note: from https://github.com/multi30k/dataset/blob/master/scripts/feature-extractor
 # This script uses the PyTorch's pre-trained ResNet-50 CNN to extract
 #   res4f_relu convolutional features of size 1024x14x14
@@ -84,20 +92,85 @@ class ImageFolderDataset(data.Dataset):
         return len(self.image_files)
 
 
-def resnet_forward(cnn, x):
-    x = cnn.conv1(x)
-    x = cnn.bn1(x)
-    x = cnn.relu(x)
-    x = cnn.maxpool(x)
+def extract(rank, devices, args, dataset, chunks, paths, log, cache, digests):
+    """Extracts the features of the images ``chunks[rank]`` on
+    ``devices[rank]`` and writes them at their rows of the memmaps."""
+    device = devices[rank]
+    todo = chunks[rank]
+    layers = args.layers
+    if not todo:
+        return
+    if len(devices) > 1:
+        log.part = rank
+
+    configure_threads(args, devices)
+    print('Creating CNN instance on {} ({} threads).'.format(
+        device, torch.get_num_threads()))
+    cnn = build_cnn(args.model_file, layers, device, args.channels_last)
+    use_cuda = torch.device(device).type == "cuda"
 
-    x = cnn.layer1(x)
-    x = cnn.layer2(x)
-    res4f_relu = cnn.layer3(x)
-    res5e_relu = cnn.layer4(res4f_relu)
+    feats = {layer: np.lib.format.open_memmap(paths[layer], mode="r+")
+             for layer in layers}
 
-    avgp = cnn.avgpool(res5e_relu)
-    avgp = torch.flatten(avgp, 1)
-    return res4f_relu, res5e_relu, avgp
+    loader = build_loader(data.Subset(dataset, todo), args, use_cuda)
+
+    n_batches = int(np.ceil(len(todo) / args.batch_size))
+
+    bs = args.batch_size
+
+    def write_batch(indices, outputs, ready=None):
+        if ready is not None:
+            ready.synchronize()
+        runs = index_runs(indices)
+        for layer, out in zip(layers, outputs):
+            # Already float16 on the fused path, written without a copy
+            out = out.numpy().astype(np.float16, copy=False)
+            pos = 0
+            for start, end in runs:
+                feats[layer][start:end] = out[pos:pos + end - start]
+                pos += end - start
+            feats[layer].flush()
+            if cache is not None:
+                for i, idx in enumerate(indices):
+                    cache.put(digests[idx], layer, out[i])
+        for start, end in runs:
+            log.mark(start, end)
+
+    transfer = None
+    if args.fused_transfer:
+        transfer = FusedTransfer(
+            [LAYERS[layer] for layer in layers], bs, device,
+            num_buffers=args.write_queue + 2)
+
+    prefix = "[{}] ".format(device) if len(devices) > 1 else ""
+
+    stats = PipelineStats()
+    with AsyncWriter(write_batch, args.write_queue) as writer:
+        for bidx, batch in enumerate(stats.iterate(loader)):
+            x = batch.to(device, non_blocking=True)
+            if args.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            with inference_mode():
+                outputs = resnet_forward(cnn, x, layers)
+            outputs = [outputs[layer].contiguous() for layer in layers]
+
+            indices = todo[bidx * bs: (bidx + 1) * bs]
+            if transfer is not None:
+                outputs, ready = transfer(outputs)
+                writer.put(indices, outputs, ready)
+            else:
+                writer.put(indices, [out.cpu() for out in outputs])
+
+            print('{}{:3}/{:3} batches completed.'.format(
+                prefix, bidx + 1, n_batches), end='\r')
+            sys.stdout.flush()
+
+    print()
+    stats.report(writer)
+
+    # Save the files
+    for layer in layers:
+        feats[layer].flush()
 
 
 if __name__ == '__main__':
@@ -114,6 +187,11 @@ if __name__ == '__main__':
     
     parser.add_argument('-o', '--output-prefix', type=str, required=True,
                         help='Output file prefix. Ex: out/train/resnet50')
+    add_layers_arg(parser)
+    add_loader_args(parser)
+    add_resume_arg(parser)
+    add_device_args(parser)
+    add_cache_args(parser)
 
     # Parse arguments
     args = parser.parse_args()
@@ -122,6 +200,7 @@ if __name__ == '__main__':
     file_names = Path(args.file_names).expanduser().resolve()
     output_prefix = Path(args.output_prefix).expanduser().resolve()
     model_file = Path(args.model_file).expanduser().resolve()
+    layers = args.layers
 
     print("Output folder: %s" % str(output_prefix.parent))
     os.makedirs(output_prefix.parent, exist_ok=True)
@@ -134,52 +213,61 @@ if __name__ == '__main__':
                                  resize=256, crop=224)
     print('Image folder: %s' % args.image_folder)
 
-    loader = data.DataLoader(dataset, batch_size=args.batch_size)
-
-    print('Creating CNN instance.')
-    cnn = resnet50(pretrained=False)
-    #resnet_dict = torch.hub.load_state_dict_from_url(
-    #    "", file_name="blah/"+str(model_file), progress=True)
-    resnet_dict = torch.load(str(model_file))
-    cnn.load_state_dict(resnet_dict)
-
-    # Remove final classifier layer
-    del cnn.fc
-
-    # Move to GPU and switch to evaluation mode
-    cnn.cuda()
-    cnn.train(False)
-
-    # Create memmaped files
-    res4f_feats = np.lib.format.open_memmap(
-        str(output_prefix) + "-resnet50-res4frelu.npy", mode="w+",
-        dtype=np.float16, shape=(len(dataset), 1024, 14, 14))
-    res5e_feats = np.lib.format.open_memmap(
-        str(output_prefix) + "-resnet50-res5erelu.npy", mode="w+",
-        dtype=np.float16, shape=(len(dataset), 2048, 7, 7))
-    pool_feats = np.lib.format.open_memmap(
-        str(output_prefix) + "-resnet50-avgpool.npy", mode="w+",
-        dtype=np.float16, shape=(len(dataset), 2048))
-
-    n_batches = int(np.ceil(len(dataset) / args.batch_size))
-
-    bs = args.batch_size
-
-    for bidx, batch in enumerate(loader):
-        x = batch.cuda()
-        with torch.no_grad():
-            res4f, res5e, avgpool = resnet_forward(cnn, x)
-
-        pool_feats[bidx * bs: (bidx + 1) * bs] = avgpool.data.cpu().numpy().astype(np.float16)
-        res4f_feats[bidx * bs: (bidx + 1) * bs] = res4f.data.cpu().numpy().astype(np.float16)
-        res5e_feats[bidx * bs: (bidx + 1) * bs] = res5e.data.cpu().numpy().astype(np.float16)
-
-        print('{:3}/{:3} batches completed.'.format(
-            bidx + 1, n_batches), end='\r')
-        sys.stdout.flush()
-
-    # Save the files
-    res4f_feats.flush()
-    res5e_feats.flush()
-    pool_feats.flush()
- 
+    # Create memmaped files, or reopen them when resuming
+    paths = {layer: str(output_prefix) + "-resnet50-" + layer + ".npy"
+             for layer in layers}
+    log = ProgressLog(str(output_prefix) + "-resnet50.progress",
+                      {"images": len(dataset), "layers": layers})
+    resume = args.resume and log.load() and \
+        all(os.path.exists(path) for path in paths.values())
+
+    for layer in layers:
+        shape = (len(dataset),) + LAYERS[layer]
+        if resume:
+            feats = np.lib.format.open_memmap(paths[layer], mode="r")
+            assert feats.shape == shape, \
+                "{} has shape {}, expected {}".format(
+                    paths[layer], feats.shape, shape)
+        else:
+            feats = np.lib.format.open_memmap(
+                paths[layer], mode="w+", dtype=np.float16, shape=shape)
+        del feats
+    if not resume:
+        log.reset()
+
+    todo = log.remaining(len(dataset))
+    if resume:
+        print("Resuming: {} of {} images left.".format(len(todo), len(dataset)))
+
+    # Copy cached features and only compute the misses
+    cache = digests = None
+    if args.cache_dir is not None:
+        cache = FeatureCache(args.cache_dir,
+                             cache_context(model_file, dataset, args),
+                             args.cache_size)
+        feats = {layer: np.lib.format.open_memmap(paths[layer], mode="r+")
+                 for layer in layers}
+
+        def write_cached(idx, cached):
+            for layer in layers:
+                feats[layer][idx] = cached[layer]
+
+        hits, todo, digests = lookup(
+            cache, dataset.image_files, todo, layers, write_cached)
+        for layer in layers:
+            feats[layer].flush()
+        del feats
+        for start, end in index_runs(hits):
+            log.mark(start, end)
+        print("Feature cache: {} hits, {} misses.".format(len(hits), len(todo)))
+
+    # Every device gets a contiguous block of rows of the same memmaps
+    devices = parse_devices(args.devices)
+    chunks = split_work(todo, len(devices))
+    args.model_file = str(model_file)
+    start = time.perf_counter()
+    run_workers(extract, devices, args, dataset, chunks, paths, log,
+                cache, digests)
+    elapsed = time.perf_counter() - start
+    print("Extracted {} images on {} in {:.1f}s ({:.1f} images/s).".format(
+        len(todo), ",".join(devices), elapsed, len(todo) / max(elapsed, 1e-9)))
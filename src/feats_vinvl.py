@@ -3,10 +3,14 @@
 import cv2
 import os.path as op
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import json
-import numpy as np
 import os
 from pathlib import Path
+import time
+
+import torch
 
 from scene_graph_benchmark.scene_parser import SceneParser
 from scene_graph_benchmark.AttrRCNN import AttrRCNN
@@ -18,10 +22,18 @@ from maskrcnn_benchmark.data.datasets.utils.load_files import \
     config_dataset_file
 from maskrcnn_benchmark.data.datasets.utils.load_files import load_labelmap_file
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
+from maskrcnn_benchmark.structures.image_list import to_image_list
 
-from tools.demo.detect_utils import detect_objects_on_single_image
+from tools.demo.detect_utils import detect_objects_on_single_image, cv2Img_to_Image
 from tools.demo.visual_utils import draw_bb, draw_rel
 
+from completion_journal import CompletionJournal
+import npz_codec
+import detection_store
+
+# Attribute names merged into another one by postprocess_attr
+ATTR_ALIASES = {'blonde': 'blond'}
+
 
 def postprocess_attr(dataset_attr_labelmap, label_list, conf_list):
     common_attributes = {
@@ -29,7 +41,7 @@ def postprocess_attr(dataset_attr_labelmap, label_list, conf_list):
         'wood', 'orange', 'gray', 'grey', 'metal', 'pink', 'tall', 'long', 'dark', 'purple'
     }
     common_attributes_thresh = 0.1
-    attr_alias_dict = {'blonde': 'blond'}
+    attr_alias_dict = ATTR_ALIASES
     attr_dict = {}
     for label, conf in zip(label_list, conf_list):
         label = dataset_attr_labelmap[label]
@@ -51,7 +63,111 @@ def postprocess_attr(dataset_attr_labelmap, label_list, conf_list):
         return [[], []]
 
 
-def main():
+# Number of batches whose images are sorted by size together
+BUCKET_WINDOW = 8
+
+
+def read_image(image_file, transforms):
+    """Reads an image and applies the test transforms. Runs in the prefetch
+    workers."""
+    cv2_img = cv2.imread(image_file)
+    if cv2_img is None:
+        return None, None
+    img_input, _ = transforms(cv2Img_to_Image(cv2_img), target=None)
+    return cv2_img, img_input
+
+
+def prefetch(fn, items, num_workers, depth):
+    """Yields ``(item, fn(item))`` in order, with up to ``depth`` results
+    computed ahead by a pool of ``num_workers`` threads."""
+    with ThreadPoolExecutor(max(1, num_workers)) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def prediction_to_dets(prediction, cv2_img):
+    """Converts the prediction of one image of a batch to the detections
+    returned by ``detect_objects_on_single_image``."""
+    prediction = prediction.to(torch.device("cpu"))
+    img_height, img_width = cv2_img.shape[:2]
+    prediction = prediction.resize((img_width, img_height))
+    boxes = prediction.bbox.tolist()
+    classes = prediction.get_field("labels").tolist()
+    scores = prediction.get_field("scores").tolist()
+
+    if "attr_scores" in prediction.extra_fields:
+        attr_scores = prediction.get_field("attr_scores")
+        attr_labels = prediction.get_field("attr_labels")
+        return [
+            {"rect": box, "class": cls, "conf": score,
+             "attr": attr[attr_conf > 0.01].tolist(),
+             "attr_conf": attr_conf[attr_conf > 0.01].tolist()}
+            for box, cls, score, attr, attr_conf in
+            zip(boxes, classes, scores, attr_labels, attr_scores)
+        ]
+
+    return [
+        {"rect": box, "class": cls, "conf": score}
+        for box, cls, score in zip(boxes, classes, scores)
+    ]
+
+
+def detect_images(detector, todo, images_per_batch, num_workers):
+    """Yields ``(image_file, npz_file, dets)`` for the ``(image_file,
+    npz_file)`` pairs of ``todo`` whose image can be read.
+
+    Images are read and transformed ahead by a pool of workers and go
+    through the model ``images_per_batch`` at a time. To limit padding, the
+    images of a window of several batches are sorted by size before they
+    are split into batches, so detections may come out of order. Batches of
+    one image are neither sorted nor padded, as before batching."""
+    cfg = detector.cfg
+    model = detector.model
+    window = max(1, images_per_batch) * BUCKET_WINDOW
+
+    # A single image is not padded, as in detect_objects_on_single_image
+    size_divisible = cfg.DATALOADER.SIZE_DIVISIBILITY if images_per_batch > 1 else 0
+
+    def run_window(pending):
+        if images_per_batch > 1:
+            pending.sort(key=lambda p: tuple(p[2].shape[-2:]))
+        for i in range(0, len(pending), images_per_batch):
+            batch = pending[i:i + images_per_batch]
+            images = to_image_list([img_input for _, _, img_input in batch],
+                                   size_divisible)
+            with torch.no_grad():
+                predictions = model(images.to(cfg.MODEL.DEVICE))
+            for ((image_file, npz_file), cv2_img, _), prediction in \
+                    zip(batch, predictions):
+                yield image_file, npz_file, prediction_to_dets(prediction, cv2_img)
+
+    loaded = prefetch(lambda item: read_image(item[0], detector.transforms),
+                      todo, num_workers, window + num_workers)
+    pending = []
+    for (image_file, npz_file), (cv2_img, img_input) in loaded:
+        if cv2_img is None:
+            print("Bad image file: {}. Skipping.".format(image_file))
+            continue
+        if isinstance(model, SceneParser):
+            # Relation detection is only supported one image at a time
+            yield image_file, npz_file, detect_objects_on_single_image(
+                model, detector.transforms, cv2_img)
+            continue
+        pending.append(((image_file, npz_file), cv2_img, img_input))
+        if len(pending) == window:
+            yield from run_window(pending)
+            pending = []
+    yield from run_window(pending)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Object Detection Demo")
     parser.add_argument("--config-file", metavar="FILE",
                         help="path to config file")
@@ -59,54 +175,92 @@ def main():
     parser.add_argument("--output-dir", help="output directory for features")
     parser.add_argument("--image-dir", help="input directory with images")
     parser.add_argument("--file-list", help="list of image files")
+    parser.add_argument("--images-per-batch", type=int, default=1,
+                        help="number of images per forward pass, batches "
+                        "are formed from images of similar size")
+    parser.add_argument("--num-workers", type=int, default=4,
+                        help="threads reading and transforming images ahead "
+                        "of the model")
+    parser.add_argument("--codec", choices=npz_codec.CODECS, default="zlib",
+                        help="compression of the output .npz files")
+    parser.add_argument("--output-format", choices=["npz", "store"],
+                        default="npz",
+                        help="'npz' writes one file per image, 'store' "
+                        "appends the detections to a columnar store in "
+                        "<output-dir>.store")
+    parser.add_argument("--chunk-size", type=int,
+                        default=detection_store.DEFAULT_CHUNK_SIZE,
+                        help="images per chunk of the store")
     
     parser.add_argument("opts", default=None, nargs=argparse.REMAINDER,
                         help="Modify config options using the command-line")
 
-    args = parser.parse_args()
-    cfg.set_new_allowed(True)
-    cfg.merge_from_other_cfg(sg_cfg)
-    cfg.set_new_allowed(False)
-    cfg.merge_from_file(args.config_file)
-    cfg.merge_from_list(args.opts)
-    cfg.freeze()
+    return parser.parse_args(argv)
 
-    output_dir = cfg.OUTPUT_DIR
-    mkdir(output_dir)
 
-    mkdir(args.output_dir)
+def model_key(args):
+    """Arguments that determine the model built by :func:`load_model`."""
+    return (op.realpath(args.config_file), tuple(args.opts))
 
-    if cfg.MODEL.META_ARCHITECTURE == "SceneParser":
-        model = SceneParser(cfg)
-    elif cfg.MODEL.META_ARCHITECTURE == "AttrRCNN":
-        model = AttrRCNN(cfg)
-    model.to(cfg.MODEL.DEVICE)
-    model.eval()
-
-    checkpointer = DetectronCheckpointer(cfg, model, save_dir=output_dir)
-    checkpointer.load(cfg.MODEL.WEIGHT)
-
-    # dataset labelmap is used to convert the prediction to class labels
-    dataset_labelmap_file = config_dataset_file(cfg.DATA_DIR,
-                                                cfg.DATASETS.LABELMAP_FILE)
-    assert dataset_labelmap_file
-    dataset_allmap = json.load(open(dataset_labelmap_file, 'r'))
-    dataset_labelmap = {int(val): key
-                        for key, val in dataset_allmap['label_to_idx'].items()}
-    # visual_labelmap is used to select classes for visualization
-    visual_labelmap = None
 
-    if cfg.MODEL.ATTRIBUTE_ON:
-        dataset_attr_labelmap = {
-            int(val): key for key, val in
-            dataset_allmap['attribute_to_idx'].items()}
-    
-    if cfg.MODEL.RELATION_ON:
-        dataset_relation_labelmap = {
-            int(val): key for key, val in
-            dataset_allmap['predicate_to_idx'].items()}
+class Detector(object):
+    """Model, transforms and label maps built from a config, which can be
+    reused for several image lists."""
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+        mkdir(cfg.OUTPUT_DIR)
+
+        if cfg.MODEL.META_ARCHITECTURE == "SceneParser":
+            model = SceneParser(cfg)
+        elif cfg.MODEL.META_ARCHITECTURE == "AttrRCNN":
+            model = AttrRCNN(cfg)
+        model.to(cfg.MODEL.DEVICE)
+        model.eval()
+
+        checkpointer = DetectronCheckpointer(cfg, model, save_dir=cfg.OUTPUT_DIR)
+        checkpointer.load(cfg.MODEL.WEIGHT)
+        self.model = model
 
-    transforms = build_transforms(cfg, is_train=False)
+        # dataset labelmap is used to convert the prediction to class labels
+        dataset_labelmap_file = config_dataset_file(cfg.DATA_DIR,
+                                                    cfg.DATASETS.LABELMAP_FILE)
+        assert dataset_labelmap_file
+        dataset_allmap = json.load(open(dataset_labelmap_file, 'r'))
+        self.dataset_labelmap = {int(val): key
+                                 for key, val in dataset_allmap['label_to_idx'].items()}
+
+        self.dataset_attr_labelmap = None
+        if cfg.MODEL.ATTRIBUTE_ON:
+            self.dataset_attr_labelmap = {
+                int(val): key for key, val in
+                dataset_allmap['attribute_to_idx'].items()}
+
+        self.dataset_relation_labelmap = None
+        if cfg.MODEL.RELATION_ON:
+            self.dataset_relation_labelmap = {
+                int(val): key for key, val in
+                dataset_allmap['predicate_to_idx'].items()}
+
+        self.transforms = build_transforms(cfg, is_train=False)
+
+
+def load_model(args):
+    # Work on a copy, the global config can only be merged into once
+    model_cfg = cfg.clone()
+    model_cfg.set_new_allowed(True)
+    model_cfg.merge_from_other_cfg(sg_cfg)
+    model_cfg.set_new_allowed(False)
+    model_cfg.merge_from_file(args.config_file)
+    model_cfg.merge_from_list(args.opts)
+    model_cfg.freeze()
+    return Detector(model_cfg)
+
+
+def run(args, detector=None):
+    """Detects the objects of one image list. ``detector`` is an optional
+    model returned by :func:`load_model` for the same arguments."""
+    mkdir(args.output_dir)
 
     imglist = []
     with Path(args.file_list).open() as f:
@@ -121,6 +275,15 @@ def main():
     fd_list = open(args.output_dir + ".txt", "w")
     listdir = op.basename(args.output_dir)
 
+    if args.output_format == "store":
+        store = detection_store.store_dir(args.output_dir)
+        detection_store.merge_parts(store)
+        done = detection_store.stored_names(store)
+    else:
+        journal = CompletionJournal(args.output_dir)
+        done = journal.load()
+
+    todo = []
     for imgfile in imglist:
 
         image_file = op.join(args.image_dir, imgfile)
@@ -130,19 +293,46 @@ def main():
         assert op.isfile(image_file), \
             "Image: {} does not exist".format(image_file)
 
-        if op.isfile(npz_file):
-            print("Output exists: {}. Skipping.".format(npz_file))
+        name = op.splitext(imgfile)[0]
+        if (name if args.output_format == "store" else name + ".npz") in done:
             continue
 
-        cv2_img = cv2.imread(image_file)
+        todo.append((image_file, npz_file))
+    fd_list.close()
 
-        if cv2_img is None:
-            print("Bad image file: {}. Skipping.".format(image_file))
-            continue
+    print("Images left: {} of {}.".format(len(todo), num_images))
+    if not todo:
+        return
 
-        print("Processing {}.".format(image_file))
+    if detector is None:
+        detector = load_model(args)
+    cfg = detector.cfg
+    model = detector.model
+    dataset_labelmap = detector.dataset_labelmap
+    dataset_attr_labelmap = detector.dataset_attr_labelmap
+    dataset_relation_labelmap = detector.dataset_relation_labelmap
+    # visual_labelmap is used to select classes for visualization
+    visual_labelmap = None
+
+    if args.output_format == "store":
+        classes = [dataset_labelmap[i] for i in sorted(dataset_labelmap)]
+        attributes = []
+        if dataset_attr_labelmap is not None:
+            attributes = [dataset_attr_labelmap[i] for i in sorted(dataset_attr_labelmap)]
+            attributes += [a for a in sorted(set(ATTR_ALIASES.values()))
+                           if a not in attributes]
+        class_index = {c: i for i, c in enumerate(classes)}
+        attr_index = {a: i for i, a in enumerate(attributes)}
+        # The .npz outputs hold the scores as float64 lists
+        writer = detection_store.DetectionStoreWriter(
+            store, classes, attributes, chunk_size=args.chunk_size,
+            score_dtype="float64")
 
-        dets = detect_objects_on_single_image(model, transforms, cv2_img)
+    start = time.perf_counter()
+    for image_file, npz_file, dets in detect_images(
+            detector, todo, args.images_per_batch, args.num_workers):
+
+        print("Processing {}.".format(image_file))
 
         if isinstance(model, SceneParser):
             rel_dets = dets['relations']
@@ -178,22 +368,37 @@ def main():
         #print("OUTPUT:", args.output_dir)
         #print("ATTR vis:", cfg.MODEL.ATTRIBUTE_ON)
 
-        if cfg.MODEL.ATTRIBUTE_ON:
-            np.savez_compressed(
-                npz_file,
-                rects=rects,
-                objects_scores=scores,
-                objects=[d["class"] for d in dets],
-                attrs_scores = attr_scores,
-                attrs = attr_labels            
-            )
-        else:
-            np.savez_compressed(
-                npz_file,
-                rects=rects,
-                objects_scores=scores,
-                objects=[d["class"] for d in dets]
-            )
+        if args.output_format == "store":
+            writer.append(
+                op.relpath(op.splitext(npz_file)[0], args.output_dir),
+                rects, scores, [class_index[d["class"]] for d in dets],
+                [[attr_index[a] for a in d["attr"]] for d in dets]
+                if cfg.MODEL.ATTRIBUTE_ON else None,
+                attr_scores if cfg.MODEL.ATTRIBUTE_ON else None)
+            continue
+
+        # Written under a temporary name, so an interrupted run never
+        # leaves a partial output behind
+        tmp_file = npz_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            if cfg.MODEL.ATTRIBUTE_ON:
+                npz_codec.save(
+                    f, args.codec,
+                    rects=rects,
+                    objects_scores=scores,
+                    objects=[d["class"] for d in dets],
+                    attrs_scores = attr_scores,
+                    attrs = attr_labels            
+                )
+            else:
+                npz_codec.save(
+                    f, args.codec,
+                    rects=rects,
+                    objects_scores=scores,
+                    objects=[d["class"] for d in dets]
+                )
+        os.replace(tmp_file, npz_file)
+        journal.commit(op.relpath(npz_file, args.output_dir))
     
         #draw_bb(cv2_img, rects, labels, scores)
     
@@ -222,7 +427,16 @@ def main():
         #     with open(text_save_file, "w") as fid:
         #         fid.write(result_str)
 
-    fd_list.close()
+    if args.output_format == "store":
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print("Detected {} images in {:.1f}s ({:.1f} images/s).".format(
+        len(todo), elapsed, len(todo) / max(elapsed, 1e-9)))
+
+
+def main():
+    run(parse_args())
     
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of per-image features.
+
+Entries are keyed on the bytes of the image, a context string describing
+how features are computed (model weights digest, transforms, ...) and the
+layer name, so the same image is only run through the model once across
+splits, test sets and output formats. The cache is size bounded and evicts
+the least recently used entries.
+
+Layout of a cache directory::
+
+    <cache>/ab/ab12...ef.npy    one entry per image and layer
+    <cache>/digests.json        memo of file digests keyed on path, size and
+                                mtime, so unchanged files are not rehashed
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 50 << 30  # 50 GiB
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FeatureCache(object):
+    """Size-bounded LRU cache of float16 feature arrays.
+
+    Arguments:
+        root (str): Cache directory, created if needed.
+        context (str): Describes everything besides the image and the layer
+            that the features depend on. Use :meth:`digest` for large files
+            such as model weights.
+        max_bytes (int, optional): Size above which least recently used
+            entries are evicted.
+    """
+    def __init__(self, root, context, max_bytes=DEFAULT_CACHE_SIZE):
+        self.root = str(root)
+        self.context = context
+        self.max_bytes = max_bytes
+        self._digests = None
+        self._size = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def __getstate__(self):
+        # Worker processes rebuild the memo and the size lazily
+        state = dict(self.__dict__)
+        state["_digests"] = None
+        state["_size"] = None
+        return state
+
+    def _memo_file(self):
+        return os.path.join(self.root, "digests.json")
+
+    def digest(self, path):
+        """Returns the SHA-256 of the file at ``path``, reusing the digest
+        computed by a previous run if the file is unchanged."""
+        if self._digests is None:
+            self._digests = {}
+            if os.path.exists(self._memo_file()):
+                try:
+                    with open(self._memo_file()) as f:
+                        self._digests = json.load(f)
+                except ValueError:
+                    pass
+        path = os.path.realpath(str(path))
+        st = os.stat(path)
+        entry = self._digests.get(path)
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+            entry = [st.st_size, st.st_mtime_ns, file_digest(path)]
+            self._digests[path] = entry
+        return entry[2]
+
+    def save_digests(self):
+        if self._digests is None:
+            return
+        tmp = "{}.{}.tmp".format(self._memo_file(), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self._digests, f)
+        os.replace(tmp, self._memo_file())
+
+    def _path(self, image_digest, layer):
+        key = hashlib.sha256("\n".join(
+            [self.context, layer, image_digest]).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    def get(self, image_digest, layer):
+        """Returns the cached array or ``None``, and marks a hit as recently
+        used."""
+        path = self._path(image_digest, layer)
+        try:
+            arr = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arr
+
+    def put(self, image_digest, layer, arr):
+        path = self._path(image_digest, layer)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr, dtype=np.float16))
+        os.replace(tmp, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".npy"):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is 10% below
+        its size limit."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        size = sum(e[1] for e in entries)
+        target = 0.9 * self.max_bytes
+        for path, nbytes, _ in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= nbytes
+        self._size = size
+
+
+def add_cache_args(parser):
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Content-addressed feature cache shared between '
+                        'runs, splits and test sets (default: no cache).')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='Cache size limit in bytes before least recently '
+                        'used entries are evicted.')
+
+
+def lookup(cache, image_files, indices, layers, write):
+    """Serves the images of ``indices`` that are in ``cache``.
+
+    For every image whose ``layers`` are all cached, ``write(idx, feats)`` is
+    called with a dict of the cached arrays. Returns the indices that were
+    served, the indices that are still to be computed and the list of image
+    digests (``None`` for images not in ``indices``).
+    """
+    digests = [None] * len(image_files)
+    hits, misses = [], []
+    for idx in indices:
+        digests[idx] = cache.digest(image_files[idx])
+        feats = {}
+        for layer in layers:
+            arr = cache.get(digests[idx], layer)
+            if arr is None:
+                break
+            feats[layer] = arr
+        if len(feats) == len(layers):
+            write(idx, feats)
+            hits.append(idx)
+        else:
+            misses.append(idx)
+    cache.save_digests()
+    return hits, misses, digests
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Sharded feature store for the ResNet50 extractors.
+
+Instead of writing one small ``.npy`` file per image and per layer, features
+are appended to a handful of large shard files. Each image occupies one
+fixed-size record in a shard, holding the float16 tensors of all stored
+layers back to back. An index file maps image names to their shard and
+record offset, so a single tensor can be memory-mapped by name without
+copying.
+
+Layout of a store directory::
+
+    <store>/index.json          dtype, layer shapes/offsets, shard names
+                                and the (name, shard, offset) of every image
+    <store>/shard-00000.bin     raw records
+    <store>/shard-00001.bin
+    ...
+
+Several processes can fill the same store by writing separate parts
+(``index.<part>.json`` and ``shard-<part>-00000.bin``), which
+:func:`merge_parts` then combines into the single ``index.json``.
+"""
+from collections import OrderedDict
+import glob
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+DEFAULT_SHARD_SIZE = 2 << 30  # 2 GiB
+
+
+def index_file(part=None):
+    return INDEX_FILE if part is None else "index.{}.json".format(part)
+
+
+def write_index(path, index):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def merge_parts(path, names=None):
+    """Combines ``index.json`` and all part indexes of the store at ``path``
+    into ``index.json`` and removes the part indexes. Images are ordered as
+    in ``names`` when given (names missing from the store are skipped), in
+    order of appearance otherwise."""
+    path = str(path)
+    files = glob.glob(os.path.join(glob.escape(path), "index.*.json"))
+    if os.path.exists(os.path.join(path, INDEX_FILE)):
+        files.insert(0, os.path.join(path, INDEX_FILE))
+
+    merged = None
+    images = OrderedDict()
+    for fname in files:
+        with open(fname) as f:
+            index = json.load(f)
+        if merged is None:
+            merged = dict(index, shards=[], images=[])
+        elif index["layers"] != merged["layers"]:
+            raise ValueError("{} was written with layers {}, expected {}.".format(
+                fname, index["layers"], merged["layers"]))
+        base = len(merged["shards"])
+        merged["shards"] += index["shards"]
+        for name, shard, offset in index["images"]:
+            images[name] = (base + shard, offset)
+    if merged is None:
+        return
+
+    if names is None:
+        names = images.keys()
+    merged["images"] = [[name, images[name][0], images[name][1]]
+                        for name in names if name in images]
+    write_index(os.path.join(path, INDEX_FILE), merged)
+    for fname in files:
+        if os.path.basename(fname) != INDEX_FILE:
+            os.remove(fname)
+
+
+def remove_store(path):
+    """Deletes the index and shard files of the store at ``path``."""
+    path = glob.escape(str(path))
+    for fname in glob.glob(os.path.join(path, "index*.json")) + \
+            glob.glob(os.path.join(path, "shard-*.bin")):
+        os.remove(fname)
+
+
+def record_layout(layers, dtype=np.float16):
+    """Returns ``({layer: (offset, shape)}, record_size)`` for an ordered
+    list of ``(layer, shape)`` pairs."""
+    itemsize = np.dtype(dtype).itemsize
+    layout = {}
+    offset = 0
+    for name, shape in layers:
+        shape = tuple(int(s) for s in shape)
+        layout[name] = (offset, shape)
+        offset += int(np.prod(shape)) * itemsize
+    return layout, offset
+
+
+class ShardedFeatureWriter(object):
+    """Appends per-image feature records to a sharded store.
+
+    Arguments:
+        path (str): Store directory, created if needed.
+        layers (list): Ordered ``(layer, shape)`` pairs, e.g.
+            ``[("res4frelu", (1024, 14, 14)), ("avgpool", (2048,))]``.
+        shard_size (int, optional): Approximate maximum shard size in bytes.
+            A shard always holds at least one record.
+        resume (bool, optional): Continue appending to an existing store.
+            Records written after the last :meth:`flush` are discarded, and
+            appending a name that is already indexed replaces its entry.
+        part (str, optional): Write a separate part of the store, to be
+            combined with :func:`merge_parts`.
+    """
+    def __init__(self, path, layers, shard_size=DEFAULT_SHARD_SIZE,
+                 dtype=np.float16, resume=False, part=None):
+        self.path = str(path)
+        self.part = part
+        self.index_file = index_file(part)
+        self.dtype = np.dtype(dtype)
+        self.layers = [(name, tuple(shape)) for name, shape in layers]
+        self.layout, self.record_size = record_layout(self.layers, self.dtype)
+        self.records_per_shard = max(1, shard_size // self.record_size)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.shards = []
+        self.images = OrderedDict()
+        self._fd = None
+        self._count = 0
+
+        if resume and os.path.exists(os.path.join(self.path, self.index_file)):
+            self._reopen()
+
+    def _reopen(self):
+        with open(os.path.join(self.path, self.index_file)) as f:
+            index = json.load(f)
+        layers = [(name, tuple(shape)) for name, _, shape in index["layers"]]
+        if layers != self.layers or np.dtype(index["dtype"]) != self.dtype:
+            raise ValueError("{} was written with layers {}, expected {}.".format(
+                self.path, layers, self.layers))
+        self.shards = index["shards"]
+        self.images = OrderedDict(
+            (name, (shard, offset)) for name, shard, offset in index["images"])
+        if not self.shards:
+            return
+
+        # Drop records that were appended after the index was last written
+        last = len(self.shards) - 1
+        offsets = [offset for shard, offset in self.images.values()
+                   if shard == last]
+        self._count = max(offsets) // self.record_size + 1 if offsets else 0
+        self._fd = open(os.path.join(self.path, self.shards[last]), "r+b")
+        self._fd.truncate(self._count * self.record_size)
+        self._fd.seek(0, os.SEEK_END)
+
+    def _open_shard(self):
+        if self._fd is not None:
+            self._fd.close()
+        # Shards of merged parts may already use the next number
+        n = len(self.shards)
+        while True:
+            if self.part is None:
+                name = "shard-{:05d}.bin".format(n)
+            else:
+                name = "shard-{}-{:05d}.bin".format(self.part, n)
+            if not os.path.exists(os.path.join(self.path, name)):
+                break
+            n += 1
+        self.shards.append(name)
+        self._fd = open(os.path.join(self.path, name), "wb")
+        self._count = 0
+
+    def append(self, name, feats):
+        """Appends one image. ``feats`` maps every layer of the store to an
+        array of the layer's shape; arrays are cast to the store dtype."""
+        if self._fd is None or self._count == self.records_per_shard:
+            self._open_shard()
+        for layer, shape in self.layers:
+            arr = np.ascontiguousarray(feats[layer], dtype=self.dtype)
+            if arr.shape != shape:
+                raise ValueError("{}: expected shape {} for {}, got {}".format(
+                    name, shape, layer, arr.shape))
+            self._fd.write(memoryview(arr).cast("B"))
+        self.images[name] = (len(self.shards) - 1,
+                             self._count * self.record_size)
+        self._count += 1
+
+    def flush(self):
+        """Flushes shard data and atomically rewrites the index."""
+        if self._fd is not None:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+
+        index = {
+            "dtype": self.dtype.str,
+            "record_size": self.record_size,
+            "layers": [[name, self.layout[name][0], list(shape)]
+                       for name, shape in self.layers],
+            "shards": self.shards,
+            "images": [[name, shard, offset]
+                       for name, (shard, offset) in self.images.items()],
+        }
+        write_index(os.path.join(self.path, self.index_file), index)
+
+    def close(self):
+        self.flush()
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardedFeatureReader(object):
+    """Read-only access to a store written by :class:`ShardedFeatureWriter`.
+
+    Shards are memory-mapped lazily, and :meth:`get` returns a read-only
+    view into the mapping, so no data is copied until it is used.
+    Names may be given either as bare image names or as entries of the
+    ``<split>.txt`` manifest (``train/1000092795.npy``).
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        self.record_size = index["record_size"]
+        self.layout = {name: (offset, tuple(shape))
+                       for name, offset, shape in index["layers"]}
+        self.layers = [name for name, _, _ in index["layers"]]
+        self.shards = index["shards"]
+        self.index = {name: (shard, offset)
+                      for name, shard, offset in index["images"]}
+        self.names = [name for name, _, _ in index["images"]]
+        self._maps = {}
+
+    def _shard(self, shard):
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(
+                os.path.join(self.path, self.shards[shard]),
+                dtype=np.uint8, mode="r")
+        return self._maps[shard]
+
+    @staticmethod
+    def key(name):
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def get(self, name, layer):
+        shard, offset = self.index[self.key(name)]
+        loffset, shape = self.layout[layer]
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        start = offset + loffset
+        buf = self._shard(shard)[start:start + nbytes]
+        return buf.view(self.dtype).reshape(shape)
+
+    def __contains__(self, name):
+        return self.key(name) in self.index
+
+    def __len__(self):
+        return len(self.names)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Output codecs for the per-image ``.npz`` files of the detector scripts.
+
+``zlib`` is the default ``np.savez_compressed`` and ``none`` is ``np.savez``;
+both are plain zip archives that ``np.load`` reads. ``lz4`` and ``zstd``
+compress the whole uncompressed archive with the respective frame format
+(which needs the ``lz4`` or ``zstandard`` package), behind a small header::
+
+    MAGIC  codec name length (1 byte)  codec name  payload length (8 bytes)
+    payload
+
+The file name keeps the ``.npz`` extension, so output lists and manifests do
+not depend on the codec. Readers use :func:`load`, which tells the formats
+apart by their first bytes.
+"""
+import io
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+CODECS = ("zlib", "none", "lz4", "zstd")
+MAGIC = b"\x93NPZC\x01"
+_LENGTH = struct.Struct("<Q")
+
+
+def _frame_codec(codec):
+    """Returns the ``(compress, decompress)`` functions of a frame codec."""
+    if codec == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("The lz4 codec needs the lz4 package (pip install lz4).")
+        return lz4.frame.compress, lz4.frame.decompress
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("The zstd codec needs the zstandard package "
+                              "(pip install zstandard).")
+        # The frames record their content size, which decompress() needs
+        return (zstandard.ZstdCompressor(level=3).compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError("Unknown codec {}, expected one of {}.".format(codec, CODECS))
+
+
+def save(file, codec="zlib", **arrays):
+    """Like ``np.savez_compressed(file, **arrays)`` with the given codec.
+    ``file`` is a path, to which ``.npz`` is appended when missing, or an
+    open binary file."""
+    if isinstance(file, (str, os.PathLike)):
+        file = os.fspath(file)
+        if not file.endswith(".npz"):
+            file = file + ".npz"
+    if codec == "zlib":
+        np.savez_compressed(file, **arrays)
+        return
+    if codec == "none":
+        np.savez(file, **arrays)
+        return
+
+    compress, _ = _frame_codec(codec)
+    raw = io.BytesIO()
+    np.savez(raw, **arrays)
+    payload = compress(raw.getvalue())
+    name = codec.encode("ascii")
+    header = MAGIC + bytes([len(name)]) + name + _LENGTH.pack(len(payload))
+    if isinstance(file, str):
+        with open(file, "wb") as f:
+            f.write(header)
+            f.write(payload)
+    else:
+        file.write(header)
+        file.write(payload)
+
+
+def _read_header(f):
+    """Reads the header after ``MAGIC``, returns the codec and the length
+    of the payload."""
+    size = f.read(1)
+    codec = f.read(size[0]).decode("ascii") if size else ""
+    length = f.read(_LENGTH.size)
+    if len(length) < _LENGTH.size:
+        raise ValueError("Truncated header.")
+    return codec, _LENGTH.unpack(length)[0]
+
+
+def load(path, allow_pickle=False):
+    """Loads a file written by :func:`save` with any codec. Returns a
+    mapping of the array names to arrays, like ``np.load``."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            codec, length = _read_header(f)
+            payload = f.read(length)
+            _, decompress = _frame_codec(codec)
+            return np.load(io.BytesIO(decompress(payload)), allow_pickle=allow_pickle)
+    return np.load(path, allow_pickle=allow_pickle)
+
+
+def is_complete(path):
+    """Tells whether a file written by :func:`save` was completely written.
+    A zip archive has its central directory written last, a frame codec
+    file has the length of its payload in its header."""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) == MAGIC:
+                _, length = _read_header(f)
+                return f.tell() + length == os.fstat(f.fileno()).st_size
+        with zipfile.ZipFile(path) as zf:
+            return len(zf.namelist()) > 0
+    except (zipfile.BadZipFile, OSError, ValueError):
+        return False
+
+
+class CodecNumpy(object):
+    """Stands in for the ``numpy`` module of code that saves its outputs
+    with ``np.savez_compressed``, which then uses ``codec`` instead.
+    ``on_save(file, arrays)`` is called after each save, if given."""
+    def __init__(self, codec, on_save=None):
+        self.codec = codec
+        self.on_save = on_save
+
+    def __getattr__(self, name):
+        return getattr(np, name)
+
+    def savez_compressed(self, file, *args, **arrays):
+        if args:
+            # Positional arrays are saved as arr_0, arr_1, ... like numpy
+            arrays.update(("arr_{}".format(i), a) for i, a in enumerate(args))
+        save(file, self.codec, **arrays)
+        if self.on_save is not None:
+            self.on_save(file, arrays)
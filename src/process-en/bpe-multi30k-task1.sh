@@ -13,6 +13,8 @@ BPECODES=$3
 BPEVOCAB=$4
 INFILE=$5
 OUTPREF=$6
+# Processes of apply_bpe.py (optional)
+NUM_WORKERS=${7:-1}
 
 TOKFILE="${OUTPREF}.lc.norm.tok.${OLANG}"
 OUTFILE="${OUTPREF}.lc.norm.tok.bpe.${OLANG}"
@@ -34,5 +36,5 @@ echo " ($lang) $N_SENTS sentences, $N_WORDS words, $N_WORD_PER_SENT words/sent"
 #    --write-vocabulary \
 #            "${BPE}/${LPAIR}/vocab.en" "${BPE}/${LPAIR}/vocab.$TLANG"
 
-$BPEAPPLY -c $BPECODES --vocabulary $BPEVOCAB < $TOKFILE > $OUTFILE
+$BPEAPPLY -c $BPECODES --vocabulary $BPEVOCAB --num-workers $NUM_WORKERS < $TOKFILE > $OUTFILE
 
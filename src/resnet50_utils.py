@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the ResNet50 feature extraction scripts."""
+from collections import OrderedDict
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.utils.data as data
+from torchvision.models import resnet50
+
+
+# Layers that can be extracted and their output shapes for 224x224 inputs
+LAYERS = OrderedDict([
+    ("res4frelu", (1024, 14, 14)),
+    ("res5erelu", (2048, 7, 7)),
+    ("avgpool", (2048,)),
+])
+
+
+def parse_layers(value):
+    """Parses a comma separated list of layer names. The result follows the
+    order of ``LAYERS`` regardless of the order given."""
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in LAYERS:
+            raise ValueError("Unknown layer {}, expected one of {}.".format(
+                name, ", ".join(LAYERS)))
+    if not names:
+        raise ValueError("No layers given.")
+    return [name for name in LAYERS if name in names]
+
+
+def add_layers_arg(parser):
+    parser.add_argument('--layers', type=parse_layers, default=list(LAYERS),
+                        help='Comma separated layers to extract, out of '
+                        '{} (default: all).'.format(",".join(LAYERS)))
+
+
+def strip_unused_layers(cnn, layers):
+    """Drops the blocks of ``cnn`` that are not needed to compute
+    ``layers``, so that their weights are not moved to the device."""
+    if "res5erelu" not in layers and "avgpool" not in layers:
+        del cnn.layer4
+
+
+def resnet_forward(cnn, x, layers=LAYERS):
+    """Runs ``cnn`` on ``x`` and returns a dict with the requested
+    ``layers``. The forward pass stops as soon as they are computed."""
+    outputs = {}
+
+    x = cnn.conv1(x)
+    x = cnn.bn1(x)
+    x = cnn.relu(x)
+    x = cnn.maxpool(x)
+
+    x = cnn.layer1(x)
+    x = cnn.layer2(x)
+    res4f_relu = cnn.layer3(x)
+    if "res4frelu" in layers:
+        outputs["res4frelu"] = res4f_relu
+    if "res5erelu" not in layers and "avgpool" not in layers:
+        return outputs
+
+    res5e_relu = cnn.layer4(res4f_relu)
+    if "res5erelu" in layers:
+        outputs["res5erelu"] = res5e_relu
+    if "avgpool" in layers:
+        avgp = cnn.avgpool(res5e_relu)
+        outputs["avgpool"] = torch.flatten(avgp, 1)
+    return outputs
+
+
+def add_resume_arg(parser):
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, skipping the images '
+                        'recorded as done in the progress log next to the '
+                        'outputs.')
+
+
+def index_runs(indices):
+    """Splits a sorted sequence of indices into ``(start, end)`` runs of
+    consecutive values."""
+    runs = []
+    for idx in indices:
+        if runs and runs[-1][1] == idx:
+            runs[-1][1] = idx + 1
+        else:
+            runs.append([idx, idx + 1])
+    return [tuple(run) for run in runs]
+
+
+def fsync_dir(path):
+    """Fsyncs the directory ``path``, which makes the files created in it
+    durable along with the journal commit that records them."""
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ProgressLog(object):
+    """Durable record of the image ranges whose features are on disk.
+
+    The log is a text file whose first line describes the run (number of
+    images, layers, ...) and whose following lines are ``start end`` ranges
+    of completed image indices. Ranges are appended and fsynced only after
+    the corresponding features have been flushed, so after a crash the log
+    never claims more than what was written. A torn last line is ignored.
+
+    Worker processes pass a distinct ``part`` and append to their own
+    ``<path>.<part>`` file; :meth:`load` reads all of them.
+    """
+    def __init__(self, path, meta, part=None):
+        self.path = str(path)
+        self.meta = json.dumps(meta, sort_keys=True)
+        self.part = part
+        self.ranges = []
+
+    def _parts(self):
+        return sorted(glob.glob(glob.escape(self.path) + ".*[0-9]"))
+
+    def load(self):
+        """Reads the completed ranges. Returns ``False`` if there is no log.
+        Raises ``RuntimeError`` if the log was written by a run with other
+        settings."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            lines = f.read().split("\n")
+        if lines[0] != "# " + self.meta:
+            raise RuntimeError(
+                "{} was written with different settings ({}), refusing to "
+                "resume.".format(self.path, lines[0][2:]))
+        for part in self._parts():
+            with open(part) as f:
+                lines += f.read().split("\n")
+        self.ranges = []
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) == 2 and all(x.isdigit() for x in fields):
+                self.ranges.append((int(fields[0]), int(fields[1])))
+        return True
+
+    def reset(self):
+        for part in self._parts():
+            os.remove(part)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("# " + self.meta + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.ranges = []
+
+    def mark(self, start, end):
+        path = self.path
+        if self.part is not None:
+            path = "{}.{}".format(self.path, self.part)
+        with open(path, "a") as f:
+            f.write("{} {}\n".format(start, end))
+            f.flush()
+            os.fsync(f.fileno())
+        self.ranges.append((start, end))
+
+    def remaining(self, n):
+        """Returns the sorted indices in ``range(n)`` not yet completed."""
+        done = np.zeros(n, dtype=bool)
+        for start, end in self.ranges:
+            done[start:end] = True
+        return np.flatnonzero(~done).tolist()
+
+
+def add_device_args(parser):
+    parser.add_argument('--devices', type=str, default="0",
+                        help='Comma separated devices to run on, one process '
+                        'each, e.g. "0,1,2,3" for four GPUs or "cpu,cpu" for '
+                        'two CPU processes.')
+    parser.add_argument('--intra-op-threads', type=int, default=0,
+                        help='Threads used inside an operator by each process '
+                        '(default: the cores divided among CPU processes).')
+    parser.add_argument('--inter-op-threads', type=int, default=0,
+                        help='Threads used to run independent operators '
+                        '(default: PyTorch default).')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='Run the model in channels-last memory format, '
+                        'which is usually faster on CPU. Features may differ '
+                        'from the default format in the last bits.')
+
+
+def parse_devices(value):
+    """Maps ``--devices`` to a list of torch device names."""
+    return [d if d == "cpu" or d.startswith("cuda") else "cuda:" + d
+            for d in value.split(",") if d.strip()]
+
+
+def configure_threads(args, devices):
+    """Applies the thread settings for one process running on a device of
+    ``devices``. Must be called before the first operator runs."""
+    intra = args.intra_op_threads
+    n_cpu = sum(device == "cpu" for device in devices)
+    if intra <= 0 and n_cpu > 1:
+        # Do not oversubscribe the cores with several CPU processes
+        intra = max(1, (os.cpu_count() or 1) // n_cpu)
+    if intra > 0:
+        torch.set_num_threads(intra)
+    if args.inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(args.inter_op_threads)
+        except RuntimeError:
+            print("Inter-op threads can only be set once per process, ignoring.")
+
+
+def inference_mode():
+    """``torch.inference_mode`` where available, ``torch.no_grad`` before
+    PyTorch 1.9."""
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def build_cnn(model_file, layers, device, channels_last=False):
+    """Loads the ResNet50 weights in ``model_file`` and returns the model in
+    evaluation mode on ``device``, without the blocks not needed for
+    ``layers``."""
+    cnn = resnet50(pretrained=False)
+    resnet_dict = torch.load(str(model_file), map_location="cpu")
+    cnn.load_state_dict(resnet_dict)
+
+    # Remove final classifier layer and the blocks that are not needed
+    del cnn.fc
+    strip_unused_layers(cnn, layers)
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.set_device(torch.device(device))
+    cnn.to(device)
+    if channels_last:
+        cnn.to(memory_format=torch.channels_last)
+    cnn.train(False)
+    return cnn
+
+
+def split_work(indices, n):
+    """Splits ``indices`` into ``n`` contiguous chunks of similar size, so
+    that each process writes a contiguous block of rows."""
+    indices = np.asarray(indices, dtype=np.int64)
+    return [chunk.tolist() for chunk in np.array_split(indices, n)]
+
+
+def run_workers(fn, devices, *args):
+    """Calls ``fn(rank, devices, *args)`` for every device. A single device
+    runs in the current process, more devices are run in spawned processes
+    so that no CUDA state is shared."""
+    if len(devices) == 1:
+        fn(0, devices, *args)
+    else:
+        mp.spawn(fn, args=(devices,) + args, nprocs=len(devices), join=True)
+
+
+def cache_context(model_file, dataset, args):
+    """Describes what ResNet50 features depend on besides the image and the
+    layer, for keying the feature cache."""
+    from feature_cache import file_digest
+    return "resnet50 weights={} transform={} channels_last={}".format(
+        file_digest(model_file), repr(dataset.transform), args.channels_last)
+
+
+def add_loader_args(parser):
+    """Adds the image decoding pipeline options to ``parser``."""
+    parser.add_argument('--num-workers', type=int, default=4,
+                        help='Number of image decoding worker processes '
+                        '(0 decodes on the main thread).')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+                        help='Batches decoded ahead by each worker.')
+    parser.add_argument('--no-pin-memory', dest='pin_memory',
+                        action='store_false',
+                        help='Do not decode into page-locked host buffers.')
+    parser.add_argument('--write-queue', type=int, default=2,
+                        help='Maximum number of computed batches waiting to '
+                        'be written before the forward loop blocks.')
+    parser.add_argument('--fused-transfer', action='store_true',
+                        help='Cast features to float16 on the device and copy '
+                        'all layers to the host in a single transfer.')
+
+
+def build_loader(dataset, args, use_cuda=True):
+    """Creates the decoding ``DataLoader`` for ``dataset``. Batches are
+    decoded by ``args.num_workers`` processes into pinned buffers so that
+    host-to-device copies can be issued with ``non_blocking=True``."""
+    kwargs = {}
+    if args.num_workers > 0:
+        kwargs["prefetch_factor"] = args.prefetch_factor
+    return data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory and use_cuda, **kwargs)
+
+
+class PipelineStats(object):
+    """Measures how long the forward loop waits on the decoding pipeline.
+
+    This is host time. With ``non_blocking`` copies and fused transfers the
+    loop does not synchronize with the device every batch, so the device
+    may still be busy with earlier batches while the loop waits; the wait
+    is an upper bound on device idle time, not a measure of it.
+    """
+    def __init__(self):
+        self.wait = 0.
+        self.images = 0
+        self.batches = 0
+        self.start = None
+        self.end = None
+
+    def iterate(self, loader):
+        self.start = time.perf_counter()
+        it = iter(loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                break
+            self.wait += time.perf_counter() - t0
+            self.batches += 1
+            self.images += len(batch)
+            yield batch
+        self.end = time.perf_counter()
+
+    def report(self, writer=None):
+        end = self.end if self.end is not None else time.perf_counter()
+        total = end - self.start
+        print("Processed {} images in {} batches in {:.1f}s ({:.1f} images/s).".format(
+            self.images, self.batches, total, self.images / max(total, 1e-9)))
+        print("Loader wait for decoded batches: {:.1f}s ({:.1f}%).".format(
+            self.wait, 100. * self.wait / max(total, 1e-9)))
+        if writer is not None:
+            print("Writer wait for a free queue slot: {:.1f}s ({:.1f}%).".format(
+                writer.blocked, 100. * writer.blocked / max(total, 1e-9)))
+
+
+class AsyncWriter(object):
+    """Persists batches on a background thread so that the forward pass of
+    the next batch overlaps with the disk writes of the previous one.
+
+    ``write_fn(*item)`` is called for every item given to :meth:`put`, in
+    order. At most ``max_pending`` items are queued; beyond that :meth:`put`
+    blocks, so a slow disk throttles the forward loop instead of buffering
+    features without bound. An exception raised by ``write_fn`` is re-raised
+    by the next :meth:`put` or by :meth:`close`.
+
+    Use as a context manager so that queued batches are written out even if
+    the forward loop fails::
+
+        with AsyncWriter(write_batch) as writer:
+            for batch in loader:
+                writer.put(...)
+    """
+    def __init__(self, write_fn, max_pending=2):
+        self.write_fn = write_fn
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.error = None
+        self.blocked = 0.
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write_fn(*item)
+            except BaseException as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, *item):
+        self._check()
+        t0 = time.perf_counter()
+        self.queue.put(item)
+        self.blocked += time.perf_counter() - t0
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the original exception, but still write what was computed
+            try:
+                self.close()
+            except BaseException:
+                pass
+
+
+class FusedTransfer(object):
+    """Copies a batch of several output tensors to the host as float16 in a
+    single device-to-host transfer.
+
+    The outputs are cast on the device, concatenated row-wise and copied
+    asynchronously into one of ``num_buffers`` reusable pinned host buffers.
+    The buffers are used round-robin, so ``num_buffers`` must exceed the
+    number of batches that can still be referenced by the writer
+    (``max_pending + 2`` for :class:`AsyncWriter`). The result is identical
+    to ``t.cpu().numpy().astype(np.float16)``: both round to nearest even.
+
+    Calling the object returns the per-output host views and a CUDA event
+    (``None`` on CPU) that must be synchronized before the views are read.
+    """
+    def __init__(self, shapes, batch_size, device, num_buffers):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.device = torch.device(device)
+        pin = self.device.type == "cuda"
+        self.buffers = [
+            torch.empty((batch_size, sum(self.sizes)), dtype=torch.float16,
+                        pin_memory=pin)
+            for _ in range(num_buffers)]
+        self.next = 0
+
+    def __call__(self, tensors):
+        n = tensors[0].shape[0]
+        fused = torch.cat([t.reshape(n, -1).half() for t in tensors], dim=1)
+
+        buf = self.buffers[self.next][:n]
+        self.next = (self.next + 1) % len(self.buffers)
+        buf.copy_(fused, non_blocking=True)
+
+        ready = None
+        if self.device.type == "cuda":
+            ready = torch.cuda.Event()
+            ready.record()
+
+        views = []
+        offset = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            views.append(buf[:, offset:offset + size].view(n, *shape))
+            offset += size
+        return views, ready
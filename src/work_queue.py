@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Dynamic work distribution for the detector scripts.
+
+Instead of giving every worker a fixed slice of the image list, the list is
+cut into small chunks that the workers pull from a shared queue as they
+finish their previous chunk. Workers on faster devices, or whose images are
+mostly done already, simply take more chunks.
+
+The queue is either a :class:`ChunkQueue` served by a Ray actor
+(``ray.remote(ChunkQueue)``) or a multiprocessing queue feeding local worker
+processes (:func:`run_local`), which also works with CPU-only workers.
+"""
+from collections import deque, OrderedDict
+import multiprocessing as mp
+import queue
+import time
+
+
+def make_chunks(items, chunk_size):
+    chunk_size = max(1, chunk_size)
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+class Throughput(object):
+    """Records the images and time spent by every worker."""
+    def __init__(self):
+        self.workers = OrderedDict()
+
+    def add(self, worker, num_items, seconds):
+        items, chunks, total = self.workers.get(worker, (0, 0, 0.0))
+        self.workers[worker] = (items + num_items, chunks + 1, total + seconds)
+
+    def report(self):
+        lines = []
+        for worker, (items, chunks, seconds) in self.workers.items():
+            lines.append("Worker {}: {} images in {} chunks, {:.1f}s "
+                         "({:.1f} images/s).".format(
+                             worker, items, chunks, seconds,
+                             items / max(seconds, 1e-9)))
+        return "\n".join(lines)
+
+
+class ChunkQueue(object):
+    """Hands out chunks in order to whichever worker asks first.
+
+    Arguments:
+        chunks (list): Lists of work items, see :func:`make_chunks`.
+    """
+    def __init__(self, chunks):
+        self.chunks = deque(chunks)
+        self.throughput = Throughput()
+
+    def get(self, worker):
+        """Returns the next chunk, or ``None`` when all chunks are taken."""
+        return self.chunks.popleft() if self.chunks else None
+
+    def done(self, worker, num_items, seconds):
+        self.throughput.add(worker, num_items, seconds)
+
+    def report(self):
+        return self.throughput.report()
+
+
+def _local_worker(worker, init_fn, work_fn, exit_fn, tasks, results):
+    state = init_fn(worker)
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            break
+        start = time.perf_counter()
+        work_fn(state, worker, chunk)
+        results.put((worker, len(chunk), time.perf_counter() - start))
+    if exit_fn is not None:
+        exit_fn(state)
+    results.put((worker, None, None))
+
+
+def run_local(init_fn, work_fn, chunks, num_workers, progress=None, exit_fn=None):
+    """Processes ``chunks`` in ``num_workers`` spawned processes.
+
+    Every process calls ``state = init_fn(worker)`` once, e.g. to build its
+    model, then ``work_fn(state, worker, chunk)`` for each chunk it pulls
+    from the queue, and finally ``exit_fn(state)`` if given. The functions
+    must be picklable. ``progress(n)`` is called in this process after each
+    chunk of ``n`` items. Returns the :class:`Throughput` of the workers.
+    No more workers are started than there are chunks.
+    """
+    num_workers = min(num_workers, len(chunks))
+    ctx = mp.get_context("spawn")
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    for chunk in chunks:
+        tasks.put(chunk)
+    for _ in range(num_workers):
+        tasks.put(None)
+
+    procs = [ctx.Process(target=_local_worker,
+                         args=(worker, init_fn, work_fn, exit_fn, tasks, results))
+             for worker in range(num_workers)]
+    for proc in procs:
+        proc.start()
+
+    throughput = Throughput()
+    running = num_workers
+    while running:
+        try:
+            worker, num_items, seconds = results.get(timeout=5)
+        except queue.Empty:
+            # A worker that died does not report back
+            if not any(proc.is_alive() for proc in procs):
+                break
+            continue
+        if num_items is None:
+            running -= 1
+            continue
+        throughput.add(worker, num_items, seconds)
+        if progress is not None:
+            progress(num_items)
+
+    for proc in procs:
+        proc.join()
+    failed = [worker for worker, proc in enumerate(procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError("Workers {} failed.".format(failed))
+    return throughput
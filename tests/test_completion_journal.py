@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import npz_codec
+from completion_journal import CompletionJournal
+
+
+class TestCompletionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmpdir, "test_2016_flickr")
+        os.makedirs(os.path.join(self.output_dir, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, truncate=None):
+        path = os.path.join(self.output_dir, name)
+        npz_codec.save(path, "zlib", x=np.arange(1000, dtype=np.float32))
+        if truncate is not None:
+            with open(path, "r+b") as f:
+                f.truncate(truncate)
+        return path
+
+    def journal_lines(self):
+        with open(self.output_dir + ".done") as f:
+            return f.read().splitlines()
+
+    def test_commit(self):
+        journal = CompletionJournal(self.output_dir + "/")
+        self.assertEqual(journal.load(), set())
+        self.write("1.npz")
+        journal.commit("1.npz")
+        # nothing written for this image
+        journal.commit("2.npz")
+        self.assertIn("1.npz", journal)
+        self.assertNotIn("2.npz", journal)
+        size = os.path.getsize(os.path.join(self.output_dir, "1.npz"))
+        self.assertEqual(self.journal_lines(), ["1.npz\t{}".format(size)])
+        self.assertEqual(CompletionJournal(self.output_dir).load(), {"1.npz"})
+
+    def test_adopt_and_remove(self):
+        journal = CompletionJournal(self.output_dir)
+        self.write("done.npz")
+        journal.commit("done.npz")
+        # complete, but written before the journal (or right before a crash)
+        self.write("sub/old.npz")
+        # partially written
+        partial = self.write("partial.npz", truncate=100)
+        empty = self.write("sub/empty.npz", truncate=0)
+        tmp = os.path.join(self.output_dir, "next.npz.tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"\0" * 10)
+        # not an output
+        with open(os.path.join(self.output_dir, "notes.txt"), "w") as f:
+            f.write("keep")
+
+        done = CompletionJournal(self.output_dir).load()
+        self.assertEqual(done, {"done.npz", "sub/old.npz"})
+        for path in (partial, empty, tmp):
+            self.assertFalse(os.path.exists(path), path)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "notes.txt")))
+        # the journal is rewritten with the adopted outputs
+        self.assertEqual(sorted(line.split("\t")[0] for line in self.journal_lines()),
+                         ["done.npz", "sub/old.npz"])
+
+    def test_journaled_file_changed(self):
+        journal = CompletionJournal(self.output_dir)
+        path = self.write("1.npz")
+        journal.commit("1.npz")
+        # rewritten by a worker that crashed
+        with open(path, "r+b") as f:
+            f.truncate(50)
+        self.assertEqual(CompletionJournal(self.output_dir).load(), set())
+        self.assertFalse(os.path.exists(path))
+
+    def test_torn_line(self):
+        journal = CompletionJournal(self.output_dir)
+        self.write("1.npz")
+        self.write("2.npz")
+        journal.commit("1.npz")
+        with open(self.output_dir + ".done", "a") as f:
+            f.write("2.npz\t")
+        # 2.npz is complete, so it is adopted even though its line is torn
+        self.assertEqual(CompletionJournal(self.output_dir).load(), {"1.npz", "2.npz"})
+        self.assertEqual(len(self.journal_lines()), 2)
+
+    def test_missing_output_dir(self):
+        journal = CompletionJournal(os.path.join(self.tmpdir, "missing"))
+        self.assertEqual(journal.load(), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import detection_store
+from detection_store import DetectionStoreReader, DetectionStoreWriter
+
+# Repeated names, as in the VinVL and BUTD vocabularies
+CLASSES = ["cat", "dog", "man", "dog", "tree", "ball"]
+ATTRIBUTES = ["red", "small", "wooden"]
+
+
+def random_image(rng, max_boxes=6):
+    n = int(rng.randint(0, max_boxes + 1))
+    attr_ids = [list(rng.randint(0, len(ATTRIBUTES), rng.randint(0, 3))) for _ in range(n)]
+    return {
+        "boxes": rng.rand(n, 4).astype(np.float32),
+        "scores": rng.rand(n).astype(np.float32),
+        "class_ids": rng.randint(0, len(CLASSES), n).astype(np.int32),
+        "attr_ids": attr_ids,
+        "attr_scores": [list(rng.rand(len(ids))) for ids in attr_ids],
+    }
+
+
+class TestDetectionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = detection_store.store_dir(os.path.join(self.tmpdir, "test_2016_flickr/"))
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, images, part=None, chunk_size=3):
+        with DetectionStoreWriter(self.path, CLASSES, ATTRIBUTES, chunk_size=chunk_size,
+                                  part=part) as writer:
+            for name, image in images:
+                writer.append(name, **image)
+
+    def assertImage(self, reader, name, image):
+        stored = reader.get(name)
+        np.testing.assert_array_equal(stored["boxes"], image["boxes"])
+        np.testing.assert_array_equal(stored["scores"], image["scores"])
+        np.testing.assert_array_equal(stored["class_ids"], image["class_ids"])
+        offsets = stored["attr_offsets"]
+        self.assertEqual(len(offsets), len(image["scores"]) + 1)
+        for box, (ids, scores) in enumerate(zip(image["attr_ids"], image["attr_scores"])):
+            start, end = offsets[box], offsets[box + 1]
+            np.testing.assert_array_equal(stored["attr_ids"][start:end], ids)
+            np.testing.assert_allclose(stored["attr_scores"][start:end], scores, rtol=1e-6)
+
+    def test_store_dir(self):
+        self.assertEqual(self.path, os.path.join(self.tmpdir, "test_2016_flickr.store"))
+
+    def test_chunks_and_parts(self):
+        images = [("{}".format(i), random_image(self.rng)) for i in range(20)]
+        # chunks of 3 images in two parts, the last chunk of each is partial
+        self.write(images[:11], part="0")
+        self.write(images[11:], part="1")
+        self.assertTrue(detection_store.is_store(self.path))
+        self.assertEqual(detection_store.stored_names(self.path), set())
+
+        detection_store.merge_parts(self.path)
+        self.assertFalse([f for f in os.listdir(self.path) if f.startswith("index.")
+                          and f != "index.json"])
+        self.assertEqual(detection_store.stored_names(self.path), set(name for name, _ in images))
+
+        reader = DetectionStoreReader(self.path)
+        self.assertEqual(len(reader), 20)
+        num_boxes = sum(len(image["scores"]) for _, image in images)
+        self.assertEqual(reader.box_offsets[-1], num_boxes)
+        self.assertEqual(len(reader.attr_offsets), num_boxes + 1)
+        for name, image in images:
+            self.assertImage(reader, name, image)
+        # manifest entries
+        self.assertIn("test_2016_flickr/3.npz", reader)
+        self.assertImage(reader, "test_2016_flickr/3.npz", images[3][1])
+
+    def test_merge_into_existing_index(self):
+        images = [("{}".format(i), random_image(self.rng)) for i in range(8)]
+        self.write(images[:5])
+        self.write(images[5:], part="0")
+        detection_store.merge_parts(self.path)
+        reader = DetectionStoreReader(self.path)
+        self.assertEqual(reader.names, [name for name, _ in images])
+        for name, image in images:
+            self.assertImage(reader, name, image)
+
+    def test_name_appended_twice(self):
+        first, second, other = (random_image(self.rng) for _ in range(3))
+        # again within a part, and in a part merged later, as by a resumed worker
+        self.write([("a", first), ("b", other), ("a", second)], part="0", chunk_size=2)
+        detection_store.merge_parts(self.path)
+        self.assertImage(DetectionStoreReader(self.path), "a", second)
+
+        self.write([("a", first)], part="1")
+        detection_store.merge_parts(self.path)
+        reader = DetectionStoreReader(self.path)
+        self.assertEqual(len(reader), 2)
+        self.assertImage(reader, "a", first)
+        self.assertImage(reader, "b", other)
+
+    def test_resume_part(self):
+        images = [("{}".format(i), random_image(self.rng)) for i in range(7)]
+        self.write(images[:4], part="0")
+        self.write(images[4:], part="0")
+        detection_store.merge_parts(self.path)
+        reader = DetectionStoreReader(self.path)
+        for name, image in images:
+            self.assertImage(reader, name, image)
+
+    def test_vocabulary_mismatch(self):
+        self.write([("a", random_image(self.rng))])
+        with self.assertRaises(ValueError):
+            DetectionStoreWriter(self.path, CLASSES[::-1], ATTRIBUTES)
+
+    def test_score_dtype_mismatch(self):
+        self.write([("a", random_image(self.rng))], part="0")
+        with self.assertRaises(ValueError):
+            DetectionStoreWriter(self.path, CLASSES, ATTRIBUTES, part="0",
+                                 score_dtype=np.float64)
+        with DetectionStoreWriter(self.path, CLASSES, ATTRIBUTES, part="1",
+                                  score_dtype=np.float64) as writer:
+            writer.append("b", **random_image(self.rng))
+        with self.assertRaises(ValueError):
+            detection_store.merge_parts(self.path)
+
+    def test_remove_store(self):
+        self.write([("a", random_image(self.rng))], part="0")
+        detection_store.remove_store(self.path)
+        self.assertFalse(detection_store.is_store(self.path))
+        self.assertEqual(os.listdir(self.path), [])
+
+
+def naive_objects_above(classes, class_ids, scores, box_offsets, threshold):
+    classes = np.asarray(classes).astype(str)
+    words = []
+    for i in range(len(box_offsets) - 1):
+        start, end = box_offsets[i], box_offsets[i + 1]
+        keep = scores[start:end] > threshold
+        words.append(np.unique(classes[class_ids[start:end][keep]]))
+    return words
+
+
+class TestObjectsAbove(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+        counts = self.rng.randint(0, 8, 50)
+        self.box_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.class_ids = self.rng.randint(0, len(CLASSES), counts.sum())
+        self.scores = self.rng.rand(counts.sum()).astype(np.float32)
+        # scores equal to the threshold are not above it
+        self.scores[::5] = 0.5
+
+    def assertSameWords(self, words, expected):
+        self.assertEqual([list(w) for w in words], [list(w) for w in expected])
+
+    def test_against_naive(self):
+        for threshold in (0.0, 0.3, 0.5, 0.99, 1.0):
+            self.assertSameWords(
+                detection_store.objects_above(CLASSES, self.class_ids, self.scores,
+                                              self.box_offsets, threshold),
+                naive_objects_above(CLASSES, self.class_ids, self.scores,
+                                    self.box_offsets, threshold))
+
+    def test_no_boxes(self):
+        words = detection_store.objects_above(CLASSES, np.zeros(0, dtype=int), np.zeros(0),
+                                              np.zeros(4, dtype=int), 0.5)
+        self.assertSameWords(words, [[], [], []])
+
+    def test_float64_scores_at_threshold(self):
+        # VinVL's .npz outputs hold float32 scores widened to float64, and
+        # float32(0.3) is above 0.3 only when compared in float64
+        scores = [float(np.float32(0.3)), float(np.float32(0.5)), 0.2]
+        class_ids = [0, 1, 2]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "split.store")
+            with DetectionStoreWriter(path, CLASSES, score_dtype=np.float64) as writer:
+                writer.append("a", np.zeros((3, 4)), scores, class_ids)
+            reader = DetectionStoreReader(path)
+            self.assertEqual(reader.scores.dtype, np.float64)
+            for threshold in (0.3, 0.5):
+                expected = naive_objects_above(CLASSES, np.array(class_ids),
+                                               np.array(scores), [0, 3], threshold)
+                self.assertSameWords(reader.objects_above(["a"], threshold), expected)
+            self.assertSameWords(reader.objects_above(["a"], 0.3), [["cat", "dog"]])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_reader(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "split.store")
+            with DetectionStoreWriter(path, CLASSES, chunk_size=7) as writer:
+                for i in range(len(self.box_offsets) - 1):
+                    start, end = self.box_offsets[i], self.box_offsets[i + 1]
+                    writer.append(str(i), np.zeros((end - start, 4)), self.scores[start:end],
+                                  self.class_ids[start:end])
+            reader = DetectionStoreReader(path)
+            expected = naive_objects_above(CLASSES, self.class_ids, self.scores,
+                                           self.box_offsets, 0.4)
+            # in any order, as manifest entries
+            order = self.rng.permutation(len(expected))
+            names = ["split/{}.npz".format(i) for i in order]
+            self.assertSameWords(reader.objects_above(names, 0.4), [expected[i] for i in order])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import feature_store
+from feature_store import ShardedFeatureReader, ShardedFeatureWriter
+
+LAYERS = [("res4frelu", (3, 2, 2)), ("avgpool", (5,))]
+
+
+def random_feats(rng):
+    return {layer: rng.rand(*shape).astype(np.float32) for layer, shape in LAYERS}
+
+
+class TestShardedFeatureStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "train")
+        self.rng = np.random.RandomState(0)
+        _, self.record_size = feature_store.record_layout(LAYERS)
+        # three records per shard
+        self.shard_size = 3 * self.record_size
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, images, part=None, resume=False):
+        with ShardedFeatureWriter(self.path, LAYERS, shard_size=self.shard_size,
+                                  resume=resume, part=part) as writer:
+            for name, feats in images:
+                writer.append(name, feats)
+
+    def assertImage(self, reader, name, feats):
+        for layer, _ in LAYERS:
+            stored = reader.get(name, layer)
+            self.assertEqual(stored.dtype, np.float16)
+            np.testing.assert_array_equal(stored, feats[layer].astype(np.float16))
+
+    def test_record_layout(self):
+        layout, size = feature_store.record_layout(LAYERS)
+        self.assertEqual(layout, {"res4frelu": (0, (3, 2, 2)), "avgpool": (24, (5,))})
+        self.assertEqual(size, 34)
+
+    def test_shards(self):
+        images = [(str(i), random_feats(self.rng)) for i in range(8)]
+        self.write(images)
+        reader = ShardedFeatureReader(self.path)
+        self.assertEqual(len(reader.shards), 3)
+        self.assertEqual(reader.names, [name for name, _ in images])
+        for name, feats in images:
+            self.assertImage(reader, name, feats)
+        # manifest entries
+        self.assertIn("train/5.npy", reader)
+        self.assertImage(reader, "train/5.npy", images[5][1])
+
+    def test_shape_mismatch(self):
+        feats = random_feats(self.rng)
+        feats["avgpool"] = feats["avgpool"][:4]
+        with self.assertRaises(ValueError):
+            self.write([("a", feats)])
+
+    def test_merge_parts(self):
+        images = [(str(i), random_feats(self.rng)) for i in range(10)]
+        self.write(images[0::2], part="0")
+        self.write(images[1::2], part="1")
+        names = [name for name, _ in images] + ["missing"]
+        feature_store.merge_parts(self.path, names)
+        self.assertEqual([f for f in os.listdir(self.path) if f.startswith("index")],
+                         ["index.json"])
+        reader = ShardedFeatureReader(self.path)
+        # ordered as requested, without the missing name
+        self.assertEqual(reader.names, names[:-1])
+        for name, feats in images:
+            self.assertImage(reader, name, feats)
+
+    def test_resume(self):
+        images = [(str(i), random_feats(self.rng)) for i in range(7)]
+        self.write(images[:4])
+        # a crash after appending unflushed records
+        writer = ShardedFeatureWriter(self.path, LAYERS, shard_size=self.shard_size, resume=True)
+        writer.append("lost", random_feats(self.rng))
+        writer._fd.flush()
+        self.write(images[4:], resume=True)
+
+        reader = ShardedFeatureReader(self.path)
+        self.assertNotIn("lost", reader)
+        self.assertEqual(reader.names, [name for name, _ in images])
+        for name, feats in images:
+            self.assertImage(reader, name, feats)
+        shard_sizes = [os.path.getsize(os.path.join(self.path, s)) for s in reader.shards]
+        self.assertEqual(sum(shard_sizes), 7 * self.record_size)
+
+    def test_resume_replaces_name(self):
+        first, second = random_feats(self.rng), random_feats(self.rng)
+        self.write([("a", first)])
+        self.write([("a", second)], resume=True)
+        reader = ShardedFeatureReader(self.path)
+        self.assertEqual(len(reader), 1)
+        self.assertImage(reader, "a", second)
+
+    def test_resume_layer_mismatch(self):
+        self.write([("a", random_feats(self.rng))])
+        with self.assertRaises(ValueError):
+            ShardedFeatureWriter(self.path, LAYERS[:1], resume=True)
+
+    def test_index_is_json(self):
+        self.write([("a", random_feats(self.rng))])
+        with open(os.path.join(self.path, feature_store.INDEX_FILE)) as f:
+            index = json.load(f)
+        self.assertEqual(index["images"], [["a", 0, 0]])
+        feature_store.remove_store(self.path)
+        self.assertEqual(os.listdir(self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
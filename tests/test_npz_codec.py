@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import npz_codec
+
+
+def installed(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def fake_frame_codec(codec):
+    """Frames with zlib, to test the framing without lz4 or zstandard"""
+    return zlib.compress, zlib.decompress
+
+
+class TestNpzCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.arrays = {
+            "x": rng.rand(10, 2048).astype(np.float32),
+            "bbox": rng.rand(10, 4).astype(np.float32),
+            "num_bbox": np.array(10),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name="image"):
+        return os.path.join(self.tmpdir, name)
+
+    def assertRoundTrip(self, codec):
+        npz_codec.save(self.path(), codec, **self.arrays)
+        path = self.path() + ".npz"
+        self.assertTrue(npz_codec.is_complete(path))
+        loaded = npz_codec.load(path)
+        self.assertEqual(sorted(loaded.keys()), sorted(self.arrays))
+        for name, array in self.arrays.items():
+            np.testing.assert_array_equal(loaded[name], array)
+        return path
+
+    def assertTruncatedIncomplete(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        for size in (0, 3, len(npz_codec.MAGIC) + 2, len(data) // 2, len(data) - 1):
+            with open(path, "wb") as f:
+                f.write(data[:size])
+            self.assertFalse(npz_codec.is_complete(path), size)
+
+    def test_zlib(self):
+        path = self.assertRoundTrip("zlib")
+        # plain np.load reads the zip codecs
+        np.testing.assert_array_equal(np.load(path)["x"], self.arrays["x"])
+        self.assertTruncatedIncomplete(path)
+
+    def test_none(self):
+        path = self.assertRoundTrip("none")
+        self.assertTruncatedIncomplete(path)
+
+    def test_frame(self):
+        with mock.patch.object(npz_codec, "_frame_codec", fake_frame_codec):
+            path = self.assertRoundTrip("lz4")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(len(npz_codec.MAGIC)), npz_codec.MAGIC)
+            self.assertTruncatedIncomplete(path)
+
+    @unittest.skipUnless(installed("lz4"), "needs lz4")
+    def test_lz4(self):
+        self.assertTruncatedIncomplete(self.assertRoundTrip("lz4"))
+
+    @unittest.skipUnless(installed("zstandard"), "needs zstandard")
+    def test_zstd(self):
+        self.assertTruncatedIncomplete(self.assertRoundTrip("zstd"))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            npz_codec.save(self.path(), "brotli", **self.arrays)
+
+    def test_missing_file(self):
+        self.assertFalse(npz_codec.is_complete(self.path("missing.npz")))
+
+    def test_open_file(self):
+        with mock.patch.object(npz_codec, "_frame_codec", fake_frame_codec):
+            for codec in ("zlib", "lz4"):
+                path = self.path(codec + ".npz")
+                with open(path, "wb") as f:
+                    npz_codec.save(f, codec, **self.arrays)
+                self.assertTrue(npz_codec.is_complete(path))
+                np.testing.assert_array_equal(npz_codec.load(path)["bbox"], self.arrays["bbox"])
+
+    def test_codec_numpy(self):
+        saved = []
+        np_module = npz_codec.CodecNumpy("none", on_save=lambda f, arrays: saved.append(f))
+        # other attributes are numpy's
+        self.assertIs(np_module.float32, np.float32)
+        np_module.savez_compressed(self.path(), self.arrays["bbox"], x=self.arrays["x"])
+        self.assertEqual(saved, [self.path()])
+        loaded = npz_codec.load(self.path() + ".npz")
+        np.testing.assert_array_equal(loaded["arr_0"], self.arrays["bbox"])
+        np.testing.assert_array_equal(loaded["x"], self.arrays["x"])
+        # uncompressed zip
+        buf = io.BytesIO()
+        np.savez(buf, arr_0=self.arrays["bbox"], x=self.arrays["x"])
+        self.assertEqual(os.path.getsize(self.path() + ".npz"), len(buf.getvalue()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def installed(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+NUM_IMAGES = 5
+
+
+@unittest.skipUnless(installed("torchvision"), "needs torch and torchvision")
+class TestDataParallel(unittest.TestCase):
+    """Two CPU processes write the same features as a single process."""
+
+    @classmethod
+    def setUpClass(cls):
+        import torch
+        from PIL import Image
+        from torchvision.models import resnet50
+
+        cls.tmpdir = tempfile.mkdtemp()
+        torch.manual_seed(0)
+        # Random weights, the features only need to be deterministic
+        cls.model_file = os.path.join(cls.tmpdir, "resnet50.pth")
+        torch.save(resnet50().state_dict(), cls.model_file)
+
+        cls.image_dir = os.path.join(cls.tmpdir, "images")
+        os.makedirs(cls.image_dir)
+        rng = np.random.RandomState(0)
+        cls.names = []
+        for i in range(NUM_IMAGES):
+            size = (240 + 10 * i, 230)
+            img = rng.randint(0, 256, size + (3,)).astype(np.uint8)
+            Image.fromarray(img).save(os.path.join(cls.image_dir, "{}.jpg".format(i)))
+            cls.names.append("{}.jpg".format(i))
+        cls.file_list = os.path.join(cls.tmpdir, "test.txt")
+        with open(cls.file_list, "w") as f:
+            f.write("\n".join(cls.names) + "\n")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def extract(self, devices, output_format):
+        import extract_image_feats_resnet50 as extractor
+        output_folder = os.path.join(
+            self.tmpdir, "{}-{}".format(devices.replace(",", "-"), output_format))
+        # One image per batch and one thread, so that every image goes
+        # through exactly the same computation in all runs
+        args = extractor.parse_args([
+            "-i", self.image_dir, "-f", self.file_list, "-m", self.model_file,
+            "-o", output_folder, "-s", "test", "-b", "1",
+            "--output-format", output_format, "--layers", "res4frelu",
+            "--devices", devices, "--intra-op-threads", "1", "--num-workers", "0"])
+        extractor.run(args)
+        return output_folder
+
+    def load(self, output_folder, output_format):
+        if output_format == "sharded":
+            from feature_store import ShardedFeatureReader
+            reader = ShardedFeatureReader(os.path.join(output_folder, "sharded", "test"))
+            self.assertEqual(reader.names, [str(i) for i in range(NUM_IMAGES)])
+            return [reader.get(str(i), "res4frelu") for i in range(NUM_IMAGES)]
+        return [np.load(os.path.join(output_folder, "res4frelu", "test", "{}.npy".format(i)))
+                for i in range(NUM_IMAGES)]
+
+    def assertSameFeatures(self, output_format):
+        from resnet50_utils import ProgressLog, split_work
+        # Both workers get images
+        self.assertEqual(split_work(list(range(NUM_IMAGES)), 2), [[0, 1, 2], [3, 4]])
+
+        single = self.extract("cpu", output_format)
+        parallel = self.extract("cpu,cpu", output_format)
+        for expected, feats in zip(self.load(single, output_format),
+                                   self.load(parallel, output_format)):
+            self.assertEqual(feats.shape, (1024, 14, 14))
+            np.testing.assert_array_equal(feats, expected)
+
+        # Each worker logged its own part, and together they cover all images
+        self.assertIn("test.progress.0", os.listdir(parallel))
+        self.assertIn("test.progress.1", os.listdir(parallel))
+        log = ProgressLog(os.path.join(parallel, "test.progress"),
+                          {"images": NUM_IMAGES, "layers": ["res4frelu"],
+                           "format": output_format})
+        self.assertTrue(log.load())
+        self.assertEqual(log.remaining(NUM_IMAGES), [])
+
+    def test_sharded(self):
+        self.assertSameFeatures("sharded")
+
+    def test_npy(self):
+        self.assertSameFeatures("npy")
+
+
+if __name__ == '__main__':
+    unittest.main()
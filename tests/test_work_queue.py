@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import work_queue
+
+
+# Worker functions are module-level, so that spawned processes can unpickle them
+
+def init_worker(outdir, worker):
+    path = os.path.join(outdir, "worker{}.txt".format(worker))
+    open(path, "a").close()
+    return path
+
+def record_chunk(state, worker, chunk):
+    with open(state, "a") as f:
+        for item in chunk:
+            f.write("{}\n".format(item))
+
+def fail_on_item(state, worker, chunk):
+    if 13 in chunk:
+        raise ValueError("bad item")
+    record_chunk(state, worker, chunk)
+
+
+class TestRunLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def init_fn(self):
+        return functools.partial(init_worker, self.tmpdir)
+
+    def processed(self):
+        items = []
+        for fname in os.listdir(self.tmpdir):
+            with open(os.path.join(self.tmpdir, fname)) as f:
+                items += [int(line) for line in f]
+        return items
+
+    def test_every_chunk_once(self):
+        chunks = work_queue.make_chunks(list(range(50)), 3)
+        progress = []
+        throughput = work_queue.run_local(
+            self.init_fn(), record_chunk, chunks, 3, progress=progress.append)
+        # each item once, whichever worker pulled its chunk
+        self.assertEqual(sorted(self.processed()), list(range(50)))
+        self.assertEqual(sum(progress), 50)
+        # every worker's images, chunks and time
+        stats = throughput.workers
+        self.assertTrue(set(stats) <= set(range(3)))
+        self.assertEqual(sum(items for items, _, _ in stats.values()), 50)
+        self.assertEqual(sum(n for _, n, _ in stats.values()), len(chunks))
+        self.assertTrue(all(seconds >= 0 for _, _, seconds in stats.values()))
+        self.assertIn("images/s", throughput.report())
+
+    def test_fewer_chunks_than_workers(self):
+        chunks = work_queue.make_chunks(list(range(4)), 2)
+        throughput = work_queue.run_local(self.init_fn(), record_chunk, chunks, 4)
+        # only as many workers as chunks are started
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["worker0.txt", "worker1.txt"])
+        self.assertEqual(sorted(self.processed()), list(range(4)))
+        self.assertEqual(sum(n for _, n, _ in throughput.workers.values()), 2)
+
+    def test_no_chunks(self):
+        throughput = work_queue.run_local(self.init_fn(), record_chunk, [], 2)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertEqual(throughput.workers, {})
+
+    def test_worker_error(self):
+        chunks = work_queue.make_chunks(list(range(30)), 2)
+        with self.assertRaises(RuntimeError):
+            work_queue.run_local(self.init_fn(), fail_on_item, chunks, 2)
+
+
+class TestChunkQueue(unittest.TestCase):
+
+    def test_order(self):
+        chunks = work_queue.make_chunks(list(range(7)), 3)
+        self.assertEqual(chunks, [[0, 1, 2], [3, 4, 5], [6]])
+        q = work_queue.ChunkQueue(chunks)
+        self.assertEqual(q.get(0), [0, 1, 2])
+        self.assertEqual(q.get(1), [3, 4, 5])
+        q.done(0, 3, 0.5)
+        q.done(0, 3, 0.5)
+        self.assertEqual(q.get(0), [6])
+        self.assertIsNone(q.get(1))
+        self.assertEqual(q.throughput.workers[0], (6, 2, 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()